@@ -1,33 +1,29 @@
 import json
-import time
 import traceback
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from django.contrib.auth import get_user_model
-from .models import Message, Stream
-from moderation.ai_detector import ToxicityDetector
+from .models import Message
+from .ratelimit import get_rate_limiter, rate_limit_key, rate_limited_payload
+from .outbound import OutboundQueue
+from .presence import viewer_presence
+from .directory import stream_directory
+from moderation.pipeline import ModerationContext, chat_pipeline
+from moderation.expiry import expiry_scheduler
 from asgiref.sync import sync_to_async
 
 
-@database_sync_to_async
-def get_or_create_user_db(username, client_user_id=None):
-    User = get_user_model()
-    try:
-        if client_user_id:
-            u = User.objects.filter(id=client_user_id).first()
-            if u:
-                return u.id
-    except Exception:
-        pass
-
-    user, _ = User.objects.get_or_create(username=username)
-    return user.id
-
 class ChatConsumer(AsyncWebsocketConsumer):
     """Global chat WebSocket consumer"""
     
     async def connect(self):
         self.room_group_name = 'global_chat'
+        self.rate_limiter = get_rate_limiter('chat')
+        self.rate_bucket = self.rate_limiter.connection_bucket()
+        expiry_scheduler.start()
+        # Broadcasts go through a bounded queue so a slow client can't back up the room.
+        # Created before joining the group; frames wait there until the history has been sent.
+        self.outbox = OutboundQueue(self, self.room_group_name, start=False)
         
         # Join room group
         await self.channel_layer.group_add(
@@ -43,6 +39,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'type': 'message_history',
             'messages': messages
         }))
+        self.outbox.start()
     
     async def disconnect(self, close_code):
         # Leave room group
@@ -50,98 +47,31 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        if getattr(self, 'outbox', None):
+            self.outbox.close()
     
     async def receive(self, text_data):
         try:
+            # Per-socket limit first: rejects floods before parsing or touching the DB
+            if self.rate_bucket and not self.rate_bucket.consume():
+                await self.send(text_data=json.dumps(rate_limited_payload(self.rate_bucket.retry_after())))
+                return
+
             data = json.loads(text_data)
             message_type = data.get('type')
 
             if message_type == 'chat_message':
                 username = data.get('username')
-                message_text = data.get('message')
                 client_user_id = data.get('user_id')
-
-                # Resolve or create a server-side user for this client (ensures restriction checks work)
-                server_user_id = await get_or_create_user_db(username, client_user_id)
-
-                # Check if user is restricted (using server-side id)
-                is_restricted = await self.check_user_restriction(server_user_id)
-                if is_restricted:
-                    await self.send(text_data=json.dumps({
-                        'type': 'error',
-                        'message': 'You are restricted from chatting'
-                    }))
-                    return
-
-                # Check toxicity (ASYNC, no database_sync_to_async wrapper)
-                detector = ToxicityDetector()
-                toxicity_result = await detector.analyze_async(message_text)
-
-                is_toxic = toxicity_result['is_toxic']
-                toxicity_score = toxicity_result['toxicity_score']
-
-                if is_toxic:
-                    # Increment messages_sent for the user
-                    await self.increment_user_stat(server_user_id, 'messages_sent')
-                    
-                    # Get masked text
-                    broadcast_text = toxicity_result.get('masked_text', message_text)
-                    
-                    # Save the MASKED message to DB and broadcast
-                    message = await self.save_message(
-                        server_user_id,
-                        broadcast_text,
-                        None,
-                        True, # Flagged
-                        toxicity_score
-                    )
-
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'chat_message',
-                            'message': message
-                        }
-                    )
-                    
-                    # Issue warning ONLY if should_warn is true
-                    if toxicity_result.get('should_warn', True):
-                        warning_count = await self.issue_warning(server_user_id, None)
-                        if warning_count >= 3:
-                            await self.restrict_user(server_user_id)
-                            await self.send(text_data=json.dumps({
-                                'type': 'restriction',
-                                'message': 'You have been restricted from chatting due to repeated violations'
-                            }))
-                        else:
-                            await self.send(text_data=json.dumps({
-                                'type': 'warning',
-                                'warning_count': warning_count,
-                                'message': f'Warning {warning_count}/3: Your message contained inappropriate content and was masked.'
-                            }))
-                    else:
-                        print(f"   [MESSAGING] Masked message sent without warning due to positive sentiment.")
-                    return
-
-                # Increment messages_sent for the user
-                await self.increment_user_stat(server_user_id, 'messages_sent')
-
-                # Save non-toxic message to database and broadcast
-                message = await self.save_message(
-                    server_user_id,
-                    message_text,
-                    None,
-                    is_toxic,
-                    toxicity_score
-                )
-
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'chat_message',
-                        'message': message
-                    }
-                )
+                await chat_pipeline.run(ModerationContext(
+                    consumer=self,
+                    text=data.get('message'),
+                    room_key=self.room_group_name,
+                    user_key=rate_limit_key(self),
+                    username=username,
+                    client_user_id=client_user_id,
+                    stream_id=None,
+                ))
         except Exception:
             traceback.print_exc()
             try:
@@ -156,11 +86,19 @@ class ChatConsumer(AsyncWebsocketConsumer):
         """Receive message from room group"""
         message = event['message']
         
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
+        # Queue message for the WebSocket (never blocks the group dispatch)
+        self.outbox.put({
             'type': 'new_message',
             'message': message
-        }))
+        })
+    
+    async def restriction_expired(self, event):
+        """Broadcast by the expiry scheduler when a timed restriction ends"""
+        self.outbox.put({
+            'type': 'restriction_expired',
+            'user_id': event['user_id'],
+            'restriction_type': event.get('restriction_type'),
+        })
     
     @database_sync_to_async
     def get_recent_messages(self):
@@ -175,109 +113,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'timestamp': msg.created_at.isoformat(),
         } for msg in reversed(messages)]
     
-    @database_sync_to_async
-    def increment_user_stat(self, user_id, field):
-        User = get_user_model()
-        try:
-            user = User.objects.get(id=user_id)
-            current_val = getattr(user, field, 0)
-            setattr(user, field, current_val + 1)
-            user.save()
-            print(f"   [+] Stats: Incremented {field} for user {user.username}")
-        except Exception as e:
-            print(f"   [!] Stats Error: {e}")
-
-    @database_sync_to_async
-    def save_message(self, user_id, text, stream_id, is_flagged, toxicity_score):
-        try:
-            User = get_user_model()
-            user = User.objects.get(id=user_id)
-        except Exception:
-            # Create a lightweight guest user when the provided user_id doesn't exist
-            username = f'guest_{user_id or int(time.time()*1000)}'
-            User = get_user_model()
-            user, _ = User.objects.get_or_create(username=username)
-        stream = Stream.objects.get(id=stream_id) if stream_id else None
-        
-        message = Message.objects.create(
-            user=user,
-            text=text,
-            stream=stream,
-            is_flagged=is_flagged,
-            toxicity_score=toxicity_score
-        )
-        
-        return {
-            'id': message.id,
-            'user_id': message.user.id,
-            'username': message.user.username,
-            'text': message.text,
-            'is_flagged': message.is_flagged,
-            'toxicity_score': message.toxicity_score,
-            'timestamp': message.created_at.isoformat(),
-        }
-    
-    @database_sync_to_async
-    def check_user_restriction(self, user_id):
-        if not user_id:
-            return False
-        try:
-            from moderation.models import Restriction
-            from django.utils import timezone
-            
-            restrictions = Restriction.objects.filter(
-                user_id=user_id,
-                restriction_type__in=['chat', 'full']
-            ).filter(
-                is_permanent=True
-            ) | Restriction.objects.filter(
-                user_id=user_id,
-                restriction_type__in=['chat', 'full'],
-                expires_at__gt=timezone.now()
-            )
-            
-            return restrictions.exists()
-        except:
-            return False
-
-    
-    
-    @database_sync_to_async
-    def issue_warning(self, user_id, message_id):
-        from moderation.models import Warning
-        User = get_user_model()
-        user = User.objects.get(id=user_id)
-        message = Message.objects.get(id=message_id) if message_id else None
-
-        Warning.objects.create(
-            user=user,
-            message=message,
-            reason="Automatic: Toxic content detected",
-            is_automatic=True
-        )
-
-        return Warning.objects.filter(user=user).count()
-    
-    @database_sync_to_async
-    def restrict_user(self, user_id):
-        from moderation.models import Restriction
-        User = get_user_model()
-        user = User.objects.get(id=user_id)
-        
-        Restriction.objects.create(
-            user=user,
-            restriction_type='chat',
-            reason="Automatic: 3 warnings for toxic behavior",
-            is_permanent=False
-        )
-
-
 class StreamChatConsumer(AsyncWebsocketConsumer):
     """Stream-specific chat WebSocket consumer"""
     
     async def connect(self):
         self.stream_id = self.scope['url_route']['kwargs']['stream_id']
         self.room_group_name = f'stream_chat_{self.stream_id}'
+        self.rate_limiter = get_rate_limiter('chat')
+        self.rate_bucket = self.rate_limiter.connection_bucket()
+        expiry_scheduler.start()
+        # Broadcasts go through a bounded queue so a slow viewer can't back up the room.
+        # Created before joining the group; frames wait there until the history has been sent.
+        self.outbox = OutboundQueue(self, self.room_group_name, start=False)
         
         # Join room group
         await self.channel_layer.group_add(
@@ -287,8 +134,10 @@ class StreamChatConsumer(AsyncWebsocketConsumer):
         
         await self.accept()
         
-        # Update viewer count
-        await self.update_viewer_count(1)
+        # Counted in memory; the worker flushes counts to the DB and broadcasts them in batches
+        viewer_presence.start()
+        self.viewer_id = self.get_viewer_id()
+        viewer_presence.join(self.stream_id, self.viewer_id)
         
         # Send recent messages
         messages = await self.get_recent_messages()
@@ -296,6 +145,7 @@ class StreamChatConsumer(AsyncWebsocketConsumer):
             'type': 'message_history',
             'messages': messages
         }))
+        self.outbox.start()
     
     async def disconnect(self, close_code):
         # Leave room group
@@ -303,101 +153,34 @@ class StreamChatConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        if getattr(self, 'outbox', None):
+            self.outbox.close()
         
-        # Update viewer count
-        await self.update_viewer_count(-1)
+        if hasattr(self, 'viewer_id'):
+            viewer_presence.leave(self.stream_id, self.viewer_id)
     
     async def receive(self, text_data):
         try:
+            # Per-socket limit first: rejects floods before parsing or touching the DB
+            if self.rate_bucket and not self.rate_bucket.consume():
+                await self.send(text_data=json.dumps(rate_limited_payload(self.rate_bucket.retry_after())))
+                return
+
             data = json.loads(text_data)
             message_type = data.get('type')
 
             if message_type == 'chat_message':
                 username = data.get('username')
-                message_text = data.get('message')
                 client_user_id = data.get('user_id')
-
-                # Resolve or create a server-side user for this client (ensures restriction checks work)
-                server_user_id = await get_or_create_user_db(username, client_user_id)
-
-                # Check if user is restricted (using server-side id)
-                is_restricted = await self.check_user_restriction(server_user_id)
-                if is_restricted:
-                    await self.send(text_data=json.dumps({
-                        'type': 'error',
-                        'message': 'You are restricted from chatting'
-                    }))
-                    return
-
-                # Check toxicity (ASYNC)
-                detector = ToxicityDetector()
-                toxicity_result = await detector.analyze_async(message_text)
-
-                is_toxic = toxicity_result['is_toxic']
-                toxicity_score = toxicity_result['toxicity_score']
-
-                if is_toxic:
-                    # Increment messages_sent for the user
-                    await self.increment_user_stat(server_user_id, 'messages_sent')
-                    
-                    # Get masked text
-                    broadcast_text = toxicity_result.get('masked_text', message_text)
-                    
-                    # Save masked message and broadcast
-                    message = await self.save_message(
-                        server_user_id,
-                        broadcast_text,
-                        self.stream_id,
-                        True, # Flagged
-                        toxicity_score
-                    )
-
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'chat_message',
-                            'message': message
-                        }
-                    )
-                    
-                    # Issue warning ONLY if should_warn is true
-                    if toxicity_result.get('should_warn', True):
-                        warning_count = await self.issue_warning(server_user_id, None)
-                        if warning_count >= 3:
-                            await self.restrict_user(server_user_id)
-                            await self.send(text_data=json.dumps({
-                                'type': 'restriction',
-                                'message': 'You have been restricted from chatting'
-                            }))
-                        else:
-                            await self.send(text_data=json.dumps({
-                                'type': 'warning',
-                                'warning_count': warning_count,
-                                'message': f'Warning {warning_count}/3: Inappropriate content was masked'
-                            }))
-                    else:
-                        print(f"   [STREAM] Masked message sent without warning due to positive sentiment.")
-                    return
-
-                # Increment messages_sent for the user
-                await self.increment_user_stat(server_user_id, 'messages_sent')
-
-                # Save non-toxic message to database and broadcast
-                message = await self.save_message(
-                    server_user_id,
-                    message_text,
-                    self.stream_id,
-                    is_toxic,
-                    toxicity_score
-                )
-
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'chat_message',
-                        'message': message
-                    }
-                )
+                await chat_pipeline.run(ModerationContext(
+                    consumer=self,
+                    text=data.get('message'),
+                    room_key=self.room_group_name,
+                    user_key=rate_limit_key(self),
+                    username=username,
+                    client_user_id=client_user_id,
+                    stream_id=self.stream_id,
+                ))
         except Exception:
             traceback.print_exc()
             try:
@@ -410,10 +193,23 @@ class StreamChatConsumer(AsyncWebsocketConsumer):
     
     async def chat_message(self, event):
         message = event['message']
-        await self.send(text_data=json.dumps({
+        self.outbox.put({
             'type': 'new_message',
             'message': message
-        }))
+        })
+
+    async def stream_event(self, event):
+        """Lifecycle delta for this stream (ended, stopped, viewer count)"""
+        if getattr(self, 'outbox', None):
+            self.outbox.put(dict(event))
+
+    def get_viewer_id(self):
+        """Logged-in user, else the `user_id` the client passes in the query string"""
+        user = self.scope.get('user')
+        if user is not None and user.is_authenticated:
+            return user.pk
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        return query.get('user_id', [None])[0]
     
     @database_sync_to_async
     def get_recent_messages(self):
@@ -431,162 +227,42 @@ class StreamChatConsumer(AsyncWebsocketConsumer):
             'timestamp': msg.created_at.isoformat(),
         } for msg in reversed(messages)]
     
-    @database_sync_to_async
-    def increment_user_stat(self, user_id, field):
-        User = get_user_model()
-        try:
-            user = User.objects.get(id=user_id)
-            current_val = getattr(user, field, 0)
-            setattr(user, field, current_val + 1)
-            user.save()
-        except:
-            pass
-
-    @database_sync_to_async
-    def save_message(self, user_id, text, stream_id, is_flagged, toxicity_score):
-        try:
-            User = get_user_model()
-            user = User.objects.get(id=user_id)
-        except Exception:
-            username = f'guest_{user_id or int(time.time()*1000)}'
-            User = get_user_model()
-            user, _ = User.objects.get_or_create(username=username)
-        stream = Stream.objects.get(id=stream_id)
-        
-        message = Message.objects.create(
-            user=user,
-            text=text,
-            stream=stream,
-            is_flagged=is_flagged,
-            toxicity_score=toxicity_score
-        )
-        
-        return {
-            'id': message.id,
-            'user_id': message.user.id,
-            'username': message.user.username,
-            'text': message.text,
-            'is_flagged': message.is_flagged,
-            'toxicity_score': message.toxicity_score,
-            'timestamp': message.created_at.isoformat(),
-        }
-    
-    @database_sync_to_async
-    def update_viewer_count(self, change):
-        try:
-            stream = Stream.objects.get(id=self.stream_id)
-            stream.viewer_count = max(0, stream.viewer_count + change)
-            stream.save()
-        except Stream.DoesNotExist:
-            pass
-    
-    @database_sync_to_async
-    def check_user_restriction(self, user_id):
-        if not user_id:
-            return False
-        try:
-            from moderation.models import Restriction
-            from django.utils import timezone
-            
-            restrictions = Restriction.objects.filter(
-                user_id=user_id,
-                restriction_type__in=['chat', 'full']
-            ).filter(
-                is_permanent=True
-            ) | Restriction.objects.filter(
-                user_id=user_id,
-                restriction_type__in=['chat', 'full'],
-                expires_at__gt=timezone.now()
-            )
-            
-            return restrictions.exists()
-        except:
-            return False
-    
-    @database_sync_to_async
-    def issue_warning(self, user_id, message_id):
-        from moderation.models import Warning
-        User = get_user_model()
-        user = User.objects.get(id=user_id)
-        message = Message.objects.get(id=message_id) if message_id else None
-
-        Warning.objects.create(
-            user=user,
-            message=message,
-            reason="Automatic: Toxic content detected",
-            is_automatic=True
-        )
-
-        return Warning.objects.filter(user=user).count()
-    
-    @database_sync_to_async
-    def restrict_user(self, user_id):
-        from moderation.models import Restriction
-        User = get_user_model()
-        user = User.objects.get(id=user_id)
-        
-        Restriction.objects.create(
-            user=user,
-            restriction_type='chat',
-            reason="Automatic: warnings for toxic behavior",
-            is_permanent=False
-        )
-
-
 class StreamConsumer(AsyncWebsocketConsumer):
-    """Live stream status updates"""
+    """Live stream status updates, served from the worker's stream directory"""
     
     async def connect(self):
         self.room_group_name = 'streams'
-        
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        await stream_directory.start()
         
         await self.accept()
         
-        # Send current streams
-        streams = await self.get_active_streams()
-        await self.send(text_data=json.dumps({
-            'type': 'stream_list',
-            'streams': streams
-        }))
+        # Resuming clients get the deltas they missed, everyone else the current list
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        since = query.get('since', [''])[0]
+        missed = stream_directory.catch_up(
+            query.get('epoch', [None])[0],
+            int(since) if since.isdigit() else None
+        )
+        self.outbox = OutboundQueue(self, self.room_group_name)
+        if missed is None:
+            self.outbox.put(stream_directory.snapshot())
+        else:
+            for frame in missed:
+                self.outbox.put(frame)
+        stream_directory.subscribe(self.outbox)
     
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        if getattr(self, 'outbox', None):
+            stream_directory.unsubscribe(self.outbox)
+            self.outbox.close()
     
     async def receive(self, text_data):
         data = json.loads(text_data)
         message_type = data.get('type')
         
         if message_type == 'stream_update':
-            # Broadcast stream update
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'stream_update',
-                    'stream': data['stream']
-                }
-            )
-    
-    async def stream_update(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'stream_update',
-            'stream': event['stream']
-        }))
-    
-    @database_sync_to_async
-    def get_active_streams(self):
-        streams = Stream.objects.filter(status='live').select_related('streamer')
-        return [{
-            'id': stream.id,
-            'streamer_id': stream.streamer.id,
-            'streamer_name': stream.streamer.username,
-            'title': stream.title,
-            'viewer_count': stream.viewer_count,
-            'started_at': stream.started_at.isoformat(),
-        } for stream in streams]
\ No newline at end of file
+            # Stream state is published by the server (chat.events), not relayed from clients
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': 'Stream updates are read-only'
+            }))
@@ -0,0 +1,177 @@
+"""
+Server-owned directory of live streams.
+
+StreamConsumer used to query every live stream for each subscriber and
+rebroadcast any stream object a client sent it. Each worker now keeps one
+in-memory snapshot of the live streams. It is loaded when the first
+subscriber connects and then kept current from the `stream_event`s that
+chat.events sends to the `streams` group. A resync every
+DIRECTORY_RESYNC_SECONDS catches changes that never produced an event (admin
+edits, lost messages). Every change bumps `version`, and the recent deltas
+are kept. A reconnecting client that passes `?epoch=..&since=..` gets only
+what it missed. Anyone else, or a client that is too far behind, gets the
+snapshot.
+
+Versions are per worker. `epoch` identifies the snapshot they count from,
+so a client resuming on another worker, or after a restart, falls back to
+the full list.
+"""
+import asyncio
+import time
+import uuid
+from collections import deque
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .events import STREAMS_GROUP, STARTED, ENDED, STOPPED, VIEWER_COUNT, stream_summary
+from .models import Stream
+
+
+# Deltas kept for resuming clients
+DELTA_LOG_SIZE = 500
+# Re-join the group well before channels_redis' group_expiry drops the listener
+REJOIN_SECONDS = 3600
+
+
+class StreamDirectory:
+    def __init__(self):
+        self.streams = {}
+        self.version = 0
+        self.epoch = None
+        self.log = deque(maxlen=DELTA_LOG_SIZE)
+        self.subscribers = set()
+        self.loop = None
+        self.task = None
+        self.ready = None
+
+    async def start(self):
+        """Load and subscribe once per event loop; later callers just wait until it's ready"""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop or self.task is None or self.task.done():
+            self.loop = loop
+            self.ready = loop.create_future()
+            self.task = loop.create_task(self._listen())
+        await asyncio.shield(self.ready)
+
+    def subscribe(self, subscriber):
+        """`subscriber.put(frame)` is called with every delta (e.g. an OutboundQueue)"""
+        self.subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def snapshot(self):
+        return {
+            'type': 'stream_list',
+            'streams': list(self.streams.values()),
+            'version': self.version,
+            'epoch': self.epoch,
+        }
+
+    def catch_up(self, epoch, since):
+        """Deltas after version `since`, or None if the client must take the snapshot instead"""
+        if epoch != self.epoch or since is None or since > self.version:
+            return None
+        if since == self.version:
+            return []
+        if not self.log or self.log[0]['version'] > since + 1:
+            return None
+        return [frame for frame in self.log if frame['version'] > since]
+
+    def apply(self, event, stream, reason=None):
+        """Fold one lifecycle event into the snapshot; returns the delta frame, or None if nothing changed"""
+        stream_id = stream.get('id')
+        if event == STARTED:
+            if self.streams.get(stream_id) == stream:
+                return None
+            self.streams[stream_id] = stream
+        elif event in (ENDED, STOPPED):
+            if self.streams.pop(stream_id, None) is None:
+                return None
+        elif event == VIEWER_COUNT:
+            current = self.streams.get(stream_id)
+            if current is None or current['viewer_count'] == stream['viewer_count']:
+                return None
+            # Replace rather than mutate: queued frames may still reference the old dict
+            self.streams[stream_id] = {**current, 'viewer_count': stream['viewer_count']}
+        else:
+            return None
+
+        self.version += 1
+        frame = {'type': 'stream_event', 'version': self.version, 'event': event, 'stream': stream}
+        if reason:
+            frame['reason'] = reason
+        self.log.append(frame)
+        for subscriber in list(self.subscribers):
+            subscriber.put(frame)
+        return frame
+
+    # ---- task ----
+
+    @database_sync_to_async
+    def _load_live(self):
+        streams = Stream.objects.filter(status='live').select_related('streamer')
+        return {stream.id: stream_summary(stream) for stream in streams}
+
+    async def _resync(self):
+        """Turn differences between the DB and the snapshot into deltas"""
+        live = await self._load_live()
+        for stream_id in list(self.streams):
+            if stream_id not in live:
+                self.apply(ENDED, {'id': stream_id, 'status': 'ended', 'ended_at': None})
+        for stream_id, summary in live.items():
+            current = self.streams.get(stream_id)
+            if current is None:
+                self.apply(STARTED, summary)
+            elif current['viewer_count'] != summary['viewer_count']:
+                self.apply(VIEWER_COUNT, {'id': stream_id, 'viewer_count': summary['viewer_count']})
+
+    async def _listen(self):
+        layer = get_channel_layer()
+        try:
+            channel = await layer.new_channel()
+            # Subscribe before loading so nothing started in between is missed
+            await layer.group_add(STREAMS_GROUP, channel)
+            self.streams = await self._load_live()
+        except Exception as e:
+            print(f"   [DIRECTORY] Could not load live streams: {e}")
+            self.ready.set_exception(e)
+            return
+        self.version = 0
+        self.epoch = uuid.uuid4().hex[:12]
+        self.log.clear()
+        self.ready.set_result(True)
+        print(f"   [DIRECTORY] Loaded {len(self.streams)} live stream(s)")
+
+        resync_seconds = getattr(settings, 'DIRECTORY_RESYNC_SECONDS', 300)
+        rejoin_at = time.monotonic() + REJOIN_SECONDS
+        resync_at = time.monotonic() + resync_seconds
+        try:
+            while True:
+                wait = max(0.0, min(rejoin_at, resync_at) - time.monotonic())
+                try:
+                    message = await asyncio.wait_for(layer.receive(channel), wait)
+                except asyncio.TimeoutError:
+                    message = None
+                now = time.monotonic()
+                if now >= rejoin_at:
+                    await layer.group_add(STREAMS_GROUP, channel)
+                    rejoin_at = now + REJOIN_SECONDS
+                if now >= resync_at:
+                    try:
+                        await self._resync()
+                    except Exception as e:
+                        print(f"   [DIRECTORY] Resync failed: {e}")
+                    resync_at = now + resync_seconds
+                if message is not None and message.get('type') == 'stream_event':
+                    self.apply(message['event'], message['stream'], message.get('reason'))
+        finally:
+            try:
+                await layer.group_discard(STREAMS_GROUP, channel)
+            except Exception:
+                pass
+
+
+stream_directory = StreamDirectory()
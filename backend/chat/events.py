@@ -0,0 +1,63 @@
+"""
+Stream lifecycle events pushed over the channel layer.
+
+Each change goes out as one small `stream_event` frame. It reaches the
+`streams` group (StreamConsumer, the stream directory) and the stream's own
+chat group (its viewers). Clients learn that a stream started, ended, was
+stopped by moderation or changed viewer count without polling
+`StreamListView` / `StreamDetailView`. `stream` carries only the stream id
+and the fields that changed; STARTED carries the full list entry.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+
+STREAMS_GROUP = 'streams'
+
+STARTED = 'started'
+ENDED = 'ended'
+STOPPED = 'stopped'  # ended by speech moderation
+VIEWER_COUNT = 'viewer_count'
+
+
+def stream_chat_group(stream_id):
+    return f'stream_chat_{stream_id}'
+
+
+def stream_summary(stream):
+    """Same shape as the entries StreamConsumer sends in `stream_list`"""
+    return {
+        'id': stream.id,
+        'streamer_id': stream.streamer_id,
+        'streamer_name': stream.streamer.username,
+        'title': stream.title,
+        'viewer_count': stream.viewer_count,
+        'started_at': stream.started_at.isoformat(),
+    }
+
+
+def ended_delta(stream):
+    return {
+        'id': stream.id,
+        'status': stream.status,
+        'ended_at': stream.ended_at.isoformat() if stream.ended_at else None,
+    }
+
+
+async def broadcast_stream_event(event, stream_id, stream, reason=None):
+    """Send one lifecycle delta to the directory and to the stream's viewers"""
+    message = {'type': 'stream_event', 'event': event, 'stream': stream}
+    if reason:
+        message['reason'] = reason
+    channel_layer = get_channel_layer()
+    for group in (STREAMS_GROUP, stream_chat_group(stream_id)):
+        try:
+            await channel_layer.group_send(group, message)
+        except Exception as e:
+            # State is still in the DB; a failed push only costs clients a refresh
+            print(f"[!] Stream event {event} for {stream_id} not sent to {group}: {e}")
+
+
+def broadcast_stream_event_sync(event, stream_id, stream, reason=None):
+    """`broadcast_stream_event` for views and other sync code"""
+    async_to_sync(broadcast_stream_event)(event, stream_id, stream, reason)
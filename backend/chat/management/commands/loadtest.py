@@ -0,0 +1,592 @@
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import Stream
+from safechat.api_stubs import stub_settings_env
+
+
+# Clean messages stay on the keyword fast path, toxic ones trip a high-severity
+# keyword, nuanced ones fall through to the (stubbed) Sightengine API.
+MESSAGES = {
+    'clean': [
+        'hello from the load test',
+        'what game is this',
+        'which map is next',
+        'brb grabbing water',
+        'lol that was close',
+        'first time here, hi all',
+        'gg everyone',
+        'how long is the stream tonight',
+    ],
+    'toxic': [
+        'i will kill you',
+        'go die in a fire',
+        'you are trash and i hate you',
+        'kys loser',
+    ],
+    'nuanced': [
+        'that boss fight was so damn annoying',
+        'you are an idiot honestly',
+        'keep going, you are doing amazing',
+        'fuck it, i believe in this team',
+        'this stream is kinda boring tonight',
+    ],
+}
+
+TRANSCRIPTS = {
+    'clean': [
+        'welcome back to the stream',
+        'we are going to try the next level now',
+        'thanks for the follow',
+        'give me a second to set this up',
+    ],
+    'toxic': [
+        'i am going to kill you',
+        'i hate all of you',
+        'shut up you stupid idiot',
+    ],
+    'nuanced': [
+        'damn that was a terrible run',
+        'keep going chat, we are doing amazing',
+        'this is so annoying',
+    ],
+}
+
+# First reply a speech socket sends for each transcript
+SPEECH_REPLY_TYPES = {'speech_clean', 'speech_toxic', 'timeout_active', 'rate_limited', 'error'}
+
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+TAG_RE = re.compile(r'~lt:(\d+):(\d+)')
+
+
+def summarize(samples_ms):
+    """Percentiles plus a fixed-bucket histogram, so runs can be compared bucket by bucket"""
+    if not samples_ms:
+        return {'count': 0}
+    ordered = sorted(samples_ms)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))], 2)
+
+    histogram = {f'le_{bound}': 0 for bound in HISTOGRAM_BOUNDS_MS}
+    histogram['inf'] = 0
+    for value in ordered:
+        for bound in HISTOGRAM_BOUNDS_MS:
+            if value <= bound:
+                histogram[f'le_{bound}'] += 1
+                break
+        else:
+            histogram['inf'] += 1
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered), 2),
+        'p50': pct(50),
+        'p90': pct(90),
+        'p99': pct(99),
+        'max': round(ordered[-1], 2),
+        'histogram': histogram,
+    }
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in MESSAGES:
+            raise CommandError(f"Unknown message kind '{kind}' in --mix (expected {', '.join(MESSAGES)})")
+        mix[kind] = float(weight or 1)
+    if not any(mix.values()):
+        raise CommandError('--mix needs at least one non-zero weight')
+    return mix
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Client:
+    """One WebSocket connection driven by the load test"""
+
+    def __init__(self, harness, path, room):
+        self.harness = harness
+        self.path = path
+        self.room = room
+        self.ws = None
+        self.reader = None
+
+    async def connect(self):
+        stats = self.harness.connections[self.kind]
+        stats['attempted'] += 1
+        started = time.perf_counter()
+        try:
+            self.ws = await self.harness.websockets.connect(
+                self.harness.base_url + self.path,
+                open_timeout=self.harness.options['connect_timeout'],
+                ping_interval=None,
+                max_size=None,
+            )
+            await self.on_open()
+        except Exception as e:
+            stats['failed'] += 1
+            stats['errors'][type(e).__name__] += 1
+            if self.ws:
+                await self.ws.close()
+            self.ws = None
+            return False
+        stats['open'] += 1
+        self.harness.connect_ms.append((time.perf_counter() - started) * 1000)
+        self.reader = asyncio.create_task(self.read())
+        return True
+
+    async def on_open(self):
+        pass
+
+    async def read(self):
+        try:
+            async for raw in self.ws:
+                frame = json.loads(raw)
+                self.harness.frames[frame.get('type')] += 1
+                self.on_frame(frame, time.perf_counter())
+        except self.harness.websockets.ConnectionClosed:
+            pass
+        finally:
+            self.on_closed()
+
+    def on_closed(self):
+        if not self.harness.closing:
+            self.harness.closed_unexpectedly[str(self.ws.close_code)] += 1
+
+    async def send_loop(self, until, rate):
+        rng = self.harness.random
+        # Stagger the first send so senders don't fire in lock-step
+        await asyncio.sleep(rng.uniform(0, 1 / rate))
+        while time.perf_counter() < until and self.ws:
+            kind = rng.choices(self.harness.kinds, self.harness.weights)[0]
+            try:
+                await self.send_one(kind)
+            except self.harness.websockets.ConnectionClosed:
+                return
+            await asyncio.sleep(min(rng.expovariate(rate), max(0, until - time.perf_counter())))
+
+    async def close(self):
+        if self.ws:
+            await self.ws.close()
+        if self.reader:
+            await asyncio.gather(self.reader, return_exceptions=True)
+
+
+class ChatClient(Client):
+    kind = 'chat'
+
+    def __init__(self, harness, path, room, username):
+        super().__init__(harness, path, room)
+        self.username = username
+
+    async def on_open(self):
+        # Every chat socket gets its history before it is subscribed to broadcasts
+        frame = json.loads(await asyncio.wait_for(self.ws.recv(), self.harness.options['connect_timeout']))
+        self.harness.frames[frame.get('type')] += 1
+        self.harness.room_members[self.room] += 1
+
+    def on_closed(self):
+        self.harness.room_members[self.room] -= 1
+        super().on_closed()
+
+    def on_frame(self, frame, now):
+        frame_type = frame.get('type')
+        if frame_type == 'new_message':
+            self.harness.record_receipt(frame['message'].get('text', ''), now)
+        elif frame_type == 'message_batch':
+            for message in frame['messages']:
+                self.harness.record_receipt(message.get('text', ''), now)
+        elif frame_type == 'rate_limited':
+            self.harness.chat['rate_limited'] += 1
+        elif frame_type == 'error':
+            self.harness.chat['error_frames'] += 1
+
+    async def send_one(self, kind):
+        harness = self.harness
+        harness.sequence += 1
+        tag = f'~lt:{harness.run_id}:{harness.sequence}'
+        text = harness.random.choice(MESSAGES[kind])
+        harness.sent[str(harness.sequence)] = {
+            'kind': kind,
+            'room': self.room,
+            'expected': harness.room_members[self.room],
+            'at': time.perf_counter(),
+            'receipts': 0,
+            'last': None,
+        }
+        harness.chat['sent'] += 1
+        harness.chat['sent_by_kind'][kind] += 1
+        await self.ws.send(json.dumps({
+            'type': 'chat_message',
+            'username': self.username,
+            'message': f'{text} {tag}',
+        }))
+
+
+class SpeechClient(Client):
+    kind = 'speech'
+
+    def __init__(self, harness, path, room, user_id, stream_id):
+        super().__init__(harness, path, room)
+        self.user_id = user_id
+        self.stream_id = stream_id
+        self.pending = deque()
+
+    def on_frame(self, frame, now):
+        frame_type = frame.get('type')
+        if frame_type in SPEECH_REPLY_TYPES and self.pending:
+            kind, sent_at = self.pending.popleft()
+            latency = (now - sent_at) * 1000
+            self.harness.speech['replies'] += 1
+            self.harness.speech['replies_by_type'][frame_type] += 1
+            self.harness.speech_latency[kind].append(latency)
+
+    async def send_one(self, kind):
+        self.pending.append((kind, time.perf_counter()))
+        self.harness.speech['sent'] += 1
+        self.harness.speech['sent_by_kind'][kind] += 1
+        await self.ws.send(json.dumps({
+            'type': 'speech_transcript',
+            'transcript': self.harness.random.choice(TRANSCRIPTS[kind]),
+            'user_id': self.user_id,
+            'stream_id': self.stream_id,
+        }))
+
+
+class Command(BaseCommand):
+    help = (
+        'Open many WebSocket clients against a SafeChat server, replay a mix of clean, toxic and '
+        'nuanced chat messages and speech transcripts, and print latency, fan-out and drop '
+        'statistics as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='ws://127.0.0.1:8000',
+                            help='Server to test (ignored with --spawn-workers)')
+        parser.add_argument('--spawn-workers', type=int, default=0, metavar='N',
+                            help='Start `runworkers --workers N` plus the API stubs for this run')
+        parser.add_argument('--port', type=int, default=None, help='Port for the spawned server (default: free port)')
+        parser.add_argument('--clients', type=int, default=200, help='Chat sockets to open')
+        parser.add_argument('--streams', type=int, default=2, help='Live streams to create for stream chat and speech')
+        parser.add_argument('--global-share', type=float, default=0.5,
+                            help='Fraction of chat sockets in global chat; the rest spread over the streams')
+        parser.add_argument('--senders', type=float, default=0.1, help='Fraction of chat sockets that send messages')
+        parser.add_argument('--speech-clients', type=int, default=10, help='Speech moderation sockets to open')
+        parser.add_argument('--rate', type=float, default=0.5, help='Messages/sec per sending socket')
+        parser.add_argument('--mix', default='clean=70,toxic=15,nuanced=15',
+                            help='Relative weights of clean, toxic and nuanced messages')
+        parser.add_argument('--ramp', type=float, default=10, help='Seconds over which sockets connect')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds of sending after the ramp')
+        parser.add_argument('--drain', type=float, default=5, help='Seconds to wait for in-flight messages')
+        parser.add_argument('--connect-timeout', type=float, default=10)
+        parser.add_argument('--stub-latency-ms', type=float, default=50, help='Latency of the stubbed external APIs')
+        parser.add_argument('--stub-jitter-ms', type=float, default=0)
+        parser.add_argument('--stub-error-rate', type=float, default=0.0)
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--output', default='-', help='Write the JSON report here (default: stdout)')
+
+    def handle(self, *args, **options):
+        try:
+            import websockets
+        except ImportError:
+            raise CommandError('The load test needs the websockets client: pip install "websockets>=13"')
+
+        self.websockets = websockets
+        self.options = options
+        self.random = random.Random(options['seed'])
+        mix = parse_mix(options['mix'])
+        self.kinds, self.weights = list(mix), list(mix.values())
+        # Digits only, so the tag can never contain a word the keyword detector reacts to
+        self.run_id = str(self.random.randint(100000, 999999))
+        self.processes = []
+
+        self._raise_fd_limit(options['clients'] + options['speech_clients'])
+        stream_ids = self._create_streams(options['streams'])
+
+        try:
+            if options['spawn_workers']:
+                self.base_url = self._spawn_server(options['spawn_workers'])
+            else:
+                self.base_url = options['url'].rstrip('/')
+                # Whatever that server was started with; our environment says nothing about it
+                self.channel_layer = 'unknown'
+            report = asyncio.run(self._run(stream_ids))
+        finally:
+            self._stop_processes()
+            Stream.objects.filter(id__in=stream_ids).update(status='ended')
+
+        output = json.dumps(report, indent=2)
+        if options['output'] == '-':
+            self.stdout.write(output)
+        else:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+            self.stderr.write(f"📄 Report written to {options['output']}")
+        self.stderr.write(self._headline(report))
+
+    # ---- setup ----
+
+    def _raise_fd_limit(self, sockets):
+        try:
+            import resource
+        except ImportError:
+            return
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = sockets + 256
+        if soft < wanted:
+            target = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            if target < wanted:
+                self.stderr.write(f"   [!] Open file limit is {target}; some of the {sockets} sockets may fail")
+
+    def _create_streams(self, count):
+        User = get_user_model()
+        streamer, _ = User.objects.get_or_create(username='loadtest_streamer')
+        return [
+            Stream.objects.create(streamer=streamer, title=f'Load test {self.run_id} #{i + 1}', status='live').id
+            for i in range(count)
+        ]
+
+    def _spawn_server(self, workers):
+        """Start API stubs and `runworkers` on free ports; returns the ws:// base URL"""
+        env = dict(os.environ)
+        stub_port = free_port()
+        stubs = subprocess.Popen(
+            [sys.executable, '-m', 'safechat.api_stubs', '--port', str(stub_port),
+             '--latency-ms', str(self.options['stub_latency_ms']),
+             '--jitter-ms', str(self.options['stub_jitter_ms']),
+             '--error-rate', str(self.options['stub_error_rate'])],
+            cwd=settings.BASE_DIR, stdout=subprocess.PIPE, text=True, start_new_session=True,
+        )
+        self.processes.append(stubs)
+        self.stderr.write(stubs.stdout.readline().strip())
+        self.stub_url = f'http://127.0.0.1:{stub_port}'
+        env.update(stub_settings_env(self.stub_url))
+        # Every simulated client connects from 127.0.0.1; one shared per-address bucket would throttle them all
+        env['WEBSOCKET_RATE_LIMIT_ANONYMOUS_KEY'] = 'connection'
+
+        port = self.options['port'] or free_port()
+        command = [sys.executable, 'manage.py', 'runworkers', '--workers', str(workers),
+                   '--bind', '127.0.0.1', '--port', str(port), '-v', '0']
+        self.channel_layer = env.get('CHANNEL_LAYER_BACKEND', 'memory')
+        if workers > 1 and self.channel_layer not in ('redis', 'redis_sharded'):
+            command += ['--redis-standin', str(free_port())]
+            self.channel_layer = 'redis (stand-in)'
+        server = subprocess.Popen(command, cwd=settings.BASE_DIR, env=env, start_new_session=True,
+                                  stdout=subprocess.DEVNULL)
+        self.processes.insert(0, server)
+        self._wait_for_workers(port, workers, server)
+        return f'ws://127.0.0.1:{port}'
+
+    def _wait_for_workers(self, port, workers, server, timeout=60):
+        import httpx
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f'runworkers exited with code {server.returncode}')
+            try:
+                health = httpx.get(f'http://127.0.0.1:{port}/api/health/', timeout=2).json()
+                if len(health['workers']) >= workers:
+                    self.stderr.write(f"🚀 {workers} worker(s) ready on port {port}")
+                    return
+            except (httpx.HTTPError, ValueError, KeyError):
+                pass
+            time.sleep(0.5)
+        raise CommandError(f'Workers did not report healthy within {timeout}s')
+
+    def _stop_processes(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+                try:
+                    process.wait(30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+    # ---- run ----
+
+    async def _run(self, stream_ids):
+        options = self.options
+        self.closing = False
+        self.sequence = 0
+        self.sent = {}
+        self.room_members = Counter()
+        self.frames = Counter()
+        self.closed_unexpectedly = Counter()
+        self.connect_ms = []
+        self.connections = {
+            kind: {'attempted': 0, 'open': 0, 'failed': 0, 'errors': Counter()}
+            for kind in ('chat', 'speech')
+        }
+        self.chat = {'sent': 0, 'sent_by_kind': Counter(), 'rate_limited': 0, 'error_frames': 0}
+        self.speech = {'sent': 0, 'sent_by_kind': Counter(), 'replies': 0, 'replies_by_type': Counter()}
+        self.latency = {kind: [] for kind in MESSAGES}
+        self.fanout = []
+        self.speech_latency = {kind: [] for kind in TRANSCRIPTS}
+
+        clients = self._build_clients(stream_ids)
+        started_at = datetime.now(timezone.utc)
+
+        self.stderr.write(f"🔌 Connecting {len(clients)} sockets over {options['ramp']}s")
+        ramp_started = time.perf_counter()
+        await asyncio.gather(*(
+            self._connect_at(client, ramp_started + options['ramp'] * i / max(1, len(clients)))
+            for i, client in enumerate(clients)
+        ))
+
+        chat_clients = [c for c in clients if c.kind == 'chat' and c.ws]
+        senders = self.random.sample(chat_clients, int(len(chat_clients) * options['senders']))
+        senders += [c for c in clients if c.kind == 'speech' and c.ws]
+        self.stderr.write(f"💬 {len(senders)} sockets sending for {options['duration']}s")
+        send_started = time.perf_counter()
+        until = send_started + options['duration']
+        await asyncio.gather(*(client.send_loop(until, options['rate']) for client in senders))
+        send_elapsed = time.perf_counter() - send_started
+
+        await asyncio.sleep(options['drain'])
+        self.closing = True
+        await asyncio.gather(*(client.close() for client in clients))
+
+        return self._report(started_at, send_elapsed, await self._stub_stats())
+
+    def _build_clients(self, stream_ids):
+        options = self.options
+        clients = []
+        global_count = int(options['clients'] * options['global_share']) if stream_ids else options['clients']
+        for i in range(options['clients']):
+            username = f'lt_{self.run_id}_{i}'
+            if i < global_count:
+                clients.append(ChatClient(self, '/ws/chat/', 'global_chat', username))
+            else:
+                stream_id = stream_ids[i % len(stream_ids)]
+                clients.append(ChatClient(self, f'/ws/chat/{stream_id}/', f'stream_chat_{stream_id}', username))
+        if stream_ids:
+            for i in range(options['speech_clients']):
+                stream_id = stream_ids[i % len(stream_ids)]
+                user_id = f'lt_{self.run_id}_s{i}'
+                clients.append(SpeechClient(
+                    self, f'/ws/speech/{stream_id}/{user_id}/', f'speech_moderation_{stream_id}', user_id, stream_id,
+                ))
+        # Interleave kinds and rooms so the ramp loads every consumer evenly
+        self.random.shuffle(clients)
+        return clients
+
+    async def _connect_at(self, client, at):
+        await asyncio.sleep(max(0, at - time.perf_counter()))
+        await client.connect()
+
+    def record_receipt(self, text, now):
+        match = TAG_RE.search(text)
+        if not match or match.group(1) != self.run_id:
+            return
+        entry = self.sent.get(match.group(2))
+        if not entry:
+            return
+        entry['receipts'] += 1
+        entry['last'] = now
+        self.latency[entry['kind']].append((now - entry['at']) * 1000)
+
+    async def _stub_stats(self):
+        if not getattr(self, 'stub_url', None):
+            return None
+        import httpx
+
+        try:
+            async with httpx.AsyncClient() as client:
+                return (await client.get(f'{self.stub_url}/stats', timeout=5)).json()
+        except (httpx.HTTPError, ValueError):
+            return None
+
+    # ---- report ----
+
+    def _report(self, started_at, send_elapsed, stubs):
+        delivered = [entry for entry in self.sent.values() if entry['receipts']]
+        expected = sum(entry['expected'] for entry in delivered)
+        receipts = sum(entry['receipts'] for entry in delivered)
+        self.fanout = [(entry['last'] - entry['at']) * 1000 for entry in delivered]
+        all_latency = [value for samples in self.latency.values() for value in samples]
+        all_speech = [value for samples in self.speech_latency.values() for value in samples]
+
+        config = {k: v for k, v in self.options.items()
+                  if k not in ('verbosity', 'settings', 'pythonpath', 'traceback', 'no_color', 'force_color',
+                               'skip_checks', 'stdout', 'stderr')}
+
+        return {
+            'run_id': self.run_id,
+            'started_at': started_at.isoformat(),
+            'server': self.base_url,
+            # The layer the workers actually ran with
+            'channel_layer': self.channel_layer,
+            'config': config,
+            'send_seconds': round(send_elapsed, 2),
+            'connections': {
+                **{kind: {**stats, 'errors': dict(stats['errors'])} for kind, stats in self.connections.items()},
+                'connect_ms': summarize(self.connect_ms),
+                'closed_unexpectedly': dict(self.closed_unexpectedly),
+            },
+            'chat': {
+                'sent': self.chat['sent'],
+                'sent_by_kind': dict(self.chat['sent_by_kind']),
+                'sent_per_sec': round(self.chat['sent'] / send_elapsed, 2) if send_elapsed else 0,
+                'rate_limited': self.chat['rate_limited'],
+                'error_frames': self.chat['error_frames'],
+                'delivered_messages': len(delivered),
+                # Accepted but never broadcast (rate limited, restricted, or lost server-side)
+                'undelivered_messages': len(self.sent) - len(delivered),
+                'expected_receipts': expected,
+                'receipts': receipts,
+                'receipts_per_sec': round(receipts / send_elapsed, 2) if send_elapsed else 0,
+                'drop_rate': round(1 - receipts / expected, 4) if expected else 0.0,
+                'latency_ms': {
+                    'all': summarize(all_latency),
+                    **{kind: summarize(samples) for kind, samples in self.latency.items()},
+                },
+                'fanout_ms': summarize(self.fanout),
+            },
+            'speech': {
+                'sent': self.speech['sent'],
+                'sent_by_kind': dict(self.speech['sent_by_kind']),
+                'replies': self.speech['replies'],
+                'replies_by_type': dict(self.speech['replies_by_type']),
+                'unanswered': self.speech['sent'] - self.speech['replies'],
+                'latency_ms': {
+                    'all': summarize(all_speech),
+                    **{kind: summarize(samples) for kind, samples in self.speech_latency.items()},
+                },
+            },
+            'frames': dict(self.frames),
+            'stubs': stubs,
+        }
+
+    def _headline(self, report):
+        chat, speech = report['chat'], report['speech']
+        latency = chat['latency_ms']['all']
+        return (
+            f"✅ chat: {chat['sent']} sent, {chat['receipts_per_sec']} receipts/s, "
+            f"p50 {latency.get('p50', '-')}ms p99 {latency.get('p99', '-')}ms, drop rate {chat['drop_rate']}; "
+            f"speech: {speech['replies']}/{speech['sent']} answered, "
+            f"p99 {speech['latency_ms']['all'].get('p99', '-')}ms"
+        )
@@ -0,0 +1,254 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from safechat.health import read_statuses, write_json_atomic
+
+
+class Worker:
+    """One daphne process serving the shared listening socket"""
+
+    def __init__(self, slot, process):
+        self.slot = slot
+        self.process = process
+        self.started_at = time.time()
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def alive(self):
+        return self.process.poll() is None
+
+
+class Command(BaseCommand):
+    help = (
+        'Run N daphne ASGI workers behind one port (POSIX only). '
+        'SIGHUP performs a rolling reload, SIGTERM/SIGINT a graceful shutdown.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of worker processes (default: CPU core count)')
+        parser.add_argument('--bind', default='0.0.0.0', help='Address to listen on')
+        parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+        parser.add_argument('--health-dir', default=None,
+                            help='Directory for worker heartbeat files (default: a temp dir)')
+        parser.add_argument('--heartbeat-timeout', type=float, default=15,
+                            help='Restart a worker whose heartbeat is older than this many seconds')
+        parser.add_argument('--max-loop-lag', type=float, default=10,
+                            help='Restart a worker whose event loop has been blocked for this many seconds')
+        parser.add_argument('--grace', type=float, default=10,
+                            help='Seconds a worker gets to exit after SIGTERM before it is killed')
+        parser.add_argument('--proxy-headers', action='store_true',
+                            help='Take the client address from X-Forwarded-For (behind a reverse proxy); '
+                                 'anonymous sockets are rate limited per address')
+        parser.add_argument('--redis-standin', type=int, default=None, metavar='PORT',
+                            help='Start the in-memory Redis stand-in on PORT and point all workers at it '
+                                 '(local testing only)')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.verbosity = options['verbosity']
+        worker_count = options['workers'] or os.cpu_count() or 1
+        self.env = dict(os.environ)
+        self.standin = None
+
+        if options['redis_standin'] is not None:
+            self.standin = self._start_standin(options['redis_standin'])
+
+        backend = self.env.get('CHANNEL_LAYER_BACKEND', 'memory')
+        if worker_count > 1 and backend not in ('redis', 'redis_sharded'):
+            self._stop_standin()
+            raise CommandError(
+                'Multiple workers need a shared channel layer, otherwise group broadcasts never reach '
+                'sockets on other workers. Set CHANNEL_LAYER_BACKEND=redis (or redis_sharded), '
+                'or pass --redis-standin PORT for local testing.'
+            )
+
+        self.health_dir = options['health_dir'] or tempfile.mkdtemp(prefix='safechat-health-')
+        os.makedirs(self.health_dir, exist_ok=True)
+        self.env['SAFECHAT_HEALTH_DIR'] = self.health_dir
+
+        self.sock = socket.create_server((options['bind'], options['port']), backlog=2048)
+        self.sock.set_inheritable(True)
+
+        self.stopping = False
+        self.reload_requested = False
+        self.restarts = 0
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGHUP, self._request_reload)
+
+        self.stdout.write(
+            f"🚀 Starting {worker_count} worker(s) on {options['bind']}:{options['port']} "
+            f"(channel layer: {backend}, health: {self.health_dir})"
+        )
+        self.workers = [self._spawn(slot) for slot in range(worker_count)]
+
+        try:
+            self._supervise()
+        finally:
+            self._shutdown()
+
+    # ---- process management ----
+
+    def _start_standin(self, port):
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'devtools.redis_standin', '--port', str(port)],
+            stdout=subprocess.PIPE, text=True, start_new_session=True,
+        )
+        self.stdout.write(process.stdout.readline().strip())
+        self.env['CHANNEL_LAYER_BACKEND'] = 'redis'
+        self.env['REDIS_URL'] = f'redis://127.0.0.1:{port}/0'
+        return process
+
+    def _stop_standin(self):
+        if self.standin and self.standin.poll() is None:
+            self.standin.terminate()
+            self.standin.wait(5)
+
+    def _spawn(self, slot):
+        env = dict(self.env, SAFECHAT_WORKER_ID=str(slot))
+        command = [
+            sys.executable, '-m', 'daphne',
+            '--fd', str(self.sock.fileno()),
+            '-v', str(self.verbosity),
+            'safechat.asgi:application',
+        ]
+        if self.options['proxy_headers']:
+            command.insert(-1, '--proxy-headers')
+        # Own session so a terminal Ctrl+C reaches only the supervisor, which then stops workers cleanly
+        process = subprocess.Popen(command, env=env, pass_fds=(self.sock.fileno(),), start_new_session=True)
+        if self.verbosity:
+            self.stdout.write(f"   [+] Worker {slot} started (pid {process.pid})")
+        return Worker(slot, process)
+
+    def _stop(self, worker):
+        if worker.alive():
+            worker.process.terminate()
+            try:
+                worker.process.wait(self.options['grace'])
+            except subprocess.TimeoutExpired:
+                self.stderr.write(f"   [!] Worker {worker.slot} (pid {worker.pid}) ignored SIGTERM, killing")
+                worker.process.kill()
+                worker.process.wait()
+        self._forget_heartbeat(worker)
+
+    def _forget_heartbeat(self, worker):
+        try:
+            os.remove(os.path.join(self.health_dir, f'worker-{worker.pid}.json'))
+        except OSError:
+            pass
+
+    def _heartbeat(self, worker):
+        for status in read_statuses(self.health_dir)['workers']:
+            if status.get('pid') == worker.pid:
+                return status
+        return None
+
+    def _wait_ready(self, worker, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not worker.alive():
+                return False
+            if self._heartbeat(worker):
+                return True
+            time.sleep(0.2)
+        return False
+
+    # ---- signals ----
+
+    def _request_stop(self, signum, frame):
+        self.stopping = True
+
+    def _request_reload(self, signum, frame):
+        self.reload_requested = True
+
+    # ---- main loop ----
+
+    def _supervise(self):
+        last_report = 0
+        while not self.stopping:
+            time.sleep(0.5)
+            if self.reload_requested:
+                self.reload_requested = False
+                self._rolling_reload()
+
+            for index, worker in enumerate(self.workers):
+                if self.stopping:
+                    break
+                reason = self._unhealthy_reason(worker)
+                if reason:
+                    self.stderr.write(f"   [!] Worker {worker.slot} (pid {worker.pid}) {reason}, restarting")
+                    self._stop(worker)
+                    # Back off if the worker keeps dying straight after start
+                    if time.time() - worker.started_at < 5:
+                        time.sleep(min(5, 1 + self.restarts % 5))
+                    self.workers[index] = self._spawn(worker.slot)
+                    self.restarts += 1
+
+            if time.time() - last_report >= 2:
+                self._report()
+                last_report = time.time()
+
+    def _unhealthy_reason(self, worker):
+        if not worker.alive():
+            return f'exited with code {worker.process.returncode}'
+        age = time.time() - worker.started_at
+        status = self._heartbeat(worker)
+        if status is None:
+            if age > self.options['heartbeat_timeout'] * 2:
+                return 'never reported a heartbeat'
+            return None
+        if time.time() - status['heartbeat_at'] > self.options['heartbeat_timeout']:
+            return 'heartbeat went stale'
+        # The heartbeat thread keeps writing while the event loop is stuck; the lag gives it away
+        lag_ms = status.get('loop_lag_ms')
+        if lag_ms is not None and lag_ms > self.options['max_loop_lag'] * 1000:
+            return f'event loop blocked for {lag_ms / 1000:.1f}s'
+        return None
+
+    def _rolling_reload(self):
+        """Replace workers one at a time so the port never stops accepting connections"""
+        self.stdout.write('🔄 Rolling reload requested')
+        for index, old in enumerate(list(self.workers)):
+            new = self._spawn(old.slot)
+            if not self._wait_ready(new, self.options['heartbeat_timeout'] * 2):
+                self.stderr.write(f"   [!] Replacement for worker {old.slot} failed to start, keeping pid {old.pid}")
+                self._stop(new)
+                continue
+            self.workers[index] = new
+            self._stop(old)
+        self.stdout.write('✅ Rolling reload complete')
+
+    def _report(self):
+        summary = {
+            'pid': os.getpid(),
+            'updated_at': time.time(),
+            'restarts': self.restarts,
+            'workers': [
+                {'slot': w.slot, 'pid': w.pid, 'alive': w.alive(), 'started_at': w.started_at}
+                for w in self.workers
+            ],
+        }
+        try:
+            write_json_atomic(os.path.join(self.health_dir, 'supervisor.json'), summary)
+        except OSError as e:
+            self.stderr.write(f"   [!] Could not write supervisor status: {e}")
+
+    def _shutdown(self):
+        self.stdout.write('🛑 Stopping workers')
+        for worker in self.workers:
+            if worker.alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            self._stop(worker)
+        self.sock.close()
+        self._stop_standin()
@@ -0,0 +1,171 @@
+import json
+import time
+import asyncio
+from collections import deque, defaultdict
+from django.conf import settings
+
+
+DEFAULT_OUTBOUND_QUEUE = {
+    'MAX_SIZE': 100,
+    # 'drop_oldest', 'coalesce' or 'disconnect'
+    'POLICY': 'coalesce',
+    # How long a queue may stay saturated before a 'disconnect' policy closes the socket
+    'MAX_LAG_SECONDS': 10,
+}
+
+# Per-room counters for this worker process
+_room_metrics = defaultdict(lambda: {
+    'connections': 0,
+    'queue_depth': 0,
+    'max_queue_depth': 0,
+    'dropped': 0,
+    'coalesced': 0,
+    'disconnected': 0,
+})
+
+
+def room_metrics():
+    """Snapshot of outbound queue metrics per room for this worker"""
+    return {room: dict(stats) for room, stats in list(_room_metrics.items())}
+
+
+class OutboundQueue:
+    """
+    Bounded per-socket send queue.
+
+    Group handlers put frames here instead of awaiting `consumer.send`, so a
+    slow viewer only ever backs up its own queue. A single writer task drains
+    the queue to the socket. When the queue is full the configured policy
+    decides what happens:
+
+    - drop_oldest: the oldest queued frame is discarded
+    - coalesce: queued chat messages are merged into one `message_batch` frame
+    - disconnect: like drop_oldest, but the socket is closed once the queue has
+      stayed saturated for MAX_LAG_SECONDS
+
+    A socket whose send fails is closed too, rather than left open and
+    silent. Consumers create the queue with `start=False` before joining
+    their group, so broadcasts that arrive during the handshake are queued,
+    and call `start()` once the socket is accepted and its history sent.
+    """
+
+    def __init__(self, consumer, room, start=True):
+        config = {**DEFAULT_OUTBOUND_QUEUE, **getattr(settings, 'CHAT_OUTBOUND_QUEUE', {})}
+        self.consumer = consumer
+        self.room = room
+        self.max_size = max(1, int(config['MAX_SIZE']))
+        self.policy = config['POLICY']
+        self.max_lag = float(config['MAX_LAG_SECONDS'])
+        self.max_batch = self.max_size * 5
+        self.frames = deque()
+        self.saturated_since = None
+        self.closed = False
+        self._wakeup = asyncio.Event()
+        self._metrics = _room_metrics[room]
+        self._metrics['connections'] += 1
+        self._task = None
+        self._close_task = None
+        if start:
+            self.start()
+
+    def start(self):
+        """Begin writing queued frames to the socket"""
+        if self._task is None and not self.closed:
+            self._task = asyncio.create_task(self._drain())
+
+    def put(self, frame):
+        """Queue a frame without waiting for the socket"""
+        if self.closed:
+            return
+        if len(self.frames) >= self.max_size:
+            self._overflow()
+            if self.closed:
+                return
+        self.frames.append(frame)
+        self._track_depth(1)
+        self._wakeup.set()
+
+    def _overflow(self):
+        if self.saturated_since is None:
+            self.saturated_since = time.monotonic()
+
+        if self.policy == 'coalesce':
+            self._coalesce()
+        if len(self.frames) >= self.max_size:
+            self.frames.popleft()
+            self._track_depth(-1)
+            self._metrics['dropped'] += 1
+
+        if self.policy == 'disconnect' and time.monotonic() - self.saturated_since >= self.max_lag:
+            print(f"   [OUTBOUND] Disconnecting slow consumer in {self.room} after {self.max_lag}s of lag")
+            self._metrics['disconnected'] += 1
+            self._close_socket(4008)
+
+    def _coalesce(self):
+        messages = []
+        kept = deque()
+        newly_merged = 0
+        for frame in self.frames:
+            if frame.get('type') == 'new_message':
+                messages.append(frame['message'])
+                newly_merged += 1
+            elif frame.get('type') == 'message_batch':
+                messages.extend(frame['messages'])
+            else:
+                kept.append(frame)
+        if not messages:
+            return
+
+        merged = len(self.frames) - len(kept)
+        if len(messages) > self.max_batch:
+            self._metrics['dropped'] += len(messages) - self.max_batch
+            messages = messages[-self.max_batch:]
+        kept.append({'type': 'message_batch', 'messages': messages})
+        self._metrics['coalesced'] += newly_merged
+        self.frames = kept
+        self._track_depth(1 - merged)
+
+    def _track_depth(self, change):
+        self._metrics['queue_depth'] += change
+        if len(self.frames) > self._metrics['max_queue_depth']:
+            self._metrics['max_queue_depth'] = len(self.frames)
+
+    async def _drain(self):
+        try:
+            while not self.closed:
+                if not self.frames:
+                    self.saturated_since = None
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                frame = self.frames.popleft()
+                self._track_depth(-1)
+                await self.consumer.send(text_data=json.dumps(frame))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"   [OUTBOUND] Send failed in {self.room}: {e}; closing the socket")
+            self._close_socket(1011)
+
+    def _close_socket(self, code):
+        self.close()
+        # Kept so the task isn't garbage collected before it runs
+        self._close_task = asyncio.create_task(self._close_consumer(code))
+
+    async def _close_consumer(self, code):
+        try:
+            await self.consumer.close(code=code)
+        except Exception as e:
+            print(f"   [OUTBOUND] Could not close socket in {self.room}: {e}")
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._metrics['connections'] -= 1
+        self._metrics['queue_depth'] -= len(self.frames)
+        self.frames.clear()
+        self._wakeup.set()
+        # Forget rooms nobody is connected to any more (e.g. ended streams)
+        if self._metrics['connections'] <= 0:
+            _room_metrics.pop(self.room, None)
@@ -0,0 +1,146 @@
+"""
+Stream viewer presence, counted in memory and flushed in batches.
+
+Joins and leaves used to do a read-modify-write `save()` on the Stream row
+for every connect and disconnect. A popular stream had thousands of writes on
+one row per minute, and concurrent ones overwrote each other. Each worker now
+adds up the net change per stream. Every VIEWER_COUNT_FLUSH_SECONDS it writes
+one `F()` update per changed stream and broadcasts the new count once. Updates
+from several workers add up, because each only sends its own delta. With
+RECORD_STREAM_VIEWERS, joins and leaves of known users are also written to
+`StreamViewer` in batches.
+"""
+import asyncio
+from collections import Counter
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .events import VIEWER_COUNT, broadcast_stream_event
+from .models import Stream, StreamViewer
+
+
+JOINED = 'joined'
+LEFT = 'left'
+
+
+def _row_id(value):
+    """Integer primary key, or None for ids of streams/users that have no row"""
+    value = str(value)
+    return int(value) if value.isdigit() else None
+
+
+class ViewerPresence:
+    def __init__(self):
+        # stream id -> net viewers joined since the last flush
+        self.deltas = Counter()
+        # (stream id, user id) -> open sockets, so a user with two tabs leaves once
+        self.sockets = Counter()
+        # (stream id, user id) -> JOINED | LEFT; only the latest change matters
+        self.visits = {}
+        self.loop = None
+        self.task = None
+
+    def start(self):
+        """Start the flush task on the running event loop; calling it again is a no-op"""
+        if self.task and not self.task.done():
+            return
+        self.loop = asyncio.get_running_loop()
+        self.flush_seconds = getattr(settings, 'VIEWER_COUNT_FLUSH_SECONDS', 2)
+        self.record_viewers = getattr(settings, 'RECORD_STREAM_VIEWERS', True)
+        self.task = self.loop.create_task(self._run())
+
+    def join(self, stream_id, user_id=None):
+        stream_id = _row_id(stream_id)
+        if stream_id is None:
+            return
+        self.deltas[stream_id] += 1
+        user_id = _row_id(user_id) if user_id is not None else None
+        if user_id is not None:
+            self.sockets[(stream_id, user_id)] += 1
+            if self.sockets[(stream_id, user_id)] == 1:
+                self.visits[(stream_id, user_id)] = JOINED
+
+    def leave(self, stream_id, user_id=None):
+        stream_id = _row_id(stream_id)
+        if stream_id is None:
+            return
+        self.deltas[stream_id] -= 1
+        user_id = _row_id(user_id) if user_id is not None else None
+        if user_id is not None and self.sockets[(stream_id, user_id)] > 0:
+            self.sockets[(stream_id, user_id)] -= 1
+            if self.sockets[(stream_id, user_id)] == 0:
+                del self.sockets[(stream_id, user_id)]
+                self.visits[(stream_id, user_id)] = LEFT
+
+    # ---- task ----
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+
+    async def flush(self):
+        """Write pending count changes and viewer records, then broadcast the new counts"""
+        deltas = {stream_id: delta for stream_id, delta in self.deltas.items() if delta}
+        visits = self.visits if self.record_viewers else {}
+        self.deltas = Counter()
+        self.visits = {}
+        if not deltas and not visits:
+            return
+
+        try:
+            counts = await self._write(deltas, visits)
+        except Exception as e:
+            # Keep the changes for the next flush; later joins/leaves win over these visits
+            print(f"   [PRESENCE] Flush failed: {e}")
+            self.deltas.update(deltas)
+            self.visits = {**visits, **self.visits}
+            return
+
+        for stream_id, count in counts.items():
+            await broadcast_stream_event(VIEWER_COUNT, stream_id, {'id': stream_id, 'viewer_count': count})
+
+    @database_sync_to_async
+    def _write(self, deltas, visits):
+        with transaction.atomic():
+            for stream_id, delta in deltas.items():
+                Stream.objects.filter(pk=stream_id).update(viewer_count=Greatest(F('viewer_count') + delta, 0))
+            if visits:
+                self._record_visits(visits)
+        return dict(Stream.objects.filter(pk__in=deltas).values_list('pk', 'viewer_count'))
+
+    def _record_visits(self, visits):
+        stream_ids = {stream_id for stream_id, _ in visits}
+        user_ids = {user_id for _, user_id in visits}
+        # Visits to streams or by users without a row can't be stored
+        stream_ids &= set(Stream.objects.filter(pk__in=stream_ids).values_list('pk', flat=True))
+        user_ids &= set(get_user_model().objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+
+        joins = []
+        leaves = {}
+        for (stream_id, user_id), change in visits.items():
+            if stream_id not in stream_ids or user_id not in user_ids:
+                continue
+            if change == JOINED:
+                joins.append(StreamViewer(stream_id=stream_id, user_id=user_id, left_at=None))
+            else:
+                leaves.setdefault(stream_id, []).append(user_id)
+
+        if joins:
+            # A rejoin reopens the existing (stream, user) row
+            StreamViewer.objects.bulk_create(
+                joins, update_conflicts=True, unique_fields=['stream', 'user'], update_fields=['joined_at', 'left_at'],
+            )
+        # Times are accurate to one flush interval
+        now = timezone.now()
+        for stream_id, users in leaves.items():
+            StreamViewer.objects.filter(stream_id=stream_id, user_id__in=users).update(left_at=now)
+
+
+viewer_presence = ViewerPresence()
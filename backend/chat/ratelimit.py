@@ -0,0 +1,201 @@
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+
+DEFAULT_RATE_LIMITS = {
+    'chat': {
+        'connection': {'rate': 2, 'burst': 5},
+        'user': {'rate': 3, 'burst': 8},
+        'room': {'rate': 100, 'burst': 200},
+    },
+    'speech': {
+        'connection': {'rate': 4, 'burst': 8},
+        'user': {'rate': 4, 'burst': 8},
+        'room': {'rate': 10, 'burst': 20},
+    },
+}
+
+# Idle buckets are pruned once a table grows past this many keys
+MAX_BUCKETS = 10000
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `burst`"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount=1.0, now=None):
+        self.refill(now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def retry_after(self, amount=1.0):
+        """Seconds until `amount` tokens will be available"""
+        if self.rate <= 0:
+            return None
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def is_idle(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RateLimiter:
+    """
+    Per-connection, per-user and per-room token buckets for one consumer kind
+    ('chat' or 'speech').
+
+    Buckets live in process memory so the common case costs a few float ops.
+    When WEBSOCKET_RATE_LIMIT_CACHE names a shared cache (e.g. Redis), the user
+    and room limits are enforced there instead so they hold across workers.
+    The shared mode approximates the bucket with an atomic fixed-window counter
+    of `burst` hits per `burst / rate` seconds. User buckets are keyed by
+    `rate_limit_key`.
+    """
+
+    def __init__(self, kind):
+        limits = getattr(settings, 'WEBSOCKET_RATE_LIMITS', DEFAULT_RATE_LIMITS)
+        self.kind = kind
+        self.limits = limits.get(kind, DEFAULT_RATE_LIMITS[kind])
+        self.cache_alias = getattr(settings, 'WEBSOCKET_RATE_LIMIT_CACHE', None)
+        self._buckets = {'user': {}, 'room': {}}
+
+    def connection_bucket(self):
+        """Create the bucket a consumer keeps for the lifetime of its socket"""
+        return self._new_bucket('connection')
+
+    def _new_bucket(self, scope):
+        limit = self.limits.get(scope)
+        if not limit:
+            return None
+        return TokenBucket(limit['rate'], limit['burst'])
+
+    def _local_bucket(self, scope, key):
+        table = self._buckets[scope]
+        bucket = table.get(key)
+        if bucket is None:
+            if len(table) >= MAX_BUCKETS:
+                self._prune(table)
+            bucket = self._new_bucket(scope)
+            table[key] = bucket
+        return bucket
+
+    def _prune(self, table):
+        now = time.monotonic()
+        for key in [k for k, b in table.items() if b.is_idle(now)]:
+            del table[key]
+
+    def _shared_key(self, scope, key):
+        limit = self.limits[scope]
+        window = max(1, int(round(limit['burst'] / float(limit['rate']))))
+        slot = int(time.time()) // window
+        return f'ratelimit:{self.kind}:{scope}:{key}:{slot}', window
+
+    async def _shared_hit(self, scope, key):
+        cache_key, window = self._shared_key(scope, key)
+        cache = caches[self.cache_alias]
+        # add() is a no-op if the window already exists. The sync incr() is atomic on Redis;
+        # BaseCache.aincr is a separate get and set, so concurrent hits would be lost.
+        await cache.aadd(cache_key, 0, timeout=window + 1)
+        hits = await sync_to_async(cache.incr, thread_sensitive=False)(cache_key)
+        if hits <= self.limits[scope]['burst']:
+            return True, None
+        return False, float(window - int(time.time()) % window)
+
+    async def _shared_refund(self, scope, key):
+        cache_key, _ = self._shared_key(scope, key)
+        try:
+            await sync_to_async(caches[self.cache_alias].decr, thread_sensitive=False)(cache_key)
+        except ValueError:
+            # The window rolled over in between; nothing to give back
+            pass
+
+    async def allow(self, user_key=None, room_key=None):
+        """
+        Consume one token from the user and room buckets.
+        Returns (allowed, retry_after_seconds).
+
+        The user bucket is checked first and the room bucket is only drawn
+        down for messages the user's own limit lets through, so one flooder
+        cannot use up the room's budget for everyone. A message the room
+        turns away doesn't cost the user a token either.
+        """
+        scopes = [(scope, key) for scope, key in (('user', user_key), ('room', room_key))
+                  if key is not None and self.limits.get(scope)]
+        if self.cache_alias:
+            counted = []
+            for scope, key in scopes:
+                allowed, retry_after = await self._shared_hit(scope, key)
+                if not allowed:
+                    for earlier in counted:
+                        await self._shared_refund(*earlier)
+                    return False, retry_after
+                counted.append((scope, key))
+            return True, None
+
+        now = time.monotonic()
+        buckets = [self._local_bucket(scope, str(key)) for scope, key in scopes]
+        for bucket in buckets:
+            bucket.refill(now)
+            if bucket.tokens < 1:
+                return False, bucket.retry_after()
+        for bucket in buckets:
+            bucket.tokens -= 1
+        return True, None
+
+
+def rate_limit_key(consumer):
+    """
+    Per-user bucket key for a socket. Ids sent by the client (message
+    `user_id`, URL segments) are not trusted, as anyone could use another
+    user's id to exhaust their bucket or rotate ids to escape their own.
+
+    Authenticated sockets are keyed on the user. The frontend signs in with
+    Firebase, not a Django session, so in practice sockets are anonymous and
+    are keyed on the client address (WEBSOCKET_RATE_LIMIT_ANONYMOUS_KEY =
+    'address'): opening more sockets doesn't buy more messages. Everyone
+    behind one NAT shares that bucket. Behind a reverse proxy, start the
+    workers with --proxy-headers or every client has the proxy's address.
+    With 'connection', or when the server reports no address, the key is the
+    socket itself and the user tier is no stricter than the connection tier.
+    """
+    user = consumer.scope.get('user')
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    client = consumer.scope.get('client')
+    if client and getattr(settings, 'WEBSOCKET_RATE_LIMIT_ANONYMOUS_KEY', 'address') == 'address':
+        return f'addr:{client[0]}'
+    return f'conn:{consumer.channel_name}'
+
+
+_limiters = {}
+
+
+def get_rate_limiter(kind):
+    """One limiter per consumer kind per process, so buckets are shared between sockets"""
+    limiter = _limiters.get(kind)
+    if limiter is None:
+        limiter = _limiters[kind] = RateLimiter(kind)
+    return limiter
+
+
+def rate_limited_payload(retry_after):
+    return {
+        'type': 'rate_limited',
+        'message': 'You are sending messages too fast',
+        'retry_after': round(retry_after, 2) if retry_after is not None else None,
+    }
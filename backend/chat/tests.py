@@ -1,3 +1,556 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from devtools.redis_standin import RedisStandIn
+from safechat.health import WorkerHeartbeat, write_json_atomic
+from .management.commands.runworkers import Command as RunWorkersCommand, Worker
+from .consumers import ChatConsumer
+from .models import Stream, StreamViewer
+from .directory import StreamDirectory
+from .outbound import OutboundQueue
+from .presence import ViewerPresence
+from .ratelimit import RateLimiter, TokenBucket, rate_limit_key
+from .routing import websocket_urlpatterns
+
+
+# Joins the groups given on the command line, then prints every message it receives
+LISTENER_SCRIPT = """
+import asyncio, json, sys, django
+django.setup()
+from channels.layers import get_channel_layer
+
+async def main():
+    layer = get_channel_layer()
+    channel = await layer.new_channel()
+    groups = sys.argv[1:]
+    for group in groups:
+        await layer.group_add(group, channel)
+    print('ready', flush=True)
+    for _ in groups:
+        message = await asyncio.wait_for(layer.receive(channel), 15)
+        print(json.dumps(message), flush=True)
+
+asyncio.run(main())
+"""
+
+SENDER_SCRIPT = """
+import asyncio, os, sys, django
+django.setup()
+from channels.layers import get_channel_layer
+
+async def main():
+    layer = get_channel_layer()
+    for group in sys.argv[1:]:
+        await layer.group_send(group, {'type': 'chat_message', 'message': {'text': group, 'pid': os.getpid()}})
+
+asyncio.run(main())
+"""
+
+
+class StandInServer:
+    """Runs a RedisStandIn on its own event loop thread for the duration of a test"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.standin = RedisStandIn()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        self.port = asyncio.run_coroutine_threadsafe(self.standin.start(), self.loop).result(5)
+        self.url = f'redis://127.0.0.1:{self.port}/0'
+        return self
+
+    def __exit__(self, *exc):
+        asyncio.run_coroutine_threadsafe(self.standin.stop(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+
+
+def worker_env(**overrides):
+    env = dict(os.environ)
+    env['DJANGO_SETTINGS_MODULE'] = 'safechat.settings'
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(settings.BASE_DIR), env.get('PYTHONPATH')]))
+    env.update(overrides)
+    return env
+
+
+class MultiProcessChannelLayerTests(SimpleTestCase):
+    """Group broadcasts must cross worker processes when a Redis layer is configured"""
+
+    groups = ['global_chat', 'stream_chat_1', 'stream_chat_2', 'streams', 'speech_moderation_1']
+
+    def run_fanout(self, env):
+        listeners = [
+            subprocess.Popen(
+                [sys.executable, '-c', LISTENER_SCRIPT, *self.groups],
+                cwd=settings.BASE_DIR, env=env, stdout=subprocess.PIPE, text=True,
+            )
+            for _ in range(2)
+        ]
+        try:
+            for listener in listeners:
+                self.assertEqual(listener.stdout.readline().strip(), 'ready')
+
+            sender = subprocess.run(
+                [sys.executable, '-c', SENDER_SCRIPT, *self.groups],
+                cwd=settings.BASE_DIR, env=env, timeout=30,
+            )
+            self.assertEqual(sender.returncode, 0)
+
+            for listener in listeners:
+                out, _ = listener.communicate(timeout=30)
+                received = [json.loads(line) for line in out.splitlines()]
+                self.assertEqual(sorted(m['message']['text'] for m in received), sorted(self.groups))
+                self.assertTrue(all(m['message']['pid'] != listener.pid for m in received))
+        finally:
+            for listener in listeners:
+                if listener.poll() is None:
+                    listener.kill()
+
+    def test_group_send_reaches_other_processes(self):
+        with StandInServer() as server:
+            self.run_fanout(worker_env(CHANNEL_LAYER_BACKEND='redis', REDIS_URL=server.url))
+
+    def test_sharded_group_send_reaches_other_processes(self):
+        with StandInServer() as first, StandInServer() as second:
+            self.run_fanout(worker_env(
+                CHANNEL_LAYER_BACKEND='redis_sharded',
+                REDIS_SHARD_URLS=f'{first.url},{second.url}',
+            ))
+            # Groups are consistently hashed, so both shards must hold some of them
+            for shard in (first, second):
+                self.assertTrue(any(b':group:' in key for key in shard.standin.data))
+
+    def test_sharded_layer_without_shards_is_a_configuration_error(self):
+        check = subprocess.run(
+            [sys.executable, '-c', 'import django; django.setup()'],
+            cwd=settings.BASE_DIR, env=worker_env(CHANNEL_LAYER_BACKEND='redis_sharded', REDIS_SHARD_URLS=''),
+            capture_output=True, text=True, timeout=30,
+        )
+        self.assertNotEqual(check.returncode, 0)
+        self.assertIn('ImproperlyConfigured: CHANNEL_LAYER_BACKEND=redis_sharded needs REDIS_SHARD_URLS', check.stderr)
+
+    def test_redis_layer_enforces_rate_limits_in_the_shared_cache(self):
+        check = subprocess.run(
+            [sys.executable, '-c', 'import django; django.setup(); from django.conf import settings; '
+                                   'print(settings.WEBSOCKET_RATE_LIMIT_CACHE)'],
+            cwd=settings.BASE_DIR, env=worker_env(CHANNEL_LAYER_BACKEND='redis', REDIS_URL='redis://127.0.0.1:1/0'),
+            capture_output=True, text=True, timeout=30,
+        )
+        self.assertEqual(check.stdout.strip(), 'default')
+
+
+class ChatConsumerRedisLayerTests(TransactionTestCase):
+    """A ChatConsumer in this process sees messages broadcast by another worker"""
+
+    def test_consumer_receives_broadcast_from_other_process(self):
+        with StandInServer() as server:
+            layers = {
+                'default': {
+                    'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                    'CONFIG': {'hosts': [server.url], 'prefix': 'safechat'},
+                },
+            }
+            with override_settings(CHANNEL_LAYERS=layers):
+                asyncio.run(self._receive_remote_broadcast(server.url))
+
+    async def _receive_remote_broadcast(self, url):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/ws/chat/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        history = await communicator.receive_json_from()
+        self.assertEqual(history['type'], 'message_history')
+
+        env = worker_env(CHANNEL_LAYER_BACKEND='redis', REDIS_URL=url)
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', SENDER_SCRIPT, 'global_chat', cwd=settings.BASE_DIR, env=env,
+        )
+        self.assertEqual(await process.wait(), 0)
+
+        frame = await communicator.receive_json_from(timeout=10)
+        self.assertEqual(frame['type'], 'new_message')
+        self.assertEqual(frame['message']['text'], 'global_chat')
+        await communicator.disconnect()
+
+
+class StreamEventTests(TransactionTestCase):
+    @override_settings(VIEWER_COUNT_FLUSH_SECONDS=0.1)
+    def test_viewer_and_end_events_reach_directory_and_viewers(self):
+        user = get_user_model().objects.create(username='streamer')
+        stream = Stream.objects.create(streamer=user, title='Live')
+        asyncio.run(self._watch_stream(user, stream.id))
+
+    async def _watch_stream(self, user, stream_id):
+        from channels.db import database_sync_to_async
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from .views import EndStreamView
+
+        app = URLRouter(websocket_urlpatterns)
+        directory = WebsocketCommunicator(app, '/ws/streams/')
+        await directory.connect()
+        self.assertEqual((await directory.receive_json_from(timeout=5))['type'], 'stream_list')
+
+        viewer = WebsocketCommunicator(app, f'/ws/chat/{stream_id}/')
+        await viewer.connect()
+        self.assertEqual((await viewer.receive_json_from(timeout=5))['type'], 'message_history')
+        event = await directory.receive_json_from(timeout=5)
+        self.assertEqual((event['event'], event['stream']), ('viewer_count', {'id': stream_id, 'viewer_count': 1}))
+        self.assertEqual((await viewer.receive_json_from(timeout=5))['event'], 'viewer_count')
+
+        def end_stream():
+            request = APIRequestFactory().post(f'/api/chat/streams/{stream_id}/end/')
+            force_authenticate(request, user=user)
+            return EndStreamView.as_view()(request, pk=stream_id)
+
+        # Views are sync; run it in a thread the way Django would
+        self.assertEqual((await database_sync_to_async(end_stream)()).status_code, 200)
+        for communicator in (directory, viewer):
+            event = await communicator.receive_json_from(timeout=5)
+            self.assertEqual((event['type'], event['event'], event['stream']['status']),
+                             ('stream_event', 'ended', 'ended'))
+        await viewer.disconnect()
+        await directory.disconnect()
+
+
+class ViewerPresenceTests(TransactionTestCase):
+    def test_flush_writes_net_counts_and_viewer_rows(self):
+        User = get_user_model()
+        streamer, alice, bob = (User.objects.create(username=name) for name in ('streamer', 'alice', 'bob'))
+        stream = Stream.objects.create(streamer=streamer, title='Live', viewer_count=5)
+        asyncio.run(self._visit(stream.id, alice.id, bob.id))
+
+        stream.refresh_from_db()
+        self.assertEqual(stream.viewer_count, 7)
+        self.assertIsNone(StreamViewer.objects.get(stream=stream, user=alice).left_at)
+        self.assertIsNotNone(StreamViewer.objects.get(stream=stream, user=bob).left_at)
+
+    async def _visit(self, stream_id, alice, bob):
+        presence = ViewerPresence()
+        presence.record_viewers = True
+        # Alice opens two tabs and closes one; Bob comes and goes; a guest joins
+        for user_id in (alice, alice, bob, None):
+            presence.join(stream_id, user_id)
+        presence.leave(stream_id, alice)
+        await presence.flush()
+        presence.leave(stream_id, bob)
+        await presence.flush()
+        self.assertEqual(presence.sockets, {(stream_id, alice): 1})
+
+
+class StreamDirectoryTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = StreamDirectory()
+        self.directory.epoch = 'e1'
+        self.received = []
+        self.directory.subscribe(self)
+
+    def put(self, frame):
+        self.received.append(frame)
+
+    def test_deltas_are_versioned_and_resumable(self):
+        directory = self.directory
+        directory.apply('started', {'id': 1, 'title': 'One', 'viewer_count': 0})
+        directory.apply('viewer_count', {'id': 1, 'viewer_count': 4})
+        # Unknown streams and unchanged counts produce no delta
+        self.assertIsNone(directory.apply('viewer_count', {'id': 2, 'viewer_count': 9}))
+        self.assertIsNone(directory.apply('viewer_count', {'id': 1, 'viewer_count': 4}))
+        directory.apply('stopped', {'id': 1, 'status': 'ended'}, reason='speech_violations')
+
+        self.assertEqual([frame['version'] for frame in self.received], [1, 2, 3])
+        self.assertEqual(directory.snapshot()['streams'], [])
+        self.assertEqual([frame['event'] for frame in directory.catch_up('e1', 1)], ['viewer_count', 'stopped'])
+        self.assertEqual(directory.catch_up('e1', 3), [])
+        # Another worker's (or a previous run's) versions mean nothing here
+        self.assertIsNone(directory.catch_up('other', 1))
+
+    def test_client_too_far_behind_gets_snapshot(self):
+        directory = self.directory
+        for count in range(directory.log.maxlen + 5):
+            directory.apply('started', {'id': 1, 'viewer_count': count})
+        self.assertIsNone(directory.catch_up('e1', 1))
+        self.assertEqual(len(directory.catch_up('e1', directory.version - 3)), 3)
+
+
+TEST_RATE_LIMITS = {
+    'chat': {
+        'connection': {'rate': 2, 'burst': 5},
+        'user': {'rate': 1, 'burst': 2},
+        'room': {'rate': 1, 'burst': 3},
+    },
+}
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_burst_then_refill_at_rate(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        start = bucket.updated
+        self.assertEqual([bucket.consume(now=start) for _ in range(4)], [True, True, True, False])
+        self.assertAlmostEqual(bucket.retry_after(), 0.5)
+        self.assertFalse(bucket.consume(now=start + 0.25))
+        self.assertTrue(bucket.consume(now=start + 0.5))
+        # Refill stops at the burst size, however long the bucket sat idle
+        bucket.refill(now=start + 100)
+        self.assertEqual(bucket.tokens, 3)
+        self.assertEqual(bucket.retry_after(), 0)
+
+
+@override_settings(WEBSOCKET_RATE_LIMITS=TEST_RATE_LIMITS, WEBSOCKET_RATE_LIMIT_CACHE=None)
+class RateLimiterTests(SimpleTestCase):
+    def test_flooder_does_not_use_up_the_room(self):
+        limiter = RateLimiter('chat')
+
+        async def send(user, times):
+            return [(await limiter.allow(user_key=user, room_key='room'))[0] for _ in range(times)]
+
+        # Denied by their own bucket before the room is drawn down
+        self.assertEqual(asyncio.run(send('flooder', 5)), [True, True, False, False, False])
+        self.assertEqual(asyncio.run(send('quiet', 1)), [True])
+
+    def test_room_denial_does_not_cost_user_tokens(self):
+        limiter = RateLimiter('chat')
+
+        async def run():
+            for user in ('a', 'b', 'c'):
+                await limiter.allow(user_key=user, room_key='room')
+            allowed, retry_after = await limiter.allow(user_key='d', room_key='room')
+            return allowed, retry_after, limiter._buckets['user']['d'].tokens
+
+        allowed, retry_after, tokens = asyncio.run(run())
+        self.assertFalse(allowed)
+        self.assertGreater(retry_after, 0)
+        self.assertAlmostEqual(tokens, 2, places=2)
+
+    @override_settings(WEBSOCKET_RATE_LIMIT_CACHE='default')
+    def test_shared_mode_counts_across_limiters(self):
+        cache.clear()
+        # Two limiters stand in for two worker processes sharing the cache
+        first, second = RateLimiter('chat'), RateLimiter('chat')
+
+        async def run():
+            return [
+                (await first.allow(user_key='u', room_key=None))[0],
+                (await second.allow(user_key='u', room_key=None))[0],
+                await first.allow(user_key='u', room_key=None),
+            ]
+
+        one, two, (allowed, retry_after) = asyncio.run(run())
+        self.assertTrue(one and two)
+        self.assertFalse(allowed)
+        self.assertGreater(retry_after, 0)
+
+    def test_user_key_ignores_client_supplied_ids(self):
+        class Socket:
+            channel_name = 'specific.abc!123'
+            scope = {'user': AnonymousUser(), 'url_route': {'kwargs': {'user_id': '42'}}}
+
+        self.assertEqual(rate_limit_key(Socket()), 'conn:specific.abc!123')
+        Socket.scope = {'user': get_user_model()(pk=7, username='alice'), 'client': ['203.0.113.5', 50123]}
+        self.assertEqual(rate_limit_key(Socket()), 'user:7')
+
+    def test_anonymous_sockets_share_a_bucket_per_address(self):
+        class Socket:
+            def __init__(self, channel_name, port):
+                self.channel_name = channel_name
+                self.scope = {'user': AnonymousUser(), 'client': ['203.0.113.5', port]}
+
+        first, second = Socket('specific.a', 50123), Socket('specific.b', 50124)
+        self.assertEqual(rate_limit_key(first), 'addr:203.0.113.5')
+        self.assertEqual(rate_limit_key(second), rate_limit_key(first))
+        with self.settings(WEBSOCKET_RATE_LIMIT_ANONYMOUS_KEY='connection'):
+            self.assertEqual(rate_limit_key(second), 'conn:specific.b')
+
+
+class SlowSocket:
+    """Stands in for a consumer whose client reads nothing until `unblock()`"""
+
+    def __init__(self, fail=False):
+        self.sent = []
+        self.closed_with = None
+        self.fail = fail
+        self.gate = asyncio.Event()
+
+    def unblock(self):
+        self.gate.set()
+
+    async def send(self, text_data):
+        await self.gate.wait()
+        if self.fail:
+            raise ConnectionResetError('client went away')
+        self.sent.append(json.loads(text_data))
+
+    async def close(self, code=None):
+        self.closed_with = code
+
+
+def chat_frame(n):
+    return {'type': 'new_message', 'message': {'id': n}}
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def run_queue(self, policy, frames, socket=None, **config):
+        socket = socket or SlowSocket()
+
+        async def run():
+            with override_settings(CHAT_OUTBOUND_QUEUE={'MAX_SIZE': 3, 'POLICY': policy, **config}):
+                queue = OutboundQueue(socket, f'test_{policy}')
+            for frame in frames:
+                queue.put(frame)
+            # All of them arrived before the socket read anything
+            socket.unblock()
+            for _ in range(20):
+                await asyncio.sleep(0)
+            queue.close()
+            return queue
+
+        return socket, asyncio.run(run())
+
+    def test_drop_oldest_keeps_the_newest_frames(self):
+        socket, _ = self.run_queue('drop_oldest', [chat_frame(n) for n in range(8)])
+        self.assertEqual([frame['message']['id'] for frame in socket.sent], [5, 6, 7])
+
+    def test_coalesce_merges_queued_messages(self):
+        frames = [chat_frame(n) for n in range(8)]
+        frames.insert(3, {'type': 'restriction_expired', 'user_id': 1})
+        socket, _ = self.run_queue('coalesce', frames)
+        self.assertIn({'type': 'restriction_expired', 'user_id': 1}, socket.sent)
+        delivered = []
+        for frame in socket.sent:
+            if frame['type'] == 'message_batch':
+                delivered += [message['id'] for message in frame['messages']]
+            elif frame['type'] == 'new_message':
+                delivered.append(frame['message']['id'])
+        # Merged into batches; nothing dropped or duplicated, order kept
+        self.assertLess(len(socket.sent), 9)
+        self.assertEqual(delivered, list(range(8)))
+
+    def test_disconnect_closes_a_socket_that_stays_saturated(self):
+        socket, queue = self.run_queue('disconnect', [chat_frame(n) for n in range(8)], MAX_LAG_SECONDS=0)
+        self.assertEqual(socket.closed_with, 4008)
+        self.assertTrue(queue.closed)
+
+    def test_failed_send_closes_the_socket(self):
+        socket, queue = self.run_queue('coalesce', [chat_frame(0)], socket=SlowSocket(fail=True))
+        self.assertEqual(socket.closed_with, 1011)
+        self.assertTrue(queue.closed)
+
+    def test_frames_wait_until_started(self):
+        socket = SlowSocket()
+        socket.unblock()
+
+        async def run():
+            queue = OutboundQueue(socket, 'test_start', start=False)
+            queue.put(chat_frame(1))
+            await asyncio.sleep(0.01)
+            before = list(socket.sent)
+            queue.start()
+            await asyncio.sleep(0.01)
+            queue.close()
+            return before
+
+        self.assertEqual(asyncio.run(run()), [])
+        self.assertEqual(socket.sent, [chat_frame(1)])
+
+
+class FakeProcess:
+    def __init__(self, pid, returncode=None):
+        self.pid = pid
+        self.returncode = returncode
+
+    def poll(self):
+        return self.returncode
+
+
+class SupervisorHealthTests(SimpleTestCase):
+    def setUp(self):
+        self.health_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.health_dir.cleanup)
+        self.supervisor = RunWorkersCommand()
+        self.supervisor.health_dir = self.health_dir.name
+        self.supervisor.options = {'heartbeat_timeout': 15, 'max_loop_lag': 10}
+
+    def worker(self, returncode=None, **heartbeat):
+        worker = Worker(0, FakeProcess(4242, returncode))
+        if heartbeat:
+            status = {'pid': 4242, 'heartbeat_at': time.time(), 'loop_lag_ms': 1.0, **heartbeat}
+            write_json_atomic(os.path.join(self.health_dir.name, 'worker-4242.json'), status)
+        return worker
+
+    def test_healthy_worker_is_left_alone(self):
+        self.assertIsNone(self.supervisor._unhealthy_reason(self.worker(loop_lag_ms=3.5)))
+
+    def test_exited_and_stale_workers_are_restarted(self):
+        self.assertEqual(self.supervisor._unhealthy_reason(self.worker(returncode=1)), 'exited with code 1')
+        stale = self.worker(heartbeat_at=time.time() - 60)
+        self.assertEqual(self.supervisor._unhealthy_reason(stale), 'heartbeat went stale')
+
+    def test_wedged_worker_is_restarted_although_its_heartbeat_is_fresh(self):
+        wedged = self.worker(loop_lag_ms=12500.0)
+        self.assertEqual(self.supervisor._unhealthy_reason(wedged), 'event loop blocked for 12.5s')
+
+
+class WorkerHeartbeatTests(SimpleTestCase):
+    def test_loop_lag_keeps_growing_while_the_loop_is_blocked(self):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        self.addCleanup(loop.close)
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+
+        with tempfile.TemporaryDirectory() as health_dir:
+            heartbeat = WorkerHeartbeat(health_dir, '0', interval=0.05)
+        heartbeat.watch_loop(loop)
+        self.assertLess(heartbeat._measure_loop_lag(), 50)
+
+        unblock = threading.Event()
+        loop.call_soon_threadsafe(unblock.wait, 5)
+        first = heartbeat._measure_loop_lag()
+        time.sleep(0.3)
+        later = heartbeat._measure_loop_lag()
+        unblock.set()
+        # Not capped at the probe interval: a supervisor threshold above it can still trigger
+        self.assertGreaterEqual(first, 50)
+        self.assertGreaterEqual(later, 300)
+
+
+class LoadTestCommandTests(SimpleTestCase):
+    def test_single_worker_smoke_run_report(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # The command and the workers it spawns must share one (migrated) database
+            env = worker_env(SQLITE_PATH=os.path.join(tmp, 'loadtest.sqlite3'), CHANNEL_LAYER_BACKEND='memory')
+            subprocess.run([sys.executable, 'manage.py', 'migrate', '-v', '0'],
+                           cwd=settings.BASE_DIR, env=env, check=True, timeout=120, capture_output=True)
+            output = os.path.join(tmp, 'report.json')
+            subprocess.run(
+                [sys.executable, 'manage.py', 'loadtest', '--spawn-workers', '1', '--clients', '4', '--streams', '1',
+                 '--senders', '0.5', '--speech-clients', '1', '--rate', '2', '--ramp', '0.5', '--duration', '1',
+                 '--drain', '1', '--seed', '1', '--output', output],
+                cwd=settings.BASE_DIR, env=env, check=True, timeout=120, capture_output=True,
+            )
+            with open(output) as f:
+                report = json.load(f)
+
+        self.assertEqual(report['channel_layer'], 'memory')
+        self.assertEqual(report['config']['spawn_workers'], 1)
+        self.assertEqual(report['connections']['chat']['open'], 4)
+        self.assertEqual(report['connections']['speech']['open'], 1)
+        self.assertGreater(report['chat']['sent'], 0)
+        self.assertGreater(report['chat']['receipts'], 0)
+        self.assertEqual(set(report['chat']['latency_ms']), {'all', 'clean', 'toxic', 'nuanced'})
+        self.assertGreater(report['speech']['sent'], 0)
+        self.assertIsNotNone(report['stubs'])
@@ -8,4 +8,5 @@ urlpatterns = [
     path('streams/<int:pk>/', views.StreamDetailView.as_view(), name='stream-detail'),
     path('streams/start/', views.StartStreamView.as_view(), name='start-stream'),
     path('streams/<int:pk>/end/', views.EndStreamView.as_view(), name='end-stream'),
+    path('metrics/', views.ChatMetricsView.as_view(), name='chat-metrics'),
 ]
\ No newline at end of file
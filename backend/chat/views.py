@@ -4,7 +4,10 @@ from rest_framework.views import APIView
 from django.utils import timezone
 from .models import Message, Stream
 from .serializers import MessageSerializer, StreamSerializer
+from .outbound import room_metrics
+from .events import STARTED, ENDED, broadcast_stream_event_sync, ended_delta, stream_summary
 from moderation.ai_detector import ToxicityDetector
+from moderation.pipeline import pipeline_metrics
 
 class MessageListView(generics.ListCreateAPIView):
     serializer_class = MessageSerializer
@@ -62,6 +65,7 @@ class StartStreamView(APIView):
             description=description,
             status='live'
         )
+        broadcast_stream_event_sync(STARTED, stream.id, stream_summary(stream))
         
         return Response(
             StreamSerializer(stream).data,
@@ -75,6 +79,7 @@ class EndStreamView(APIView):
             stream.status = 'ended'
             stream.ended_at = timezone.now()
             stream.save()
+            broadcast_stream_event_sync(ENDED, stream.id, ended_delta(stream))
             
             return Response(StreamSerializer(stream).data)
         except Stream.DoesNotExist:
@@ -83,3 +88,7 @@ class EndStreamView(APIView):
                 status=status.HTTP_404_NOT_FOUND
             )
 
+class ChatMetricsView(APIView):
+    """Outbound queue depth and drop counters per room, and moderation stage timings (for this worker process)"""
+    def get(self, request):
+        return Response({'rooms': room_metrics(), 'pipelines': pipeline_metrics()})
@@ -0,0 +1,3 @@
+"""
+Development and test helpers. Nothing in here is used by a production deployment.
+"""
@@ -0,0 +1,419 @@
+"""
+Minimal Redis-protocol (RESP2/RESP3) server for local multi-process testing.
+
+It implements just the commands used by `channels_redis.core.RedisChannelLayer`
+and Django's RedisCache, so several workers can share a channel layer without
+a real Redis install. Data lives in memory and is lost on exit; do not use it
+in production.
+
+    python -m devtools.redis_standin --port 6399
+"""
+import argparse
+import asyncio
+import fnmatch
+import time
+
+
+class RespError(Exception):
+    pass
+
+
+def _parse_score_bound(value):
+    value = value.decode() if isinstance(value, bytes) else str(value)
+    if value in ('-inf', '+inf', 'inf'):
+        return float(value.replace('+', '')), False
+    if value.startswith('('):
+        return float(value[1:]), True
+    return float(value), False
+
+
+def _in_range(score, low, high):
+    (lo, lo_excl), (hi, hi_excl) = low, high
+    above = score > lo if lo_excl else score >= lo
+    below = score < hi if hi_excl else score <= hi
+    return above and below
+
+
+def _format_score(score):
+    return repr(float(score)).encode()
+
+
+class RedisStandIn:
+    """In-memory keyspace of strings and sorted sets with lazy key expiry"""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self._changed = asyncio.Condition()
+        self._connections = set()
+        self.server = None
+
+    # ---- keyspace helpers ----
+
+    def _alive(self, key):
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def _zset(self, key, create=False):
+        if self._alive(key):
+            value = self.data[key]
+            if not isinstance(value, dict):
+                raise RespError('WRONGTYPE Operation against a key holding the wrong kind of value')
+            return value
+        if create:
+            self.data[key] = {}
+            self.expires.pop(key, None)
+            return self.data[key]
+        return {}
+
+    def _drop_if_empty(self, key):
+        if isinstance(self.data.get(key), dict) and not self.data[key]:
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+
+    def _delete(self, keys):
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                removed += 1
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return removed
+
+    def _zadd(self, key, score, member):
+        zset = self._zset(key, create=True)
+        added = member not in zset
+        zset[member] = float(score)
+        return int(added)
+
+    def _zpopmin(self, key, count=1):
+        zset = self._zset(key)
+        popped = []
+        for member, score in sorted(zset.items(), key=lambda item: (item[1], item[0]))[:count]:
+            del zset[member]
+            popped.append((member, score))
+        self._drop_if_empty(key)
+        return popped
+
+    # ---- command dispatch ----
+
+    async def execute(self, args):
+        name = args[0].decode().upper()
+        handler = getattr(self, f'cmd_{name.lower()}', None)
+        if handler is None:
+            raise RespError(f"ERR unknown command '{name}'")
+        result = handler(*args[1:])
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    def cmd_ping(self, *args):
+        return args[0] if args else 'PONG'
+
+    def cmd_client(self, *args):
+        return 'OK'
+
+    def cmd_select(self, db):
+        return 'OK'
+
+    def cmd_flushall(self, *args):
+        self.data.clear()
+        self.expires.clear()
+        return 'OK'
+
+    cmd_flushdb = cmd_flushall
+
+    def cmd_get(self, key):
+        if not self._alive(key):
+            return None
+        value = self.data[key]
+        if isinstance(value, dict):
+            raise RespError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def cmd_set(self, key, value, *options):
+        options = [o.decode().upper() if isinstance(o, bytes) else o for o in options]
+        exists = self._alive(key)
+        if 'NX' in options and exists:
+            return None
+        if 'XX' in options and not exists:
+            return None
+        self.data[key] = value
+        self.expires.pop(key, None)
+        for unit, scale in (('EX', 1.0), ('PX', 0.001)):
+            if unit in options:
+                self.expires[key] = time.time() + float(options[options.index(unit) + 1]) * scale
+        return 'OK'
+
+    def cmd_incrby(self, key, amount):
+        current = int(self.cmd_get(key) or 0) + int(amount)
+        self.data[key] = str(current).encode()
+        return current
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, 1)
+
+    def cmd_decrby(self, key, amount):
+        return self.cmd_incrby(key, -int(amount))
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self._alive(key))
+
+    def cmd_del(self, *keys):
+        return self._delete(keys)
+
+    cmd_unlink = cmd_del
+
+    def cmd_keys(self, pattern):
+        pattern = pattern.decode()
+        return [k for k in list(self.data) if self._alive(k) and fnmatch.fnmatchcase(k.decode(), pattern)]
+
+    def cmd_expire(self, key, seconds):
+        if not self._alive(key):
+            return 0
+        self.expires[key] = time.time() + int(seconds)
+        return 1
+
+    def cmd_pexpire(self, key, millis):
+        if not self._alive(key):
+            return 0
+        self.expires[key] = time.time() + int(millis) / 1000.0
+        return 1
+
+    def cmd_persist(self, key):
+        return 1 if self.expires.pop(key, None) is not None else 0
+
+    def cmd_ttl(self, key):
+        if not self._alive(key):
+            return -2
+        deadline = self.expires.get(key)
+        return -1 if deadline is None else max(0, int(deadline - time.time()))
+
+    async def cmd_zadd(self, key, *args):
+        args = list(args)
+        while args and args[0].upper() in (b'NX', b'XX', b'GT', b'LT', b'CH'):
+            args.pop(0)
+        added = 0
+        for i in range(0, len(args), 2):
+            added += self._zadd(key, args[i], args[i + 1])
+        await self._notify()
+        return added
+
+    def cmd_zrem(self, key, *members):
+        zset = self._zset(key)
+        removed = sum(1 for m in members if zset.pop(m, None) is not None)
+        self._drop_if_empty(key)
+        return removed
+
+    def cmd_zcount(self, key, low, high):
+        low, high = _parse_score_bound(low), _parse_score_bound(high)
+        return sum(1 for score in self._zset(key).values() if _in_range(score, low, high))
+
+    def cmd_zcard(self, key):
+        return len(self._zset(key))
+
+    def cmd_zremrangebyscore(self, key, low, high):
+        low, high = _parse_score_bound(low), _parse_score_bound(high)
+        zset = self._zset(key)
+        doomed = [m for m, score in zset.items() if _in_range(score, low, high)]
+        for member in doomed:
+            del zset[member]
+        self._drop_if_empty(key)
+        return len(doomed)
+
+    def cmd_zrange(self, key, start, stop, *options):
+        ordered = sorted(self._zset(key).items(), key=lambda item: (item[1], item[0]))
+        start, stop = int(start), int(stop)
+        stop = len(ordered) + stop if stop < 0 else stop
+        start = max(0, len(ordered) + start if start < 0 else start)
+        selected = ordered[start:stop + 1]
+        if any(o.upper() == b'WITHSCORES' for o in options):
+            return [x for member, score in selected for x in (member, _format_score(score))]
+        return [member for member, _ in selected]
+
+    def cmd_zpopmin(self, key, count=b'1'):
+        return [x for member, score in self._zpopmin(key, int(count)) for x in (member, _format_score(score))]
+
+    async def cmd_bzpopmin(self, *args):
+        keys, timeout = args[:-1], float(args[-1])
+        deadline = time.monotonic() + timeout if timeout > 0 else None
+        while True:
+            for key in keys:
+                popped = self._zpopmin(key)
+                if popped:
+                    member, score = popped[0]
+                    return [key, member, _format_score(score)]
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            async with self._changed:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def cmd_eval(self, script, numkeys, *rest):
+        """
+        There is no Lua interpreter here: the scripts channels_redis ships are
+        recognised by content and executed natively.
+        """
+        numkeys = int(numkeys)
+        keys, argv = rest[:numkeys], rest[numkeys:]
+        if b'over_capacity' in script:
+            # group_send: ARGV = messages..., capacities..., current_time, expiry
+            current_time, expiry = float(argv[-2]), int(float(argv[-1]))
+            over_capacity = 0
+            for i, key in enumerate(keys):
+                if len(self._zset(key)) < int(float(argv[i + numkeys])):
+                    self._zadd(key, current_time, argv[i])
+                    self.cmd_expire(key, expiry)
+                else:
+                    over_capacity += 1
+            await self._notify()
+            return over_capacity
+        if b'backed_up' in script:
+            # Receive cleanup: move in-flight backup entries back onto the channel
+            channel, backup = argv[0], argv[1]
+            for member, score in self._zset(backup).items():
+                self._zadd(channel, score, member)
+            self._delete([backup])
+            await self._notify()
+            return None
+        if b"redis.call('keys'" in script:
+            # flush(): delete every key under a prefix
+            self._delete(self.cmd_keys(argv[0]))
+            return None
+        raise RespError('ERR script not supported by the stand-in server')
+
+    # ---- protocol ----
+
+    async def handle(self, reader, writer):
+        transaction = None
+        resp3 = False
+        self._connections.add(asyncio.current_task())
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if args is None:
+                    break
+                name = args[0].upper()
+                if name == b'HELLO':
+                    # redis-py negotiates RESP3 by default
+                    if len(args) > 1:
+                        resp3 = int(args[1]) == 3
+                    reply = {
+                        'server': 'redis',
+                        'version': '7.0.0',
+                        'proto': 3 if resp3 else 2,
+                        'mode': 'standalone',
+                        'role': 'master',
+                    }
+                elif name == b'MULTI':
+                    transaction = []
+                    reply = 'OK'
+                elif name == b'EXEC':
+                    results = []
+                    for queued in transaction or []:
+                        try:
+                            results.append(await self.execute(queued))
+                        except RespError as e:
+                            results.append(e)
+                    transaction = None
+                    reply = results
+                elif name == b'DISCARD':
+                    transaction = None
+                    reply = 'OK'
+                elif transaction is not None:
+                    transaction.append(args)
+                    reply = 'QUEUED'
+                else:
+                    try:
+                        reply = await self.execute(args)
+                    except RespError as e:
+                        reply = e
+                writer.write(self._encode(reply, resp3))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(asyncio.current_task())
+            writer.close()
+
+    async def _read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            # Inline command (e.g. from telnet/redis-cli PING)
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:])):
+            header = await reader.readline()
+            length = int(header[1:])
+            payload = await reader.readexactly(length + 2)
+            args.append(payload[:-2])
+        return args
+
+    def _encode(self, value, resp3=False):
+        if value is None:
+            return b'_\r\n' if resp3 else b'$-1\r\n'
+        if isinstance(value, RespError):
+            return b'-' + str(value).encode() + b'\r\n'
+        if isinstance(value, bool):
+            return b':%d\r\n' % int(value)
+        if isinstance(value, int):
+            return b':%d\r\n' % value
+        if isinstance(value, str):
+            return b'+' + value.encode() + b'\r\n'
+        if isinstance(value, bytes):
+            return b'$%d\r\n%s\r\n' % (len(value), value)
+        if isinstance(value, dict):
+            items = [x for pair in value.items() for x in pair]
+            if resp3:
+                return b'%%%d\r\n' % len(value) + b''.join(self._encode(v, resp3) for v in items)
+            value = items
+        if isinstance(value, (list, tuple)):
+            return b'*%d\r\n' % len(value) + b''.join(self._encode(v, resp3) for v in value)
+        raise TypeError(f'Cannot encode {type(value).__name__}')
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        if self.server:
+            await self.server.wait_closed()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the in-memory Redis stand-in server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6399)
+    options = parser.parse_args()
+
+    async def serve():
+        standin = RedisStandIn()
+        port = await standin.start(options.host, options.port)
+        print(f"Redis stand-in listening on redis://{options.host}:{port}/0", flush=True)
+        await standin.server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
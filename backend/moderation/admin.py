@@ -1,4 +1,5 @@
 from django.contrib import admin
+from .expiry import RESTRICTION, expiry_scheduler
 from .models import Warning, Restriction, ToxicityLog
 
 @admin.register(Warning)
@@ -16,6 +17,11 @@ class RestrictionAdmin(admin.ModelAdmin):
     list_filter = ['restriction_type', 'is_permanent', 'created_at']
     search_fields = ['user__username', 'reason']
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if obj.is_active and not obj.is_permanent:
+            expiry_scheduler.schedule_threadsafe(RESTRICTION, obj.pk, obj.expires_at)
+
 @admin.register(ToxicityLog)
 class ToxicityLogAdmin(admin.ModelAdmin):
     list_display = ['message_preview', 'toxicity_score', 'is_toxic', 'created_at']
@@ -0,0 +1,213 @@
+"""
+Central expiry processing for speech timeouts and chat restrictions.
+
+Each worker runs one scheduler task. It keeps a heap of upcoming
+`StreamTimeout` / `Restriction` deadlines. Due rows are deactivated in
+batched UPDATEs and an expiry event is broadcast for each one. The heap is
+rebuilt from the DB on startup and topped up every EXPIRY_RESYNC_SECONDS.
+This picks up rows created by other workers or the admin, and rows whose
+worker died before they expired. With several workers the DB update is
+idempotent. A cache `add` makes sure only one worker broadcasts each expiry.
+"""
+import asyncio
+import heapq
+import time
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import Restriction, StreamTimeout
+from .timeout_index import TIMEOUT_GROUP, row_key
+
+
+TIMEOUT = 'timeout'
+RESTRICTION = 'restriction'
+
+# Rows deactivated per UPDATE
+BATCH_SIZE = 500
+# Longest pause after the scheduler loop fails
+BACKOFF_MAX_SECONDS = 30
+
+
+class ExpiryScheduler:
+    """Heap of (deadline, kind, pk) drained by a single task on the worker's event loop"""
+
+    def __init__(self):
+        self.heap = []
+        # (kind, pk) -> deadline; heap entries that no longer match are stale and skipped
+        self.deadlines = {}
+        self.loop = None
+        self.task = None
+        self._wakeup = None
+        self.resync_seconds = getattr(settings, 'EXPIRY_RESYNC_SECONDS', 60)
+
+    def start(self):
+        """Start on the running event loop; calling it again is a no-op"""
+        if self.task and not self.task.done():
+            return
+        self.loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self.heap.clear()
+        self.deadlines.clear()
+        self.task = self.loop.create_task(self._run())
+
+    def schedule(self, kind, pk, expires_at):
+        """Track a row that expires at `expires_at` (call from the event loop)"""
+        if expires_at is None:
+            return
+        deadline = expires_at.timestamp()
+        if self.deadlines.get((kind, pk)) == deadline:
+            return
+        self.deadlines[(kind, pk)] = deadline
+        heapq.heappush(self.heap, (deadline, kind, pk))
+        # Wake the task if this is now the earliest deadline
+        if self._wakeup and self.heap[0][0] == deadline:
+            self._wakeup.set()
+
+    def schedule_threadsafe(self, kind, pk, expires_at):
+        """`schedule` for sync code (views, admin); rows are picked up by the resync otherwise"""
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.schedule, kind, pk, expires_at)
+
+    # ---- task ----
+
+    async def _run(self):
+        next_resync = 0
+        failures = 0
+        while True:
+            try:
+                now = time.time()
+                if now >= next_resync:
+                    await self._resync()
+                    next_resync = now + self.resync_seconds
+
+                due = self._pop_due(now)
+                if due:
+                    await self._expire(due)
+                    failures = 0
+                    continue
+
+                wake_at = min(next_resync, self.heap[0][0]) if self.heap else next_resync
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), max(0.0, wake_at - time.time()))
+                except asyncio.TimeoutError:
+                    pass
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # e.g. the cache is down; keep the task alive and try again after a pause
+                failures += 1
+                delay = min(BACKOFF_MAX_SECONDS, 2 ** (failures - 1))
+                print(f"   [EXPIRY] Scheduler error ({e!r}); retrying in {delay}s")
+                await asyncio.sleep(delay)
+                # Rows dropped from the heap mid-batch are still active in the DB
+                next_resync = 0
+
+    def _pop_due(self, now):
+        due = {TIMEOUT: [], RESTRICTION: []}
+        count = 0
+        while self.heap and self.heap[0][0] <= now and count < BATCH_SIZE:
+            deadline, kind, pk = heapq.heappop(self.heap)
+            if self.deadlines.get((kind, pk)) != deadline:
+                continue
+            del self.deadlines[(kind, pk)]
+            due[kind].append(pk)
+            count += 1
+        return due if count else None
+
+    async def _resync(self):
+        try:
+            pending = await self._load_pending()
+        except Exception as e:
+            print(f"   [EXPIRY] Resync failed: {e}")
+            return
+        for kind, pk, expires_at in pending:
+            self.schedule(kind, pk, expires_at)
+
+    @database_sync_to_async
+    def _load_pending(self):
+        # Only near-term deadlines are held in memory; later ones arrive with a later resync
+        horizon = timezone.now() + timedelta(seconds=self.resync_seconds * 2)
+        timeouts = StreamTimeout.objects.filter(is_active=True, expires_at__lte=horizon).values_list('pk', 'expires_at')
+        restrictions = Restriction.objects.filter(
+            is_active=True, is_permanent=False, expires_at__lte=horizon
+        ).values_list('pk', 'expires_at')
+        return (
+            [(TIMEOUT, pk, expires_at) for pk, expires_at in timeouts] +
+            [(RESTRICTION, pk, expires_at) for pk, expires_at in restrictions]
+        )
+
+    @database_sync_to_async
+    def _deactivate(self, due):
+        now = timezone.now()
+        timeouts = list(StreamTimeout.objects.filter(
+            pk__in=due[TIMEOUT], is_active=True, expires_at__lte=now
+        ).values('pk', 'user_id', 'user_identifier', 'stream_id', 'stream_identifier', 'expires_at'))
+        restrictions = list(Restriction.objects.filter(
+            pk__in=due[RESTRICTION], is_active=True, expires_at__lte=now
+        ).values('pk', 'user_id', 'restriction_type'))
+        # Rows whose expiry was pushed back are left alone and come back with the next resync
+        if timeouts:
+            StreamTimeout.objects.filter(pk__in=[row['pk'] for row in timeouts]).update(is_active=False)
+        if restrictions:
+            Restriction.objects.filter(pk__in=[row['pk'] for row in restrictions]).update(is_active=False)
+        return timeouts, restrictions
+
+    async def _expire(self, due):
+        try:
+            timeouts, restrictions = await self._deactivate(due)
+        except Exception as e:
+            # Still active in the DB, so the next resync schedules them again
+            print(f"   [EXPIRY] Deactivation failed: {e}")
+            return
+        if timeouts or restrictions:
+            print(f"   [EXPIRY] Deactivated {len(timeouts)} timeout(s), {len(restrictions)} restriction(s)")
+
+        channel_layer = get_channel_layer()
+        for row in timeouts:
+            if not await self._claim(TIMEOUT, row['pk']):
+                continue
+            user_id, stream_id = row_key(row['user_id'], row['user_identifier'],
+                                         row['stream_id'], row['stream_identifier'])
+            await self._broadcast(channel_layer, TIMEOUT_GROUP, {
+                'type': 'timeout.expired',
+                'key': [user_id, stream_id],
+                'expires_at': row['expires_at'].timestamp(),
+            })
+            await self._broadcast(channel_layer, f'speech_moderation_{stream_id}', {
+                'type': 'timeout_expired_notification',
+                'user_id': user_id,
+                'stream_id': stream_id,
+            })
+        for row in restrictions:
+            if not await self._claim(RESTRICTION, row['pk']):
+                continue
+            await self._broadcast(channel_layer, 'global_chat', {
+                'type': 'restriction_expired',
+                'user_id': row['user_id'],
+                'restriction_type': row['restriction_type'],
+            })
+
+    async def _claim(self, kind, pk):
+        """Only the first worker to expire a row announces it"""
+        try:
+            return await cache.aadd(f'expired:{kind}:{pk}', 1, timeout=300)
+        except Exception as e:
+            # The row is already deactivated, so nobody would announce it later; better twice than never
+            print(f"   [EXPIRY] Could not claim {kind} {pk} ({e}); announcing anyway")
+            return True
+
+    async def _broadcast(self, channel_layer, group, event):
+        try:
+            await channel_layer.group_send(group, event)
+        except Exception as e:
+            print(f"   [EXPIRY] Broadcast to {group} failed: {e}")
+
+
+expiry_scheduler = ExpiryScheduler()
@@ -0,0 +1,46 @@
+"""
+Background fact-checking of new posts.
+
+Post creation used to call the fact check API (with no timeout) before the
+post was saved, so every upload waited on a third party. Posts are now saved
+right away with `fact_check_status='pending'`. This queue checks the
+caption and records `is_rumor` / `rumor_reason`. A correct verdict leaves
+them alone, so it never clears a flag that reports set in the meantime. See
+moderation.post_jobs for claiming, retries and restarts. It is configured
+by the FACT_CHECK_* settings.
+"""
+import functools
+
+from .post_jobs import PostJobQueue
+from .rumors import check_caption_async
+
+
+FACT_CHECKED = 'fact_checked'
+
+
+class FactCheckQueue(PostJobQueue):
+    name = 'FACT CHECK'
+    field = 'fact_check'
+    event = FACT_CHECKED
+    setting_prefix = 'FACT_CHECK'
+
+    def __init__(self, check=None):
+        # `check(caption)` -> (is_correct, reason); raises to have the post retried
+        self.check = check or functools.partial(check_caption_async, raise_errors=True)
+        super().__init__()
+
+    async def run(self, post):
+        is_correct, reason = await self.check(post.caption)
+        if is_correct:
+            return {}
+        return {'is_rumor': True, 'rumor_reason': reason}
+
+    def payload(self, post):
+        return {
+            'fact_check_status': post.fact_check_status,
+            'is_rumor': post.is_rumor,
+            'rumor_reason': post.rumor_reason,
+        }
+
+
+fact_check_queue = FactCheckQueue()
@@ -0,0 +1,105 @@
+"""
+Keyset-paginated post feed with a shared first page.
+
+The feed used to return every post in one response. Pages are now cut on
+(created_at, id), newest first, from the `post_feed_idx` index. `next` is an
+opaque cursor that holds the last post's position, so a page costs the
+same however deep it is and posts inserted meanwhile never shift it.
+
+Almost every feed request is for the first page. Its viewer-independent
+part (the serialized posts) is cached for FEED_CACHE_SECONDS. Each viewer's
+`is_liked` flags are merged in afterwards with one indexed lookup. Creating
+or deleting a post, or changing its rumor flag, moves the cache to a new
+generation. A page computed before the invalidation can then only be stored
+under the old key. Like counts and views on the cached page may lag by up to
+FEED_CACHE_SECONDS.
+"""
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Q
+
+from .models import PostLike
+
+
+DEFAULT_PAGE_SIZE = 20
+DEFAULT_CACHE_SECONDS = 30
+GENERATION_KEY = 'post_feed:generation'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _cache():
+    return caches[getattr(settings, 'POST_FEED_CACHE', 'default')]
+
+
+def page_size():
+    return getattr(settings, 'POST_FEED_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+
+
+def encode_cursor(post):
+    raw = f'{post.created_at.isoformat()}|{post.pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(created_at, id) of the last post on the previous page"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, pk = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCursor(cursor)
+
+
+def feed_page(queryset, cursor=None, size=None):
+    """One page of `queryset` (newest first) and the cursor for the next one, or None"""
+    size = size or page_size()
+    queryset = queryset.order_by('-created_at', '-id')
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    posts = list(queryset[:size + 1])
+    next_cursor = encode_cursor(posts[size - 1]) if len(posts) > size else None
+    return posts[:size], next_cursor
+
+
+def cached_first_page(build):
+    """
+    The viewer-independent first page, as stored by `build()`, which must
+    return `(results, next_cursor)`
+    """
+    cache = _cache()
+    generation = cache.get(GENERATION_KEY, 0)
+    key = f'post_feed:first:{generation}'
+    page = cache.get(key)
+    if page is None:
+        results, next_cursor = build()
+        page = {'results': results, 'next': next_cursor}
+        cache.set(key, page, getattr(settings, 'POST_FEED_CACHE_SECONDS', DEFAULT_CACHE_SECONDS))
+    return page
+
+
+def merge_liked(results, viewer_id):
+    """Copies of the cached posts with this viewer's `is_liked` flags"""
+    liked = set()
+    if viewer_id and results:
+        liked = set(PostLike.objects.filter(
+            post_id__in=[post['id'] for post in results], user_id=str(viewer_id),
+        ).values_list('post_id', flat=True))
+    return [{**post, 'is_liked': post['id'] in liked} for post in results]
+
+
+def invalidate_feed():
+    """Drop the cached first page after a change to which posts it shows or how"""
+    cache = _cache()
+    # incr is atomic; add covers the first invalidation (or an evicted counter)
+    if not cache.add(GENERATION_KEY, 1, timeout=None):
+        try:
+            cache.incr(GENERATION_KEY)
+        except ValueError:
+            cache.set(GENERATION_KEY, 1, timeout=None)
@@ -0,0 +1,68 @@
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from django.contrib.auth import get_user_model
+
+from chat.models import Stream
+
+
+@dataclass(frozen=True)
+class SpeechIdentity:
+    """
+    Who is speaking in which stream, resolved once per speech connection.
+
+    Speech clients may be ephemeral frontend ids without a `User` row, and
+    streams may not have a `Stream` row either. In that case, violations and
+    timeouts are keyed by the raw identifier fields instead of the foreign
+    keys. `filter` and `create_kwargs` pick the right pair of fields, so
+    queries don't need to branch four ways on every call.
+    """
+    user_id: str
+    stream_id: str
+    user: Optional[object] = None
+    stream: Optional[Stream] = None
+    filter: Dict = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        lookup = {}
+        if self.user is not None:
+            lookup['user'] = self.user
+        else:
+            lookup['user_identifier'] = self.user_id
+        if self.stream is not None:
+            lookup['stream'] = self.stream
+        else:
+            lookup['stream_identifier'] = self.stream_id
+        object.__setattr__(self, 'filter', lookup)
+
+    @classmethod
+    def resolve(cls, user_id, stream_id):
+        """Look up the User and Stream rows behind the URL ids (sync, call from a DB thread)"""
+        user_id, stream_id = str(user_id), str(stream_id)
+        User = get_user_model()
+        try:
+            user = User.objects.filter(pk=user_id).first()
+        except (ValueError, TypeError):
+            # Non-numeric ephemeral ids can't match an integer primary key
+            user = None
+        try:
+            stream = Stream.objects.filter(pk=stream_id).first()
+        except (ValueError, TypeError):
+            stream = None
+        return cls(user_id, stream_id, user, stream)
+
+    @property
+    def key(self):
+        """(user, stream) key shared with rows in the timeout index"""
+        user = str(self.user.pk) if self.user is not None else self.user_id
+        stream = str(self.stream.pk) if self.stream is not None else self.stream_id
+        return user, stream
+
+    def create_kwargs(self):
+        """Fields for creating a SpeechViolation / StreamTimeout owned by this identity"""
+        return {
+            'user': self.user,
+            'user_identifier': None if self.user is not None else self.user_id,
+            'stream': self.stream,
+            'stream_identifier': None if self.stream is not None else self.stream_id,
+        }
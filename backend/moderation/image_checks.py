@@ -0,0 +1,284 @@
+"""
+Cached AI-generated image detection.
+
+`CheckAIImageView` used to call Sightengine with a blocking request for
+every call, even for an image it had already checked. Verdicts are now
+cached by the SHA-256 of the image bytes for AI_IMAGE_CACHE_SECONDS, so the
+same image is never sent twice, whatever URL it comes from. URL checks
+remember the image's ETag. Asking about the same URL again costs a
+conditional GET (304 Not Modified) instead of a download. Calls share one
+pooled httpx client per event loop; sync views run them on one long-lived
+background loop (`detect_image_url_sync`) so they share one too.
+
+The URL comes from the client, so fetching it is guarded: only http(s) to
+hosts that resolve to public addresses, checked again on every redirect
+hop, and the body is streamed and dropped once it passes MAX_IMAGE_BYTES.
+The client connects to the very address it checked, so a host can't pass
+the check and then resolve somewhere else (DNS rebinding) for the connection.
+
+Uploaded post images are checked in the background by ImageCheckQueue (see
+moderation.post_jobs), which stores the verdict on the post.
+"""
+import asyncio
+import hashlib
+import ipaddress
+import threading
+import weakref
+from urllib.parse import urlsplit
+
+import httpcore
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from .ai_detector import AIImageDetector
+from .post_jobs import PostJobQueue
+
+
+CREDENTIALS_MISSING = 'API Credentials missing'
+URL_NOT_ALLOWED = 'Image URL is not allowed'
+DEFAULT_CACHE_SECONDS = 30 * 24 * 60 * 60
+# Larger downloads are left for the API to fetch by URL
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+MAX_REDIRECTS = 5
+
+_clients = weakref.WeakKeyDictionary()
+_sync_loop = None
+_sync_lock = threading.Lock()
+
+
+class UnsafeURLError(Exception):
+    pass
+
+
+class ImageTooLargeError(Exception):
+    pass
+
+
+async def _resolve(host, port):
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port)
+    return [info[4][0] for info in infos]
+
+
+async def public_address(host, port):
+    """An address of `host` to connect to; UnsafeURLError if any of them isn't public"""
+    try:
+        addresses = await _resolve(host, port)
+    except OSError as e:
+        raise UnsafeURLError(f'cannot resolve {host}: {e}')
+    for address in addresses:
+        # Strip an IPv6 zone ("fe80::1%eth0")
+        ip = ipaddress.ip_address(address.split('%')[0])
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise UnsafeURLError(f'{host} resolves to {ip}')
+    if not addresses:
+        raise UnsafeURLError(f'cannot resolve {host}')
+    return addresses[0]
+
+
+async def check_url(url):
+    """Raise UnsafeURLError unless `url` is http(s) and its host only resolves to public addresses"""
+    try:
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+    except ValueError as e:
+        raise UnsafeURLError(str(e))
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise UnsafeURLError(f'not an http(s) URL: {url}')
+    await public_address(parts.hostname, port)
+
+
+class PublicAddressBackend(httpcore.AsyncNetworkBackend):
+    """Opens connections to the address `public_address` checked, never to a second lookup's answer"""
+
+    def __init__(self):
+        self.backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        # TLS still verifies and sends SNI for `host`: httpcore passes the origin's name to start_tls
+        address = await public_address(host, port)
+        return await self.backend.connect_tcp(address, port, timeout, local_address, socket_options)
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        raise UnsafeURLError(f'unix socket {path}')
+
+    async def sleep(self, seconds):
+        await self.backend.sleep(seconds)
+
+
+class PublicAddressTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, limits):
+        # No proxies from the environment: a proxy would do its own lookup
+        super().__init__(limits=limits, trust_env=False)
+        # httpx doesn't take a network backend; swap the pool it built for one on ours
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(trust_env=False),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=PublicAddressBackend(),
+        )
+
+
+def get_client():
+    """The pooled client for the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        # Redirects are followed by hand in detect_image_url, so each hop is checked
+        client = _clients[loop] = httpx.AsyncClient(
+            timeout=15, follow_redirects=False,
+            transport=PublicAddressTransport(httpx.Limits(max_connections=20, max_keepalive_connections=10)),
+        )
+    return client
+
+
+async def _fetch(client, url, headers):
+    """
+    GET `url` by hand through up to MAX_REDIRECTS redirects, checking every hop.
+
+    Returns (response, body); the body is None unless the status is 200.
+    Raises ImageTooLargeError past MAX_IMAGE_BYTES without reading the rest.
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        await check_url(url)
+        async with client.stream('GET', url, headers=headers) as response:
+            if response.has_redirect_location:
+                url = str(response.url.join(response.headers['Location']))
+                continue
+            if response.status_code != 200:
+                return response, None
+            if int(response.headers.get('Content-Length') or 0) > MAX_IMAGE_BYTES:
+                raise ImageTooLargeError(url)
+            body = bytearray()
+            async for chunk in response.aiter_bytes():
+                body += chunk
+                if len(body) > MAX_IMAGE_BYTES:
+                    raise ImageTooLargeError(url)
+            return response, bytes(body)
+    raise httpx.TooManyRedirects(f'more than {MAX_REDIRECTS} redirects', request=response.request)
+
+
+def _cache():
+    return caches[getattr(settings, 'AI_IMAGE_CACHE', 'default')]
+
+
+def _ttl():
+    return getattr(settings, 'AI_IMAGE_CACHE_SECONDS', DEFAULT_CACHE_SECONDS)
+
+
+async def detect_image_bytes(content, detector=None, client=None):
+    """Verdict for these image bytes, from the cache when this image was seen before"""
+    key = f'ai_image:{hashlib.sha256(content).hexdigest()}'
+    cache = _cache()
+    result = await cache.aget(key)
+    if result is not None:
+        return result
+    result = await (detector or AIImageDetector()).detect_async(client or get_client(), content=content)
+    # Errors (including missing credentials) are not verdicts; try again next time
+    if 'error' not in result:
+        await cache.aset(key, result, _ttl())
+    return result
+
+
+async def detect_image_url(image_url, detector=None, client=None):
+    """
+    Verdict for the image at `image_url`; revalidated by ETag instead of downloaded again.
+
+    URLs pointing into a private network (or redirecting there) get a
+    URL_NOT_ALLOWED error and are neither fetched nor passed on.
+    """
+    detector = detector or AIImageDetector()
+    client = client or get_client()
+    cache = _cache()
+    key = f'ai_image_url:{hashlib.sha256(image_url.encode()).hexdigest()}'
+    entry = await cache.aget(key)
+    headers = {'If-None-Match': entry['etag']} if entry else {}
+
+    try:
+        response, content = await _fetch(client, image_url, headers)
+    except UnsafeURLError as e:
+        print(f"   [AI IMAGE] Refusing {image_url}: {e}")
+        return {'is_ai_generated': False, 'score': 0.0, 'error': URL_NOT_ALLOWED}
+    except ImageTooLargeError:
+        response = content = None
+    except httpx.HTTPError as e:
+        print(f"   [AI IMAGE] Could not fetch {image_url}: {e}")
+        response = content = None
+    if response is not None and response.status_code == 304 and entry:
+        return entry['result']
+    if content is None:
+        # Not reachable from here (or too big); the API may still be able to fetch it
+        return await detector.detect_async(client, image_url=image_url)
+
+    result = await detect_image_bytes(content, detector, client)
+    etag = response.headers.get('ETag')
+    if etag and 'error' not in result:
+        await cache.aset(key, {'etag': etag, 'result': result}, _ttl())
+    return result
+
+
+def _background_loop():
+    global _sync_loop
+    with _sync_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(target=_sync_loop.run_forever, name='ai-image-client', daemon=True).start()
+        return _sync_loop
+
+
+def detect_image_url_sync(image_url):
+    """
+    `detect_image_url` for sync views.
+
+    async_to_sync may give every call a fresh loop (always under WSGI), and
+    with it a fresh client and fresh TLS connections. This runs the check on
+    one long-lived loop instead, so its pooled client is reused.
+    """
+    return asyncio.run_coroutine_threadsafe(detect_image_url(image_url), _background_loop()).result()
+
+
+def _read_image(post):
+    with post.image.open('rb') as f:
+        return f.read()
+
+
+class ImageCheckError(Exception):
+    pass
+
+
+class ImageCheckQueue(PostJobQueue):
+    name = 'AI IMAGE'
+    field = 'ai_image'
+    event = 'ai_image_checked'
+    setting_prefix = 'AI_IMAGE_CHECK'
+    defaults = {**PostJobQueue.defaults, 'WORKERS': 2, 'TIMEOUT_SECONDS': 30}
+
+    def __init__(self, detector=None):
+        self.detector = detector
+        super().__init__()
+
+    async def run(self, post):
+        if not post.image:
+            return {}
+        content = await sync_to_async(_read_image, thread_sensitive=False)(post)
+        result = await detect_image_bytes(content, self.detector)
+        if result.get('error') == CREDENTIALS_MISSING:
+            # Nothing to check with; same as the fact check without an API key
+            return {}
+        if 'error' in result:
+            raise ImageCheckError(result['error'])
+        return {'is_ai_generated': result['is_ai_generated'], 'ai_image_score': result['score']}
+
+    def payload(self, post):
+        return {
+            'ai_image_status': post.ai_image_status,
+            'is_ai_generated': post.is_ai_generated,
+            'ai_image_score': post.ai_image_score,
+        }
+
+
+image_check_queue = ImageCheckQueue()
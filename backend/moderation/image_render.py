@@ -0,0 +1,177 @@
+"""
+Pillow work for post images; runs in moderation.image_variants' process pool.
+
+Worker processes are spawned, not forked, so this module is imported on its
+own in a fresh interpreter. Keep Django (and anything importing models) out
+of it.
+"""
+import os
+import struct
+
+from PIL import Image, ImageOps
+
+
+EXTENSIONS = {'WEBP': 'webp', 'JPEG': 'jpg', 'PNG': 'png'}
+
+ORIENTATION = 0x0112
+# JPEG segments that carry no metadata: JFIF/JFXX (APP0) and Adobe (APP14, needed for CMYK colours)
+_JPEG_KEEP_APP = {0xE0, 0xEE}
+# PNG chunks with EXIF, text (author, software, ...) or a timestamp
+_PNG_METADATA = {b'eXIf', b'tEXt', b'zTXt', b'iTXt', b'tIME'}
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def _jpeg_segments(data):
+    """(marker, bytes) of each segment of the main image, its scan data included"""
+    pos = 2
+    while pos < len(data):
+        if data[pos] != 0xFF:
+            raise ValueError('not a JPEG marker')
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0xD9:
+            # Phones append more images after this (previews, depth maps), each with its own EXIF
+            yield marker, data[pos:pos + 2]
+            return
+        end = pos + 2 + struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        if marker == 0xDA:
+            # Scan data runs to the next marker that isn't stuffing (FF00), a restart (FFD0-D7) or fill
+            end = data.index(b'\xff', end)
+            while data[end + 1] == 0 or 0xD0 <= data[end + 1] <= 0xD7 or data[end + 1] == 0xFF:
+                end = data.index(b'\xff', end + 1)
+        yield marker, data[pos:end]
+        pos = end
+    raise ValueError('JPEG ends before its end marker')
+
+
+def _jpeg_without_metadata(data, orientation):
+    """The JPEG without EXIF, XMP, IPTC and comments; a 1-tag EXIF block keeps it upright"""
+    kept = [
+        segment for marker, segment in _jpeg_segments(data)
+        if not (marker == 0xFE or (0xE0 <= marker <= 0xEF and marker not in _JPEG_KEEP_APP
+                                   and segment[4:16] != b'ICC_PROFILE\x00'))
+    ]
+    if orientation and orientation != 1:
+        exif = Image.Exif()
+        exif[ORIENTATION] = orientation
+        block = exif.tobytes()
+        # After the JFIF header, which has to come first
+        at = 1 if kept[0][:2] == b'\xff\xe0' else 0
+        kept.insert(at, b'\xff\xe1' + struct.pack('>H', len(block) + 2) + block)
+    return data[:2] + b''.join(kept)
+
+
+def _png_without_metadata(data):
+    out = [_PNG_SIGNATURE]
+    pos = len(_PNG_SIGNATURE)
+    while pos < len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        end = pos + 12 + length
+        if kind not in _PNG_METADATA:
+            out.append(data[pos:end])
+        pos = end
+        if kind == b'IEND':
+            return b''.join(out)
+    raise ValueError('PNG ends before IEND')
+
+
+def _replace(path, write):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _write_bytes(data):
+    def write(tmp):
+        with open(tmp, 'wb') as f:
+            f.write(data)
+    return write
+
+
+def strip_metadata(path):
+    """
+    Drop EXIF (GPS position, camera, ...), XMP and comments from the image
+    at `path`, in place. JPEG and PNG are rewritten segment by segment
+    without decoding, so the pixels stay exactly the same. Other formats,
+    and files those parsers can't follow, are re-encoded, but only if they
+    carry metadata. Returns True if the file changed.
+    """
+    with Image.open(path) as img:
+        # Phone JPEGs with extra pictures (MPF) open as MPO
+        fmt = 'JPEG' if img.format == 'MPO' else img.format
+        exif = img.getexif()
+        orientation = exif.get(ORIENTATION)
+        has_metadata = bool(exif) or any(key in img.info for key in ('exif', 'xmp', 'XML:com.adobe.xmp', 'comment'))
+
+    if fmt in ('JPEG', 'PNG'):
+        with open(path, 'rb') as f:
+            original = f.read()
+        try:
+            data = _jpeg_without_metadata(original, orientation) if fmt == 'JPEG' else _png_without_metadata(original)
+        except (ValueError, IndexError, struct.error):
+            data = None
+        if data is not None:
+            if data == original:
+                return False
+            _replace(path, _write_bytes(data))
+            return True
+
+    if not has_metadata:
+        return False
+    with Image.open(path) as img:
+        animated = getattr(img, 'n_frames', 1) > 1
+        if not animated:
+            img = ImageOps.exif_transpose(img)
+        img.info = {}
+        _replace(path, lambda tmp: img.save(tmp, fmt, save_all=animated))
+    return True
+
+
+def render_variants(source, targets, fmt='WEBP', quality=80):
+    """
+    Write downscaled copies of the image at `source`.
+
+    `targets` is a list of (path, longest side) pairs. EXIF orientation is
+    applied to the pixels and all metadata except the colour profile is
+    dropped. Each file is written next to its target and renamed into place,
+    so running this again for the same post just replaces the same files.
+    Returns {path: (width, height)}.
+    """
+    largest = max(size for _, size in targets)
+    sizes = {}
+    with Image.open(source) as img:
+        # JPEGs decode straight at 1/2 .. 1/8 scale when that is still big enough
+        img.draft('RGB', (largest, largest))
+        icc_profile = img.info.get('icc_profile')
+        img = ImageOps.exif_transpose(img)
+        has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+        img = img.convert('RGBA' if has_alpha and fmt != 'JPEG' else 'RGB')
+        # EXIF (GPS, camera, ...), XMP, comments
+        img.info = {}
+
+        # Largest first, each shrunk from the one before it
+        for path, size in sorted(targets, key=lambda target: -target[1]):
+            img.thumbnail((size, size), Image.LANCZOS)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.tmp'
+            options = {'quality': quality}
+            if icc_profile:
+                options['icc_profile'] = icc_profile
+            if fmt == 'JPEG':
+                options.update(optimize=True, progressive=True)
+            elif fmt == 'WEBP':
+                options['method'] = 4
+            try:
+                img.save(tmp, fmt, **options)
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            sizes[path] = img.size
+    return sizes
@@ -0,0 +1,107 @@
+"""
+Feed-size copies of uploaded post images.
+
+The feed used to serve every post image as uploaded, often a multi-megabyte
+photo with its EXIF (GPS position included) intact. Posts saved with an image
+now get `image_variants_status='pending'`. This queue writes a `thumb` and a
+`feed` copy, downscaled and re-encoded in IMAGE_VARIANTS_FORMAT without
+metadata, under posts/variants/<post id>/. It then stores them in
+`image_thumb` / `image_feed`. See moderation.post_jobs for claiming, retries
+and restarts. The original is stripped of its metadata on upload; the job
+does it again for posts uploaded before that.
+
+Decoding and resizing are CPU-bound and hold the GIL, so they run in a pool
+of IMAGE_VARIANTS_PROCESSES spawned processes (moderation.image_render), not
+on the queue's event loop or a request thread. With 0 processes they run in a
+thread instead. Variants are written to fixed names and renamed into place,
+so a run that is retried, or repeated after a crash, just writes the same
+files again.
+"""
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from .image_render import EXTENSIONS, render_variants, strip_metadata
+from .post_jobs import PostJobQueue
+
+
+READY = 'ready'
+
+DEFAULT_SIZES = {'thumb': 320, 'feed': 1080}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """The process pool shared by this process' renders, or None to render in a thread"""
+    global _pool
+    processes = getattr(settings, 'IMAGE_VARIANTS_PROCESSES', 2)
+    if processes <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # Spawned: forking a process that runs threads (channels, queues) can deadlock the child
+            _pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def variant_name(post_id, variant):
+    fmt = getattr(settings, 'IMAGE_VARIANTS_FORMAT', 'WEBP')
+    return f'posts/variants/{post_id}/{variant}.{EXTENSIONS[fmt]}'
+
+
+class ImageVariantQueue(PostJobQueue):
+    name = 'IMAGE VARIANTS'
+    field = 'image_variants'
+    event = 'image_variants_ready'
+    setting_prefix = 'IMAGE_VARIANTS'
+    done_status = READY
+    defaults = {**PostJobQueue.defaults, 'WORKERS': 2, 'TIMEOUT_SECONDS': 60}
+
+    async def run(self, post):
+        if not post.image:
+            return {}
+        custom = getattr(settings, 'IMAGE_VARIANTS_SIZES', {})
+        sizes = {variant: custom.get(variant, size) for variant, size in DEFAULT_SIZES.items()}
+        names = {variant: variant_name(post.pk, variant) for variant in sizes}
+        targets = [(default_storage.path(names[variant]), size) for variant, size in sizes.items()]
+
+        pool = get_pool()
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(pool, strip_metadata, post.image.path)
+            await loop.run_in_executor(
+                pool, render_variants, post.image.path, targets,
+                getattr(settings, 'IMAGE_VARIANTS_FORMAT', 'WEBP'),
+                getattr(settings, 'IMAGE_VARIANTS_QUALITY', 80),
+            )
+        except BrokenProcessPool:
+            # A render process died (out of memory?); the retry gets a new pool
+            if pool is not None:
+                _discard_pool(pool)
+            raise
+        return {'image_thumb': names['thumb'], 'image_feed': names['feed']}
+
+    def payload(self, post):
+        return {
+            'image_variants_status': post.image_variants_status,
+            'image_thumb': post.image_thumb.url if post.image_thumb else None,
+            'image_feed': post.image_feed.url if post.image_feed else None,
+        }
+
+
+image_variant_queue = ImageVariantQueue()
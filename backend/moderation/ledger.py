@@ -0,0 +1,66 @@
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import SpeechViolation
+
+
+# Long enough to outlive any stream; ended streams drop their entries explicitly
+DEFAULT_LEDGER_TTL = 12 * 60 * 60
+
+
+class ViolationLedger:
+    """
+    Running speech violation count for one (user, stream) pair.
+
+    The count is seeded from SpeechViolation once per connection. After that
+    it lives in the default cache, which is process memory with the in-memory
+    channel layer and the shared Redis with a Redis layer. Escalation then
+    needs no COUNT(*) per toxic utterance. `increment` is an atomic cache INCR,
+    so two utterances processed concurrently (other tabs, other workers) never
+    get the same warning number.
+    """
+
+    def __init__(self, identity):
+        self.identity = identity
+        self.cache = caches[getattr(settings, 'SPEECH_VIOLATION_LEDGER_CACHE', 'default')]
+        self.ttl = getattr(settings, 'SPEECH_VIOLATION_LEDGER_TTL', DEFAULT_LEDGER_TTL)
+        self.key = self.cache_key(identity)
+
+    @staticmethod
+    def cache_key(identity):
+        user = f'u{identity.user.pk}' if identity.user is not None else f'i{identity.user_id}'
+        stream = f's{identity.stream.pk}' if identity.stream is not None else f'i{identity.stream_id}'
+        return f'speech_violations:{stream}:{user}'
+
+    @database_sync_to_async
+    def _count_from_db(self):
+        return SpeechViolation.objects.filter(**self.identity.filter).count()
+
+    async def seed(self):
+        """Load the stored count unless another connection already holds it"""
+        if await self.cache.aget(self.key) is None:
+            await self.cache.aadd(self.key, await self._count_from_db(), timeout=self.ttl)
+
+    async def increment(self):
+        """Reserve the next violation number"""
+        # BaseCache.aincr is a get followed by a set; the sync incr is atomic
+        # (INCR on Redis, lock-protected in LocMemCache)
+        incr = sync_to_async(self.cache.incr, thread_sensitive=False)
+        try:
+            return await incr(self.key)
+        except ValueError:
+            # Evicted or expired mid-stream: reseed from the DB and retry once
+            await self.seed()
+            return await incr(self.key)
+
+    async def rollback(self):
+        """Give back a number whose violation could not be stored"""
+        try:
+            await sync_to_async(self.cache.decr, thread_sensitive=False)(self.key)
+        except ValueError:
+            pass
+
+    async def forget(self):
+        await self.cache.adelete(self.key)
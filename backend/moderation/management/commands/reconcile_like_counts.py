@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.db.models.functions import Coalesce
+
+from moderation.models import Post, PostLike
+
+
+class Command(BaseCommand):
+    help = (
+        'Recount Post.likes_count from PostLike rows and fix any drift. '
+        'Works through posts in id order, one short transaction per batch.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Posts checked per transaction')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report drifted posts without changing them')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        counts = PostLike.objects.filter(post=models.OuterRef('pk')).order_by() \
+            .values('post').annotate(total=models.Count('id')).values('total')
+        checked = fixed = 0
+        last_id = 0
+
+        while True:
+            ids = list(Post.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+            checked += len(ids)
+
+            with transaction.atomic():
+                # Lock the batch so likes toggled meanwhile wait instead of being overwritten
+                drifted = list(
+                    Post.objects.select_for_update().filter(pk__in=ids)
+                    .annotate(actual=Coalesce(models.Subquery(counts), 0))
+                    .exclude(likes_count=models.F('actual'))
+                    .values_list('pk', 'likes_count', 'actual')
+                )
+                for pk, stored, actual in drifted:
+                    if options['verbosity'] >= 2 or options['dry_run']:
+                        self.stdout.write(f'Post {pk}: likes_count {stored} -> {actual}')
+                    if not options['dry_run']:
+                        Post.objects.filter(pk=pk).update(likes_count=actual)
+                fixed += len(drifted)
+
+        verb = 'would be fixed' if options['dry_run'] else 'fixed'
+        self.stdout.write(self.style.SUCCESS(f'Checked {checked} post(s); {fixed} {verb}'))
@@ -0,0 +1,26 @@
+# Generated by Django 6.0.1 on 2026-10-19 10:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moderation', '0006_alter_confirmedrumor_id_alter_post_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='restriction',
+            name='is_active',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddIndex(
+            model_name='restriction',
+            index=models.Index(fields=['is_active', 'expires_at'], name='moderation__is_acti_78f029_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='streamtimeout',
+            index=models.Index(fields=['is_active', 'expires_at'], name='moderation__is_acti_376800_idx'),
+        ),
+    ]
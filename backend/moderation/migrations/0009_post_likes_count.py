@@ -0,0 +1,28 @@
+# Generated by Django 6.0.1 on 2026-10-19 11:10
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def backfill_likes_count(apps, schema_editor):
+    Post = apps.get_model('moderation', 'Post')
+    PostLike = apps.get_model('moderation', 'PostLike')
+    counts = PostLike.objects.filter(post=models.OuterRef('pk')).order_by() \
+        .values('post').annotate(total=models.Count('id')).values('total')
+    Post.objects.update(likes_count=Coalesce(models.Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moderation', '0008_post_feed_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='likes_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_likes_count, migrations.RunPython.noop),
+    ]
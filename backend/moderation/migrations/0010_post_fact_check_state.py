@@ -0,0 +1,39 @@
+# Generated by Django 6.0.1 on 2026-10-19 11:14
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def mark_existing_checked(apps, schema_editor):
+    # Posts created so far were fact-checked before they were saved
+    apps.get_model('moderation', 'Post').objects.update(fact_check_status='checked')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moderation', '0009_post_likes_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='fact_check_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='fact_check_due_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='fact_check_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('checked', 'Checked'), ('failed', 'Failed')], default='pending', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['fact_check_status', 'fact_check_due_at'], name='post_fact_check_idx'),
+        ),
+        migrations.RunPython(mark_existing_checked, migrations.RunPython.noop),
+    ]
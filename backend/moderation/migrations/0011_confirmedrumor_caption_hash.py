@@ -0,0 +1,39 @@
+# Generated by Django 6.0.1 on 2026-10-19 11:16
+
+import hashlib
+import re
+import unicodedata
+
+from django.db import migrations, models
+
+
+# moderation.rumors.caption_hash as of this migration, frozen so replaying it
+# always writes the hashes it wrote the first time
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def caption_hash(text):
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    return hashlib.sha256(' '.join(_NON_WORD.sub(' ', text).split()).encode()).hexdigest()
+
+
+def hash_existing(apps, schema_editor):
+    ConfirmedRumor = apps.get_model('moderation', 'ConfirmedRumor')
+    for rumor in ConfirmedRumor.objects.only('caption_text').iterator():
+        ConfirmedRumor.objects.filter(pk=rumor.pk).update(caption_hash=caption_hash(rumor.caption_text))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moderation', '0010_post_fact_check_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='confirmedrumor',
+            name='caption_hash',
+            field=models.CharField(db_index=True, default='', max_length=64),
+        ),
+        migrations.RunPython(hash_existing, migrations.RunPython.noop),
+    ]
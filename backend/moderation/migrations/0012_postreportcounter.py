@@ -0,0 +1,46 @@
+# Generated by Django 6.0.1 on 2026-10-19 11:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def count_existing_reports(apps, schema_editor):
+    PostReport = apps.get_model('moderation', 'PostReport')
+    PostReportCounter = apps.get_model('moderation', 'PostReportCounter')
+    totals = PostReport.objects.values('post_id', 'reason').annotate(total=models.Count('id')).order_by()
+    PostReportCounter.objects.bulk_create(
+        [PostReportCounter(post_id=row['post_id'], reason=row['reason'], count=row['total']) for row in totals],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moderation', '0011_confirmedrumor_caption_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostReportCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reason', models.CharField(max_length=255)),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='postreport',
+            index=models.Index(fields=['post', 'reason'], name='moderation__post_id_2ad7ca_idx'),
+        ),
+        migrations.AddField(
+            model_name='postreportcounter',
+            name='post',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='report_counters', to='moderation.post'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='postreportcounter',
+            unique_together={('post', 'reason')},
+        ),
+        migrations.RunPython(count_existing_reports, migrations.RunPython.noop),
+    ]
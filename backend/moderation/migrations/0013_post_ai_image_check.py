@@ -0,0 +1,43 @@
+# Generated by Django 6.0.1 on 2026-10-19 11:22
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moderation', '0012_postreportcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='ai_image_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='ai_image_due_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='ai_image_score',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='ai_image_status',
+            field=models.CharField(choices=[('none', 'No image'), ('pending', 'Pending'), ('checked', 'Checked'), ('failed', 'Failed')], default='none', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='is_ai_generated',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['ai_image_status', 'ai_image_due_at'], name='post_ai_image_idx'),
+        ),
+    ]
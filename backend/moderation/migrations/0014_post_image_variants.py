@@ -0,0 +1,51 @@
+# Generated by Django 6.0.1 on 2026-10-19 11:26
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def queue_existing_images(apps, schema_editor):
+    # The variant queue's poller works these off after the upgrade
+    apps.get_model('moderation', 'Post').objects.exclude(image='').exclude(image__isnull=True).update(
+        image_variants_status='pending'
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moderation', '0013_post_ai_image_check'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='image_feed',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to=''),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='image_thumb',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to=''),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='image_variants_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='image_variants_due_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='image_variants_status',
+            field=models.CharField(choices=[('none', 'No image'), ('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], default='none', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['image_variants_status', 'image_variants_due_at'], name='post_image_variants_idx'),
+        ),
+        migrations.RunPython(queue_existing_images, migrations.RunPython.noop),
+    ]
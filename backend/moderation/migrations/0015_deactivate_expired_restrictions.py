@@ -0,0 +1,22 @@
+# Generated by Django 6.0.1 on 2026-10-19 11:39
+
+from django.db import migrations
+from django.utils import timezone
+
+
+def deactivate_expired(apps, schema_editor):
+    # 0007 added is_active=True to every row, including restrictions that had already run out
+    apps.get_model('moderation', 'Restriction').objects.filter(
+        is_active=True, is_permanent=False, expires_at__lte=timezone.now()
+    ).update(is_active=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moderation', '0014_post_image_variants'),
+    ]
+
+    operations = [
+        migrations.RunPython(deactivate_expired, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,7 @@
 from django.db import models
 from django.contrib.auth import get_user_model
 from django.conf import settings
+from django.utils import timezone
 
 User = get_user_model()
 
@@ -37,12 +38,15 @@ class Restriction(models.Model):
     issued_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='issued_restrictions')
     is_permanent = models.BooleanField(default=False)
     expires_at = models.DateTimeField(null=True, blank=True)
+    # Cleared by the expiry scheduler once expires_at has passed
+    is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
         ordering = ['-created_at']
         indexes = [
             models.Index(fields=['user', '-created_at']),
+            models.Index(fields=['is_active', 'expires_at']),
         ]
     
     def __str__(self):
@@ -119,6 +123,7 @@ class StreamTimeout(models.Model):
         ordering = ['-started_at']
         indexes = [
             models.Index(fields=['user', 'stream', 'is_active']),
+            models.Index(fields=['is_active', 'expires_at']),
         ]
     
     def __str__(self):
@@ -126,23 +131,75 @@ class StreamTimeout(models.Model):
         stream_display = self.stream.title if self.stream else (self.stream_identifier or 'unknown')
         return f"Timeout for {user_display} in {stream_display}"
 
+class PostQuerySet(models.QuerySet):
+    def with_feed_annotations(self, viewer_id=None):
+        """The viewer's liked flag in the same query, instead of one query per post"""
+        liked = models.Exists(PostLike.objects.filter(post=models.OuterRef('pk'), user_id=str(viewer_id))) \
+            if viewer_id else models.Value(False)
+        return self.annotate(viewer_liked=liked)
+
+
 class Post(models.Model):
+    FACT_CHECK_STATES = [
+        ('pending', 'Pending'),
+        ('checked', 'Checked'),
+        ('failed', 'Failed'),  # gave up after FACT_CHECK_MAX_ATTEMPTS
+    ]
+    AI_IMAGE_STATES = [
+        ('none', 'No image'),
+        ('pending', 'Pending'),
+        ('checked', 'Checked'),
+        ('failed', 'Failed'),  # gave up after AI_IMAGE_CHECK_MAX_ATTEMPTS
+    ]
+    IMAGE_VARIANT_STATES = [
+        ('none', 'No image'),
+        ('pending', 'Pending'),
+        ('ready', 'Ready'),
+        ('failed', 'Failed'),  # gave up after IMAGE_VARIANTS_MAX_ATTEMPTS; clients fall back to `image`
+    ]
+
     user_id = models.CharField(max_length=255, default="")
     username = models.CharField(max_length=255, default="")
     image = models.ImageField(upload_to='posts/', null=True, blank=True)
     caption = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     views = models.IntegerField(default=0)
+    # Kept in step with PostLike rows by LikePostView; `reconcile_like_counts` repairs drift
+    likes_count = models.IntegerField(default=0)
     is_rumor = models.BooleanField(default=False)
     rumor_reason = models.TextField(blank=True, default="")
+    # Worked off by moderation.fact_check after the post is saved
+    fact_check_status = models.CharField(max_length=10, choices=FACT_CHECK_STATES, default='pending')
+    fact_check_attempts = models.PositiveSmallIntegerField(default=0)
+    # Next attempt (retry backoff), or when a worker's claim on it lapses
+    fact_check_due_at = models.DateTimeField(default=timezone.now)
+    # Worked off by moderation.image_checks for posts with an uploaded image
+    is_ai_generated = models.BooleanField(default=False)
+    ai_image_score = models.FloatField(null=True, blank=True)
+    ai_image_status = models.CharField(max_length=10, choices=AI_IMAGE_STATES, default='none')
+    ai_image_attempts = models.PositiveSmallIntegerField(default=0)
+    ai_image_due_at = models.DateTimeField(default=timezone.now)
+    # Downscaled, metadata-free copies of `image` written by moderation.image_variants
+    image_thumb = models.ImageField(null=True, blank=True, editable=False)
+    image_feed = models.ImageField(null=True, blank=True, editable=False)
+    image_variants_status = models.CharField(max_length=10, choices=IMAGE_VARIANT_STATES, default='none')
+    image_variants_attempts = models.PositiveSmallIntegerField(default=0)
+    image_variants_due_at = models.DateTimeField(default=timezone.now)
+
+    objects = PostQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Feed pages are cut on (created_at, id), newest first
+            models.Index(fields=['-created_at', '-id'], name='post_feed_idx'),
+            models.Index(fields=['fact_check_status', 'fact_check_due_at'], name='post_fact_check_idx'),
+            models.Index(fields=['ai_image_status', 'ai_image_due_at'], name='post_ai_image_idx'),
+            models.Index(fields=['image_variants_status', 'image_variants_due_at'], name='post_image_variants_idx'),
+        ]
 
     def __str__(self):
         return f"{self.username} - {self.created_at}"
 
-    @property
-    def likes_count(self):
-        return self.post_likes.count()
-
 class PostLike(models.Model):
     post = models.ForeignKey(Post, related_name='post_likes', on_delete=models.CASCADE)
     user_id = models.CharField(max_length=255)
@@ -158,12 +215,37 @@ class PostReport(models.Model):
     description = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['post', 'reason']),
+        ]
+
     def __str__(self):
         return f"Report for {self.post.id} by {self.reporter_user_id}"
 
+
+class PostReportCounter(models.Model):
+    """Reports per (post, reason), bumped with F() by ReportPostView instead of a COUNT(*) per report"""
+    post = models.ForeignKey(Post, related_name='report_counters', on_delete=models.CASCADE)
+    reason = models.CharField(max_length=255)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('post', 'reason')
+
+    def __str__(self):
+        return f"{self.count} '{self.reason}' report(s) for {self.post_id}"
+
 class ConfirmedRumor(models.Model):
     caption_text = models.TextField(unique=True)
+    # moderation.rumors.caption_hash(caption_text): new posts are matched on this, not the raw text
+    caption_hash = models.CharField(max_length=64, db_index=True, default="")
     created_at = models.DateTimeField(auto_now_add=True)
 
+    def save(self, *args, **kwargs):
+        from .rumors import caption_hash
+        self.caption_hash = caption_hash(self.caption_text)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"Confirmed Rumor: {self.caption_text[:50]}..."
@@ -0,0 +1,501 @@
+"""
+One moderation path for global chat, stream chat and speech.
+
+The three consumers used to carry their own copies of detect, mask, save,
+warn and restrict, each with slightly different rules. Now each consumer
+builds a `ModerationContext` and runs a `ModerationPipeline`, which is an
+ordered list of stages:
+
+    chat:          rate limit -> identity -> restriction -> detect -> persist -> broadcast -> escalate
+    speech intake: rate limit -> coalesce
+    speech:        timeout -> segment -> detect -> persist -> escalate -> reply
+
+A stage can halt the context, e.g. when the user is restricted. Later stages
+then skip it. The pipeline times every stage, and the totals are served by
+`pipeline_metrics()` (GET /api/chat/metrics/). Extra observers can be added
+with `add_hook`. `run_batch` runs several contexts stage by stage. A stage
+that can share work across messages overrides `run_many` (the detector runs
+a batch concurrently).
+"""
+import asyncio
+import json
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+from django.db.models import F, Q
+from django.utils import timezone
+
+from chat.events import STOPPED, broadcast_stream_event, ended_delta
+from chat.models import Message, Stream
+from chat.ratelimit import rate_limited_payload
+from .ai_detector import ToxicityDetector
+from .expiry import expiry_scheduler, TIMEOUT
+from .models import Restriction, Warning
+from .timeout_index import timeout_index
+from .transcripts import Segment
+
+
+# Warnings before an automatic chat restriction
+CHAT_WARNING_LIMIT = 3
+SPEECH_TIMEOUT_SECONDS = 10
+
+# pipeline name -> stage name -> counters, for this worker process
+_pipeline_stats = defaultdict(lambda: defaultdict(lambda: {
+    'calls': 0,
+    'items': 0,
+    'total_ms': 0.0,
+    'max_ms': 0.0,
+}))
+
+
+def pipeline_metrics():
+    """Snapshot of per-stage timings for every pipeline in this worker"""
+    return {
+        name: {stage: {**stats, 'total_ms': round(stats['total_ms'], 3), 'max_ms': round(stats['max_ms'], 3)}
+               for stage, stats in list(stages.items())}
+        for name, stages in list(_pipeline_stats.items())
+    }
+
+
+@dataclass
+class ModerationContext:
+    """One message or transcript on its way through a pipeline"""
+    consumer: Any
+    text: str
+    room_key: str
+    user_key: Optional[str] = None
+    # chat
+    username: Optional[str] = None
+    client_user_id: Any = None
+    stream_id: Any = None
+    user_id: Optional[int] = None
+    message: Optional[Dict] = None
+    # speech
+    utterance_id: Optional[str] = None
+    is_final: bool = True
+    segment: Optional[Segment] = None
+    # The whole utterance so far with every flagged word masked; what the speaker is shown
+    masked_transcript: Optional[str] = None
+    violation_count: Optional[int] = None
+    action: Optional[Dict] = None
+    # detect
+    result: Optional[Dict] = None
+    halted: bool = False
+
+    @property
+    def is_toxic(self):
+        return bool(self.result and self.result.get('is_toxic'))
+
+    @property
+    def should_warn(self):
+        return self.is_toxic and self.result.get('should_warn', True)
+
+    def halt(self):
+        self.halted = True
+
+    async def reply(self, payload):
+        """Send a frame to the socket this message came from"""
+        await self.consumer.send(text_data=json.dumps(payload, default=str))
+
+
+class Stage:
+    name = 'stage'
+
+    async def run(self, ctx):
+        raise NotImplementedError
+
+    async def run_many(self, ctxs):
+        """Batching hook; the default handles the contexts one at a time"""
+        for ctx in ctxs:
+            if not ctx.halted:
+                await self.run(ctx)
+
+
+class ModerationPipeline:
+    def __init__(self, name, stages):
+        self.name = name
+        self.stages = stages
+        self.hooks = []
+        self._stats = _pipeline_stats[name]
+
+    def add_hook(self, hook):
+        """`hook(pipeline, stage, seconds, items)` is called after every stage"""
+        self.hooks.append(hook)
+
+    async def run(self, ctx):
+        for stage in self.stages:
+            if ctx.halted:
+                break
+            start = time.perf_counter()
+            await stage.run(ctx)
+            self._record(stage, time.perf_counter() - start, 1)
+        return ctx
+
+    async def run_batch(self, ctxs):
+        for stage in self.stages:
+            live = [ctx for ctx in ctxs if not ctx.halted]
+            if not live:
+                break
+            start = time.perf_counter()
+            await stage.run_many(live)
+            self._record(stage, time.perf_counter() - start, len(live))
+        return ctxs
+
+    def _record(self, stage, seconds, items):
+        stats = self._stats[stage.name]
+        stats['calls'] += 1
+        stats['items'] += items
+        stats['total_ms'] += seconds * 1000
+        stats['max_ms'] = max(stats['max_ms'], seconds * 1000)
+        for hook in self.hooks:
+            hook(self.name, stage.name, seconds, items)
+
+
+# ---- shared stages ----
+
+class RateLimitStage(Stage):
+    """Per-user and per-room limits (the per-socket bucket is checked before parsing)"""
+    name = 'rate_limit'
+
+    async def run(self, ctx):
+        allowed, retry_after = await ctx.consumer.rate_limiter.allow(user_key=ctx.user_key, room_key=ctx.room_key)
+        if not allowed:
+            await ctx.reply(rate_limited_payload(retry_after))
+            ctx.halt()
+
+
+class DetectStage(Stage):
+    name = 'detect'
+
+    def __init__(self):
+        self.detector = None
+
+    async def run(self, ctx):
+        if self.detector is None:
+            self.detector = ToxicityDetector()
+        text = ctx.segment.text if ctx.segment is not None else ctx.text
+        ctx.result = await self.detector.analyze_async(text)
+
+    async def run_many(self, ctxs):
+        await asyncio.gather(*(self.run(ctx) for ctx in ctxs if not ctx.halted))
+
+
+# ---- chat ----
+
+@database_sync_to_async
+def get_or_create_user_db(username, client_user_id=None):
+    User = get_user_model()
+    try:
+        if client_user_id:
+            u = User.objects.filter(id=client_user_id).first()
+            if u:
+                return u.id
+    except Exception:
+        pass
+
+    user, _ = User.objects.get_or_create(username=username)
+    return user.id
+
+
+@database_sync_to_async
+def is_chat_restricted(user_id):
+    if not user_id:
+        return False
+    try:
+        # The expiry scheduler clears is_active, but a lapsed deadline must not block chat
+        # if no scheduler has got to the row yet (or none is running)
+        return Restriction.objects.filter(
+            Q(is_permanent=True) | Q(expires_at__gt=timezone.now()),
+            user_id=user_id,
+            restriction_type__in=['chat', 'full'],
+            is_active=True
+        ).exists()
+    except Exception:
+        return False
+
+
+@database_sync_to_async
+def save_chat_message(user_id, text, stream_id, is_flagged, toxicity_score):
+    """Store the message and count it in the sender's stats (one DB round trip)"""
+    User = get_user_model()
+    user = User.objects.filter(id=user_id).first()
+    if user is None:
+        # Create a lightweight guest user when the provided user_id doesn't exist
+        user, _ = User.objects.get_or_create(username=f'guest_{user_id or int(time.time() * 1000)}')
+    stream = Stream.objects.get(id=stream_id) if stream_id else None
+
+    message = Message.objects.create(
+        user=user,
+        text=text,
+        stream=stream,
+        is_flagged=is_flagged,
+        toxicity_score=toxicity_score
+    )
+    try:
+        User.objects.filter(pk=user.pk).update(messages_sent=F('messages_sent') + 1)
+    except Exception as e:
+        print(f"   [!] Stats Error: {e}")
+
+    return {
+        'id': message.id,
+        'user_id': user.id,
+        'username': user.username,
+        'text': message.text,
+        'is_flagged': message.is_flagged,
+        'toxicity_score': message.toxicity_score,
+        'timestamp': message.created_at.isoformat(),
+    }
+
+
+@database_sync_to_async
+def issue_chat_warning(user_id):
+    """Record an automatic warning; returns the user's warning count"""
+    user = get_user_model().objects.get(id=user_id)
+    Warning.objects.create(
+        user=user,
+        message=None,
+        reason="Automatic: Toxic content detected",
+        is_automatic=True
+    )
+    return Warning.objects.filter(user=user).count()
+
+
+@database_sync_to_async
+def restrict_chat_user(user_id):
+    Restriction.objects.create(
+        user_id=user_id,
+        restriction_type='chat',
+        reason=f"Automatic: {CHAT_WARNING_LIMIT} warnings for toxic behavior",
+        is_permanent=False
+    )
+
+
+class ChatIdentityStage(Stage):
+    """Resolve or create a server-side user for this client (so restriction checks work)"""
+    name = 'identity'
+
+    async def run(self, ctx):
+        ctx.user_id = await get_or_create_user_db(ctx.username, ctx.client_user_id)
+
+
+class RestrictionStage(Stage):
+    name = 'restriction'
+
+    async def run(self, ctx):
+        if await is_chat_restricted(ctx.user_id):
+            await ctx.reply({
+                'type': 'error',
+                'message': 'You are restricted from chatting'
+            })
+            ctx.halt()
+
+
+class ChatPersistStage(Stage):
+    """Toxic messages are stored (and shown) masked and flagged"""
+    name = 'persist'
+
+    async def run(self, ctx):
+        text = ctx.result.get('masked_text', ctx.text) if ctx.is_toxic else ctx.text
+        ctx.message = await save_chat_message(
+            ctx.user_id,
+            text,
+            ctx.stream_id,
+            ctx.is_toxic,
+            ctx.result['toxicity_score']
+        )
+
+
+class ChatBroadcastStage(Stage):
+    name = 'broadcast'
+
+    async def run(self, ctx):
+        await ctx.consumer.channel_layer.group_send(ctx.room_key, {
+            'type': 'chat_message',
+            'message': ctx.message
+        })
+
+
+class ChatEscalateStage(Stage):
+    """Warn on toxic messages; restrict after CHAT_WARNING_LIMIT warnings"""
+    name = 'escalate'
+
+    async def run(self, ctx):
+        if not ctx.is_toxic:
+            return
+        if not ctx.should_warn:
+            print(f"   [MESSAGING] Masked message sent without warning due to positive sentiment.")
+            return
+        warning_count = await issue_chat_warning(ctx.user_id)
+        if warning_count >= CHAT_WARNING_LIMIT:
+            await restrict_chat_user(ctx.user_id)
+            await ctx.reply({
+                'type': 'restriction',
+                'message': 'You have been restricted from chatting due to repeated violations'
+            })
+        else:
+            await ctx.reply({
+                'type': 'warning',
+                'warning_count': warning_count,
+                'message': f'Warning {warning_count}/{CHAT_WARNING_LIMIT}: Your message contained inappropriate content and was masked.'
+            })
+
+
+# ---- speech ----
+
+class CoalesceStage(Stage):
+    """Hand the transcript to the connection's coalescer; the speech pipeline runs when it is flushed"""
+    name = 'coalesce'
+
+    async def run(self, ctx):
+        await ctx.consumer.coalescer.submit(ctx.utterance_id, ctx.text, ctx.is_final)
+
+
+class SpeechTimeoutStage(Stage):
+    name = 'timeout'
+
+    async def run(self, ctx):
+        if ctx.consumer.check_timeout():
+            print(f"⏸️  User {ctx.consumer.user_id} is timed out, ignoring speech")
+            await ctx.reply({
+                'type': 'timeout_active',
+                'message': 'You are currently timed out and cannot speak'
+            })
+            ctx.halt()
+
+
+class SegmentStage(Stage):
+    """
+    Interim results resend the whole utterance; only moderate what's new.
+    Clients that don't send an utterance_id get every transcript checked in full.
+    """
+    name = 'segment'
+
+    async def run(self, ctx):
+        if ctx.utterance_id is None:
+            ctx.segment = Segment(None, ctx.text, 0, True)
+            return
+        ctx.segment = ctx.consumer.transcripts.segment(str(ctx.utterance_id), ctx.text, ctx.is_final)
+        if ctx.segment is None:
+            ctx.halt()
+        else:
+            print(f"🔍 Running moderation on: '{ctx.segment.text}'")
+
+
+class SpeechPersistStage(Stage):
+    """Reserve the next violation number (atomic ledger, no COUNT query) and log it"""
+    name = 'persist'
+
+    async def run(self, ctx):
+        consumer = ctx.consumer
+        masked_text = ctx.result.get('masked_text') if ctx.result else None
+        if not ctx.should_warn:
+            ctx.masked_transcript = consumer.transcripts.commit(ctx.segment, masked_text=masked_text)
+            return
+        print(f"🚨 TOXIC SPEECH DETECTED (WARN)!")
+        ctx.violation_count = await consumer.ledger.increment()
+        print(f"📊 Violation #{ctx.violation_count} for user {consumer.user_id} in stream {consumer.stream_id}")
+        try:
+            await consumer.log_violation(
+                ctx.text,
+                ctx.result.get('toxicity_score', 0),
+                ctx.result.get('detected_words', []),
+                ctx.violation_count
+            )
+        except Exception:
+            await consumer.ledger.rollback()
+            raise
+        # Counted once: later updates of this utterance don't re-check these words
+        ctx.masked_transcript = consumer.transcripts.commit(ctx.segment, flagged=True, masked_text=masked_text)
+
+
+class SpeechEscalateStage(Stage):
+    """Warning, then a timeout, then the stream is stopped"""
+    name = 'escalate'
+
+    async def run(self, ctx):
+        count = ctx.violation_count
+        if not count:
+            return
+        consumer = ctx.consumer
+        if count == 1:
+            ctx.action = {'type': 'speech_warning', 'warning_number': 1, 'message': '⚠️ WARNING 1/3: Inappropriate content.'}
+        elif count == 2:
+            timeout = await consumer.issue_timeout(SPEECH_TIMEOUT_SECONDS)
+            await timeout_index.publish_issued(consumer.identity.key, timeout.expires_at)
+            # Expiry (deactivation + timeout_expired event) is handled by the worker's scheduler
+            expiry_scheduler.schedule(TIMEOUT, timeout.pk, timeout.expires_at)
+            ctx.action = {'type': 'speech_timeout', 'warning_number': 2, 'timeout_duration': SPEECH_TIMEOUT_SECONDS,
+                          'message': f'🔇 muted for {SPEECH_TIMEOUT_SECONDS}s'}
+        else:
+            stream = await consumer.stop_stream()
+            await consumer.ledger.forget()
+            # Viewers and the stream directory learn about it without polling
+            delta = ended_delta(stream) if stream else {'id': consumer.stream_id, 'status': 'ended', 'ended_at': None}
+            await broadcast_stream_event(STOPPED, consumer.stream_id, delta, reason='speech_violations')
+            ctx.action = {'type': 'stream_stopped', 'message': '🚫 Stream terminated'}
+
+
+class SpeechReplyStage(Stage):
+    """Replies carry the whole utterance, masked, never raw words from an earlier flagged update"""
+    name = 'reply'
+
+    async def run(self, ctx):
+        segment = ctx.segment
+        if ctx.violation_count:
+            await ctx.reply({
+                'type': 'speech_toxic',
+                'transcript': ctx.masked_transcript,
+                'original_transcript': segment.text,
+                'utterance_id': ctx.utterance_id,
+                'details': ctx.result,
+                'warning_number': ctx.violation_count
+            })
+            await ctx.reply(ctx.action)
+        elif ctx.is_toxic:
+            print(f"✅ Speech has profanity but positive sentiment. Sending masked version only.")
+            await ctx.reply({
+                'type': 'speech_clean',  # Use speech_clean to avoid triggering UI warnings
+                'transcript': ctx.masked_transcript,
+                'utterance_id': ctx.utterance_id,
+                'is_final': ctx.is_final,
+                'is_masked': True
+            })
+        else:
+            print(f"✅ Speech is clean")
+            await ctx.reply({
+                'type': 'speech_clean',
+                'transcript': ctx.masked_transcript,
+                'utterance_id': ctx.utterance_id,
+                'is_final': ctx.is_final,
+                # Earlier updates of this utterance may have been masked
+                'is_masked': ctx.masked_transcript != ctx.text,
+            })
+
+
+chat_pipeline = ModerationPipeline('chat', [
+    RateLimitStage(),
+    ChatIdentityStage(),
+    RestrictionStage(),
+    DetectStage(),
+    ChatPersistStage(),
+    ChatBroadcastStage(),
+    ChatEscalateStage(),
+])
+
+speech_intake_pipeline = ModerationPipeline('speech_intake', [
+    RateLimitStage(),
+    CoalesceStage(),
+])
+
+speech_pipeline = ModerationPipeline('speech', [
+    SpeechTimeoutStage(),
+    SegmentStage(),
+    DetectStage(),
+    SpeechPersistStage(),
+    SpeechEscalateStage(),
+    SpeechReplyStage(),
+])
@@ -0,0 +1,30 @@
+from channels.generic.websocket import AsyncWebsocketConsumer
+
+from chat.outbound import OutboundQueue
+from moderation.fact_check import fact_check_queue
+from moderation.image_checks import image_check_queue
+from moderation.image_variants import image_variant_queue
+from moderation.post_jobs import POSTS_GROUP
+
+
+class PostConsumer(AsyncWebsocketConsumer):
+    """Post updates for the feed: fact check, AI image check and image variant results for pending posts"""
+
+    async def connect(self):
+        # Make sure this process works off pending checks even before anyone posts here
+        for queue in (fact_check_queue, image_check_queue, image_variant_queue):
+            await queue.start_async()
+        # Created before joining the group so no event arrives without a queue to land in
+        self.outbox = OutboundQueue(self, POSTS_GROUP, start=False)
+        await self.channel_layer.group_add(POSTS_GROUP, self.channel_name)
+        await self.accept()
+        self.outbox.start()
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(POSTS_GROUP, self.channel_name)
+        if getattr(self, 'outbox', None):
+            self.outbox.close()
+
+    async def post_event(self, event):
+        if getattr(self, 'outbox', None):
+            self.outbox.put(dict(event))
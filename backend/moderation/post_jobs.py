@@ -0,0 +1,240 @@
+"""
+Background jobs that run once per post (fact check, image check, ...).
+
+Each job owns three columns on Post: `<field>_status`, `<field>_attempts`
+and `<field>_due_at`. The Post table is the queue, so nothing is lost on a
+restart. Each process runs one PostJobQueue per job: a daemon thread with
+its own event loop and WORKERS tasks, so at most that many runs are in
+flight.
+
+Views hand a new post's id to the local queue with `submit`. A poller also
+loads due pending posts every POLL_SECONDS. The poller picks up posts
+created while no worker was running, retries that are due and claims that
+lapsed. A worker claims a post with a conditional UPDATE that pushes
+`<field>_due_at` past the job's timeout. Two workers (or two processes)
+never run the same post at once, and a claim held by a worker that died
+simply expires. A failed run is retried with exponential backoff, up to
+MAX_ATTEMPTS, after which the post is marked failed.
+
+A run's result is written to the post and pushed to the `posts` group
+(ws/posts/) as a `post_event` frame. The send is handed to the server's
+event loop (recorded by `start_async`): the in-memory channel layer only
+wakes consumers waiting on the loop the send runs on.
+"""
+import asyncio
+import threading
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .feed import invalidate_feed
+from .models import Post
+
+
+POSTS_GROUP = 'posts'
+
+PENDING = 'pending'
+CHECKED = 'checked'
+FAILED = 'failed'
+
+# Due posts loaded per poll
+POLL_BATCH = 200
+
+
+class PostJobQueue:
+    # Subclasses set these
+    name = 'JOB'
+    field = None
+    event = None
+    setting_prefix = None
+    # `<field>_status` once a run has succeeded
+    done_status = CHECKED
+    defaults = {
+        'WORKERS': 4,
+        'TIMEOUT_SECONDS': 10,
+        'MAX_ATTEMPTS': 5,
+        'RETRY_SECONDS': 15,
+        'POLL_SECONDS': 30,
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.loop = None
+        # The ASGI server's loop, where broadcasts are sent from
+        self.server_loop = None
+        self.queue = None
+        # Ids waiting in `queue`, so the poller doesn't add them again
+        self.queued = set()
+        self.status_field = f'{self.field}_status'
+        self.attempts_field = f'{self.field}_attempts'
+        self.due_field = f'{self.field}_due_at'
+        self.config()
+
+    def config(self):
+        def setting(name):
+            return getattr(settings, f'{self.setting_prefix}_{name}', self.defaults[name])
+        self.workers = setting('WORKERS')
+        self.timeout = setting('TIMEOUT_SECONDS')
+        self.max_attempts = setting('MAX_ATTEMPTS')
+        self.retry_seconds = setting('RETRY_SECONDS')
+        self.poll_seconds = setting('POLL_SECONDS')
+
+    # ---- the job ----
+
+    async def run(self, post):
+        """Do the work for `post`; returns the Post fields to save. Raise to have it retried."""
+        raise NotImplementedError
+
+    def payload(self, post):
+        """Fields of the finished post sent with the `post_event`"""
+        return {self.status_field: getattr(post, self.status_field)}
+
+    # ---- queue ----
+
+    def start(self):
+        """Start the queue thread once per process; False if the job is turned off"""
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return True
+            self.config()
+            if self.workers <= 0:
+                return False
+            ready = threading.Event()
+            self.thread = threading.Thread(
+                target=lambda: asyncio.run(self._main(ready)), name=self.name.lower().replace(' ', '-'), daemon=True,
+            )
+            self.thread.start()
+        ready.wait()
+        return True
+
+    async def start_async(self):
+        """`start` from the server's event loop (consumers); broadcasts are sent from this loop"""
+        self.server_loop = asyncio.get_running_loop()
+        if self.thread is not None and self.thread.is_alive():
+            return True
+        # Starting waits for the queue thread's loop; don't hold up this one meanwhile
+        return await sync_to_async(self.start, thread_sensitive=False)()
+
+    def submit(self, post_id):
+        """Run the job for a newly saved post soon; safe to call from sync code"""
+        if not self.start():
+            return
+        self.loop.call_soon_threadsafe(self._enqueue, post_id)
+
+    def _enqueue(self, post_id):
+        if post_id not in self.queued:
+            self.queued.add(post_id)
+            self.queue.put_nowait(post_id)
+
+    async def _main(self, ready):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.queued = set()
+        ready.set()
+        for _ in range(self.workers):
+            self.loop.create_task(self._work())
+        print(f"   [{self.name}] Started {self.workers} worker(s)")
+        while True:
+            try:
+                for post_id in await self._due_ids():
+                    self._enqueue(post_id)
+            except Exception as e:
+                print(f"   [{self.name}] Poll failed: {e}")
+            await asyncio.sleep(self.poll_seconds)
+
+    async def _work(self):
+        while True:
+            post_id = await self.queue.get()
+            self.queued.discard(post_id)
+            try:
+                await self.process(post_id)
+            except Exception as e:
+                print(f"   [{self.name}] Post {post_id} failed: {e}")
+
+    async def process(self, post_id):
+        """Claim, run and record one post; no-op if it isn't due or someone else has it"""
+        post = await self._claim(post_id)
+        if post is None:
+            return None
+        try:
+            changes = await asyncio.wait_for(self.run(post), self.timeout)
+        except Exception as e:
+            post = await self._retry(post_id, e)
+        else:
+            post = await self._finish(post_id, changes)
+        if post is not None and getattr(post, self.status_field) != PENDING:
+            await self._broadcast(post)
+        return post
+
+    async def _broadcast(self, post):
+        event = {
+            'type': 'post_event',
+            'event': self.event,
+            'post': {'id': post.pk, **self.payload(post)},
+        }
+        send = get_channel_layer().group_send(POSTS_GROUP, event)
+        loop = self.server_loop
+        try:
+            if loop is not None and loop is not asyncio.get_running_loop() and loop.is_running():
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(send, loop))
+            else:
+                await send
+        except Exception as e:
+            send.close()
+            # The result is stored; clients see it on their next feed load
+            print(f"[!] {self.event} for post {post.pk} not sent: {e}")
+
+    # ---- DB ----
+
+    @database_sync_to_async
+    def _due_ids(self):
+        return list(
+            Post.objects.filter(**{self.status_field: PENDING, f'{self.due_field}__lte': timezone.now()})
+            .order_by(self.due_field).values_list('pk', flat=True)[:POLL_BATCH]
+        )
+
+    @database_sync_to_async
+    def _claim(self, post_id):
+        now = timezone.now()
+        claimed = Post.objects.filter(
+            pk=post_id, **{self.status_field: PENDING, f'{self.due_field}__lte': now}
+        ).update(**{
+            self.due_field: now + timedelta(seconds=self.timeout * 2),
+            self.attempts_field: F(self.attempts_field) + 1,
+        })
+        if not claimed:
+            return None
+        return Post.objects.filter(pk=post_id).first()
+
+    @database_sync_to_async
+    def _finish(self, post_id, changes):
+        Post.objects.filter(pk=post_id, **{self.status_field: PENDING}).update(
+            **changes, **{self.status_field: self.done_status}
+        )
+        invalidate_feed()
+        return Post.objects.filter(pk=post_id).first()
+
+    @database_sync_to_async
+    def _retry(self, post_id, error):
+        post = Post.objects.filter(pk=post_id).first()
+        if post is None:
+            return None
+        attempts = getattr(post, self.attempts_field)
+        if attempts >= self.max_attempts:
+            print(f"   [{self.name}] Giving up on post {post_id} after {attempts} attempt(s): {error}")
+            setattr(post, self.status_field, FAILED)
+            Post.objects.filter(pk=post_id, **{self.status_field: PENDING}).update(**{self.status_field: FAILED})
+            invalidate_feed()
+        else:
+            delay = self.retry_seconds * 2 ** (attempts - 1)
+            print(f"   [{self.name}] Post {post_id} attempt {attempts} failed ({error!r}); retrying in {delay}s")
+            Post.objects.filter(pk=post_id, **{self.status_field: PENDING}).update(**{
+                self.due_field: timezone.now() + timedelta(seconds=delay),
+            })
+        return post
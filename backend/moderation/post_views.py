@@ -0,0 +1,173 @@
+"""
+Buffered post view counting.
+
+IncrementViewView used to load the post and `save()` the whole row for every
+impression. Concurrent views overwrote each other's `views += 1`. Each worker
+now adds up its views per post in memory. A background thread writes them
+every POST_VIEW_FLUSH_SECONDS as a single `F('views') + n` UPDATE for all
+changed posts. Workers only send their own deltas, so the writes add up.
+
+The count a client gets back is a running total in the shared cache. The
+first view of a post since the cache lost it seeds the total from the DB;
+after that, views don't touch the DB. The total can trail the DB by views
+another worker counted just before it was seeded, so it is approximate.
+
+With POST_VIEW_DEDUP_SECONDS, repeat views of a post by the same viewer
+within the window are not counted. Each worker remembers the (post, viewer)
+pairs it has seen in two rotating Bloom filters (this window and the last).
+Each holds DEDUP_CAPACITY views in about 350 KB. A false positive drops
+roughly one view in a thousand.
+"""
+import atexit
+import hashlib
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Case, F, IntegerField, Value, When
+
+from .models import Post
+
+
+DEFAULT_FLUSH_SECONDS = 5
+DEFAULT_DEDUP_SECONDS = 30 * 60
+# Views remembered per window before the false positive rate passes ~0.1%
+DEDUP_CAPACITY = 200_000
+# Long enough to outlive the flush interval many times over; reseeded from the DB when gone
+TOTAL_TTL = 24 * 60 * 60
+
+
+class BloomFilter:
+    def __init__(self, capacity, hashes=10):
+        # ~14.4 bits per item for 0.1% at the optimal hash count
+        self.size = capacity * 144 // 10
+        self.hashes = hashes
+        self.bits = bytearray(self.size // 8 + 1)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], 'little')
+        b = int.from_bytes(digest[8:], 'little') | 1
+        return [(a + i * b) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        """Add `item`; True if it was (probably) already there"""
+        seen = True
+        for position in self._positions(item):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                seen = False
+                self.bits[byte] |= 1 << bit
+        return seen
+
+    def __contains__(self, item):
+        return all(self.bits[p // 8] & (1 << (p % 8)) for p in self._positions(item))
+
+
+class ViewCounter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # post id -> views counted since the last flush
+        self.deltas = Counter()
+        self.current = self.previous = None
+        self.window_started = 0.0
+        self.thread = None
+        self.exit_hooked = False
+
+    def _cache(self):
+        return caches[getattr(settings, 'POST_VIEW_CACHE', 'default')]
+
+    @staticmethod
+    def total_key(post_id):
+        return f'post_views:{post_id}'
+
+    def start(self):
+        """Start the flush thread once per process"""
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.flush_seconds = getattr(settings, 'POST_VIEW_FLUSH_SECONDS', DEFAULT_FLUSH_SECONDS)
+            self.thread = threading.Thread(target=self._run, name='post-view-flush', daemon=True)
+            self.thread.start()
+            if not self.exit_hooked:
+                # Don't lose the last interval's views on a graceful shutdown
+                atexit.register(self.flush)
+                self.exit_hooked = True
+
+    def _seen(self, post_id, viewer_id):
+        window = getattr(settings, 'POST_VIEW_DEDUP_SECONDS', DEFAULT_DEDUP_SECONDS)
+        if not window or not viewer_id:
+            return False
+        now = time.monotonic()
+        if self.current is None or now - self.window_started >= window:
+            # Anything seen less than one window ago is in one of the two filters
+            self.previous = self.current
+            self.current = BloomFilter(DEDUP_CAPACITY)
+            self.window_started = now
+        key = f'{post_id}:{viewer_id}'
+        if self.previous is not None and key in self.previous:
+            self.current.add(key)
+            return True
+        return self.current.add(key)
+
+    def record(self, post_id, viewer_id=None):
+        """Count one view; returns the approximate total, or None if the post doesn't exist"""
+        self.start()
+        with self.lock:
+            counted = not self._seen(post_id, viewer_id)
+            if counted:
+                self.deltas[post_id] += 1
+
+        cache = self._cache()
+        key = self.total_key(post_id)
+        if counted:
+            try:
+                # incr is atomic (INCR on Redis), unlike a get-then-set
+                return cache.incr(key)
+            except ValueError:
+                pass
+        total = cache.get(key)
+        if total is not None:
+            return total
+
+        stored = Post.objects.filter(pk=post_id).values_list('views', flat=True).first()
+        if stored is None:
+            with self.lock:
+                if counted:
+                    self.deltas[post_id] -= 1
+            return None
+        # Seed with this worker's unflushed views included; another worker may have seeded first
+        with self.lock:
+            pending = self.deltas[post_id]
+        cache.add(key, stored + pending, timeout=TOTAL_TTL)
+        return cache.get(key, stored + pending)
+
+    # ---- flushing ----
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+    def flush(self):
+        """Write the pending views of every post in one UPDATE"""
+        with self.lock:
+            deltas = {post_id: n for post_id, n in self.deltas.items() if n}
+            self.deltas = Counter()
+        if not deltas:
+            return
+        try:
+            Post.objects.filter(pk__in=deltas).update(views=F('views') + Case(
+                *[When(pk=post_id, then=Value(n)) for post_id, n in deltas.items()],
+                default=Value(0), output_field=IntegerField(),
+            ))
+        except Exception as e:
+            # Keep the views for the next flush
+            print(f"   [VIEWS] Flush failed: {e}")
+            with self.lock:
+                self.deltas.update(deltas)
+
+
+view_counter = ViewCounter()
@@ -0,0 +1,257 @@
+"""
+Near-duplicate matching of captions against confirmed rumors.
+
+`ConfirmedRumor` is matched exactly (on the normalized caption hash), so a
+copy with a word changed or an emoji added went to the API and community
+reporting again. This index keeps a MinHash signature for every confirmed
+rumor: NUM_PERM minimums over the caption's character SHINGLE-grams, 16 bits
+each (one-permutation, b-bit MinHash). The fraction of equal slots in two signatures
+estimates the Jaccard similarity of their shingle sets. Shingles barely
+notice a "not", so a caption that negates a rumor ("X does not cause Y")
+would look like a copy of it. Captions with an odd number of negations get
+every slot XORed with a constant, so they never share a band or a slot
+value with captions of the other polarity. Signatures are
+split into BANDS bands of ROWS slots. Captions that share any band land in
+the same bucket and become candidates, so a lookup costs BANDS dict hits
+plus a few comparisons, however many rumors there are. A candidate matches
+when its estimated similarity reaches RUMOR_MATCH_THRESHOLD.
+
+Each process loads the index on its first lookup. Signatures are appended
+to RUMOR_INDEX_PATH (136 bytes per rumor), so startup reads the file
+instead of re-shingling every caption. Rumors confirmed in this process are
+added immediately. Rows added by other processes (or while the file was
+missing) are picked up with one `pk > last seen` query every
+RUMOR_INDEX_REFRESH_SECONDS. Rumors deleted in the admin keep matching until
+the file is removed and the index rebuilt.
+"""
+import hashlib
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+
+from django.conf import settings
+
+from .models import ConfirmedRumor
+from .rumors import normalize_caption
+
+
+# 2: signatures of negated captions are flipped
+FORMAT_VERSION = 2
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE = 5
+DEFAULT_THRESHOLD = 0.7
+DEFAULT_REFRESH_SECONDS = 30
+
+_VALUE_BITS = 64 - (NUM_PERM.bit_length() - 1)
+_VALUE_MASK = (1 << _VALUE_BITS) - 1
+# Odd, so borrowed values differ from the slot they were borrowed from
+_DENSIFY_OFFSET = 0x9E37
+_NEGATION_MASK = 0xA5A5
+_NEGATION = re.compile(
+    r"\b(?:not|no|never|nobody|nothing|none|neither|nor|cannot|without)\b|n['’]t\b"
+    r"|\b(?:dont|doesnt|didnt|isnt|arent|wasnt|werent|cant|wont|hasnt|havent|hadnt|shouldnt|wouldnt|couldnt)\b"
+)
+_HEADER = struct.Struct('<4sHHH')
+_RECORD = struct.Struct(f'<Q{NUM_PERM}H')
+
+
+def shingles(text):
+    normalized = normalize_caption(text)
+    if len(normalized) <= SHINGLE:
+        grams = {normalized} if normalized else set()
+    else:
+        grams = {normalized[i:i + SHINGLE] for i in range(len(normalized) - SHINGLE + 1)}
+    return [int.from_bytes(hashlib.blake2b(g.encode(), digest_size=8).digest(), 'little') for g in grams]
+
+
+def is_negated(text):
+    """True when the caption contains an odd number of negations"""
+    return len(_NEGATION.findall((text or '').casefold())) % 2 == 1
+
+
+def signature(text):
+    """
+    b-bit MinHash signature of `text`, or None if it has no shingles.
+
+    One-permutation hashing: each shingle is hashed once, its top 6 bits pick
+    a slot and the slot keeps the smallest remaining value. That is one pass
+    over the shingles instead of one per slot. Slots no shingle fell into
+    borrow the next filled slot's value, offset by the distance ("rotation"
+    densification), so short captions still compare slot by slot.
+    """
+    hashes = shingles(text)
+    if not hashes:
+        return None
+    slots = [None] * NUM_PERM
+    for h in hashes:
+        slot, value = h >> _VALUE_BITS, h & _VALUE_MASK
+        if slots[slot] is None or value < slots[slot]:
+            slots[slot] = value
+    filled = [i for i, value in enumerate(slots) if value is not None]
+    sig = array('H', bytes(2 * NUM_PERM))
+    nearest = filled[-1]
+    for i in range(NUM_PERM - 1, -1, -1):
+        if slots[i] is not None:
+            nearest = i
+        distance = (nearest - i) % NUM_PERM
+        sig[i] = (slots[nearest] + distance * _DENSIFY_OFFSET) & 0xFFFF
+    if is_negated(text):
+        for i in range(NUM_PERM):
+            sig[i] ^= _NEGATION_MASK
+    return sig
+
+
+def _band_keys(sig):
+    keys = []
+    for band in range(BANDS):
+        key = 0
+        for value in sig[band * ROWS:(band + 1) * ROWS]:
+            key = (key << 16) | value
+        keys.append(key)
+    return keys
+
+
+def similarity(a, b):
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+
+class RumorIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything; the next lookup loads from the file and the DB again"""
+        self.signatures = {}
+        self.buckets = [{} for _ in range(BANDS)]
+        self.last_id = 0
+        self.loaded = False
+        self.synced_at = 0.0
+
+    @property
+    def path(self):
+        return getattr(settings, 'RUMOR_INDEX_PATH', None)
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def _insert(self, rumor_id, sig):
+        if rumor_id in self.signatures:
+            return
+        self.signatures[rumor_id] = sig
+        for band, key in enumerate(_band_keys(sig)):
+            self.buckets[band].setdefault(key, []).append(rumor_id)
+        self.last_id = max(self.last_id, rumor_id)
+
+    def match(self, text):
+        """(rumor id, similarity) of the closest confirmed rumor above the threshold, or None"""
+        self._ensure_current()
+        sig = signature(text)
+        if sig is None:
+            return None
+        threshold = getattr(settings, 'RUMOR_MATCH_THRESHOLD', DEFAULT_THRESHOLD)
+        best = None
+        seen = set()
+        for band, key in enumerate(_band_keys(sig)):
+            for rumor_id in self.buckets[band].get(key, ()):
+                if rumor_id in seen:
+                    continue
+                seen.add(rumor_id)
+                score = similarity(sig, self.signatures[rumor_id])
+                if score >= threshold and (best is None or score > best[1]):
+                    best = (rumor_id, score)
+        return best
+
+    def add(self, rumor):
+        """Index a newly confirmed rumor right away"""
+        self._ensure_current()
+        sig = signature(rumor.caption_text)
+        if sig is None:
+            return
+        with self.lock:
+            if rumor.pk in self.signatures:
+                return
+            self._insert(rumor.pk, sig)
+            self._append([(rumor.pk, sig)])
+
+    # ---- loading and persistence ----
+
+    def _ensure_current(self):
+        refresh = getattr(settings, 'RUMOR_INDEX_REFRESH_SECONDS', DEFAULT_REFRESH_SECONDS)
+        if self.loaded and time.monotonic() - self.synced_at < refresh:
+            return
+        with self.lock:
+            if not self.loaded:
+                self._load_file()
+                if self.signatures and not ConfirmedRumor.objects.filter(pk=self.last_id).exists():
+                    # Written against another database (or its rumors were deleted)
+                    print(f"   [RUMORS] {self.path} doesn't match the database; rebuilding")
+                    self._discard_file()
+                self.loaded = True
+            elif time.monotonic() - self.synced_at < refresh:
+                return
+            self._catch_up()
+            self.synced_at = time.monotonic()
+
+    def _load_file(self):
+        path = self.path
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            print(f"   [RUMORS] Could not read {path}: {e}")
+            return
+        if len(data) < _HEADER.size or _HEADER.unpack_from(data) != (b'RIDX', FORMAT_VERSION, NUM_PERM, BANDS):
+            print(f"   [RUMORS] {path} was written with other parameters; rebuilding")
+            self._discard_file()
+            return
+        count, partial = divmod(len(data) - _HEADER.size, _RECORD.size)
+        if partial:
+            # Half-written record from a crash: cut it off before anything is appended after it
+            os.truncate(path, _HEADER.size + count * _RECORD.size)
+        for i in range(count):
+            rumor_id, *values = _RECORD.unpack_from(data, _HEADER.size + i * _RECORD.size)
+            self._insert(rumor_id, array('H', values))
+        print(f"   [RUMORS] Loaded {len(self.signatures)} rumor signature(s) from {path}")
+
+    def _discard_file(self):
+        self.signatures = {}
+        self.buckets = [{} for _ in range(BANDS)]
+        self.last_id = 0
+        try:
+            os.replace(self.path, f'{self.path}.old')
+        except OSError:
+            pass
+
+    def _catch_up(self):
+        added = []
+        rows = ConfirmedRumor.objects.filter(pk__gt=self.last_id).order_by('pk').values_list('pk', 'caption_text')
+        for rumor_id, caption in rows.iterator():
+            sig = signature(caption)
+            if sig is not None and rumor_id not in self.signatures:
+                self._insert(rumor_id, sig)
+                added.append((rumor_id, sig))
+        self._append(added)
+
+    def _append(self, records):
+        path = self.path
+        if not path or not records:
+            return
+        try:
+            with open(path, 'ab') as f:
+                if f.tell() == 0:
+                    f.write(_HEADER.pack(b'RIDX', FORMAT_VERSION, NUM_PERM, BANDS))
+                # One write per batch; other processes may append the same rumors, loading dedupes them
+                f.write(b''.join(_RECORD.pack(rumor_id, *sig) for rumor_id, sig in records))
+        except OSError as e:
+            print(f"   [RUMORS] Could not save signatures to {path}: {e}")
+
+
+rumor_index = RumorIndex()
@@ -0,0 +1,114 @@
+"""
+Layered fact check for post captions.
+
+Checks run cheapest first, and the API is only called when the first two
+layers don't know the caption:
+
+1. Confirmed rumors. Captions close to a `ConfirmedRumor` (written when
+   the community flags a post) are found in the in-memory MinHash index
+   (moderation.rumor_index). Rows the index hasn't synced yet are looked up
+   by the hash of the normalized caption. Either way a repost is flagged
+   at once.
+2. Earlier verdicts. API answers, "correct" ones included, are cached by
+   the same hash for FACT_CHECK_CACHE_SECONDS.
+3. The fact check API. Failures are not cached, so the next post with the
+   same caption tries the API again.
+"""
+import hashlib
+import os
+import re
+import unicodedata
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from .ai_detector import is_factually_correct, is_factually_correct_async
+from .models import ConfirmedRumor
+
+
+DEFAULT_CACHE_SECONDS = 6 * 60 * 60
+CONFIRMED_RUMOR_REASON = "Flags: This content matches a post the community confirmed as misinformation."
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize_caption(text):
+    """Caption with case, punctuation and spacing folded away"""
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    return ' '.join(_NON_WORD.sub(' ', text).split())
+
+
+def caption_hash(text):
+    return hashlib.sha256(normalize_caption(text).encode()).hexdigest()
+
+
+def _cache():
+    return caches[getattr(settings, 'FACT_CHECK_CACHE', 'default')]
+
+
+def _verdict_key(digest):
+    return f'fact_check:{digest}'
+
+
+def _is_confirmed(digest):
+    return ConfirmedRumor.objects.filter(caption_hash=digest).exists()
+
+
+def _known_verdict(text):
+    """(digest, verdict or None) from the first two layers"""
+    from .rumor_index import rumor_index
+    digest = caption_hash(text)
+    # Near-duplicates from memory first; the DB lookup covers rumors the index hasn't synced yet
+    if rumor_index.match(text) or _is_confirmed(digest):
+        return digest, (False, CONFIRMED_RUMOR_REASON)
+    verdict = _cache().get(_verdict_key(digest))
+    return digest, tuple(verdict) if verdict is not None else None
+
+
+def _remember(digest, verdict):
+    # Without a key the API isn't asked at all; don't pin that "correct" for hours
+    if os.getenv('GOOGLE_FACT_CHECK_API_KEY'):
+        _cache().set(_verdict_key(digest), verdict, getattr(settings, 'FACT_CHECK_CACHE_SECONDS', DEFAULT_CACHE_SECONDS))
+
+
+def check_caption(text):
+    """`is_factually_correct` behind the confirmed rumor index and verdict cache"""
+    if not normalize_caption(text):
+        return True, ""
+    digest, verdict = _known_verdict(text)
+    if verdict is not None:
+        return verdict
+    try:
+        verdict = is_factually_correct(text, raise_errors=True)
+    except Exception:
+        # Same as before: an unreachable API lets the text through, but isn't cached
+        return True, ""
+    _remember(digest, verdict)
+    return verdict
+
+
+async def check_caption_async(text, raise_errors=False, **api_kwargs):
+    """Async `check_caption`; with raise_errors, API failures raise so the caller can retry"""
+    if not normalize_caption(text):
+        return True, ""
+    digest, verdict = await database_sync_to_async(_known_verdict)(text)
+    if verdict is not None:
+        return verdict
+    try:
+        verdict = await is_factually_correct_async(text, raise_errors=True, **api_kwargs)
+    except Exception:
+        if raise_errors:
+            raise
+        return True, ""
+    await sync_to_async(_remember, thread_sensitive=False)(digest, verdict)
+    return verdict
+
+
+def confirm_rumor(caption):
+    """Record a caption as confirmed misinformation; later copies are flagged without the API"""
+    from .rumor_index import rumor_index
+    rumor, _ = ConfirmedRumor.objects.get_or_create(caption_text=caption)
+    rumor_index.add(rumor)
+    return rumor
@@ -29,15 +29,19 @@ class ToxicityLogSerializer(serializers.ModelSerializer):
 class PostSerializer(serializers.ModelSerializer):
     username = serializers.CharField() # Now writable or passed in
     user_id = serializers.CharField()
-    likes_count = serializers.IntegerField(read_only=True)
     is_liked = serializers.SerializerMethodField()
 
     class Meta:
         model = Post
-        fields = ['id', 'user_id', 'username', 'image', 'caption', 'created_at', 'likes_count', 'views', 'is_liked', 'is_rumor', 'rumor_reason']
-        read_only_fields = ['views', 'likes_count', 'is_rumor', 'rumor_reason']
+        fields = ['id', 'user_id', 'username', 'image', 'caption', 'created_at', 'likes_count', 'views', 'is_liked', 'is_rumor', 'rumor_reason', 'fact_check_status',
+                  'is_ai_generated', 'ai_image_score', 'ai_image_status', 'image_thumb', 'image_feed', 'image_variants_status']
+        read_only_fields = ['views', 'likes_count', 'is_rumor', 'rumor_reason', 'fact_check_status',
+                            'is_ai_generated', 'ai_image_score', 'ai_image_status', 'image_thumb', 'image_feed',
+                            'image_variants_status']
 
     def get_is_liked(self, obj):
+        if hasattr(obj, 'viewer_liked'):
+            return obj.viewer_liked
         request = self.context.get('request')
         user_id = None
         if request and request.query_params.get('user_id'):
@@ -1,3 +1,967 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import importlib
+import os
+import tempfile
+import time
+from io import BytesIO, StringIO
 
-# Create your tests here.
+import httpx
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.apps import apps as django_apps
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from PIL import Image, PngImagePlugin
+from datetime import timedelta
+from unittest import mock
+
+from chat.models import Stream
+from chat.routing import websocket_urlpatterns
+from . import expiry, feed, image_checks
+from .expiry import ExpiryScheduler, TIMEOUT
+from .fact_check import FactCheckQueue
+from .image_checks import URL_NOT_ALLOWED, ImageCheckQueue, detect_image_bytes, detect_image_url
+from .image_render import render_variants, strip_metadata
+from .image_variants import ImageVariantQueue
+from .identity import SpeechIdentity
+from .ledger import ViolationLedger
+from .models import ConfirmedRumor, Post, PostLike, PostReportCounter, Restriction, SpeechViolation, StreamTimeout
+from .pipeline import is_chat_restricted, pipeline_metrics
+from .rumor_index import rumor_index
+from .rumors import CONFIRMED_RUMOR_REASON, caption_hash, check_caption, check_caption_async, confirm_rumor
+from .post_views import BloomFilter, view_counter
+from .timeout_index import TIMEOUT_GROUP, TimeoutIndex, timeout_index
+from .transcripts import TranscriptCoalescer, TranscriptTracker
+
+
+class SpeechIdentityTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='speaker')
+        self.stream = Stream.objects.create(streamer=self.user, title='Live')
+
+    def test_known_user_and_stream_use_foreign_keys(self):
+        identity = SpeechIdentity.resolve(self.user.id, self.stream.id)
+        self.assertEqual(identity.filter, {'user': self.user, 'stream': self.stream})
+        self.assertIsNone(identity.create_kwargs()['user_identifier'])
+
+    def test_ephemeral_ids_use_identifier_fields(self):
+        identity = SpeechIdentity.resolve('guest-abc', 'room-1')
+        self.assertEqual(identity.filter, {'user_identifier': 'guest-abc', 'stream_identifier': 'room-1'})
+        SpeechViolation.objects.create(**identity.create_kwargs(), transcript='x', toxicity_score=1,
+                                       violation_type='warning')
+        self.assertEqual(SpeechViolation.objects.filter(**identity.filter).count(), 1)
+
+
+class ViolationLedgerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.identity = SpeechIdentity.resolve('guest-abc', 'room-1')
+        for _ in range(2):
+            SpeechViolation.objects.create(**self.identity.create_kwargs(), transcript='x', toxicity_score=1,
+                                           violation_type='warning')
+
+    async def _increment_concurrently(self, ledgers):
+        for ledger in ledgers:
+            await ledger.seed()
+        return await asyncio.gather(*(ledger.increment() for ledger in ledgers))
+
+    def test_seeded_from_db_and_numbers_are_unique(self):
+        # Two connections for the same user and stream share one counter
+        ledgers = [ViolationLedger(self.identity), ViolationLedger(self.identity)]
+        numbers = async_to_sync(self._increment_concurrently)(ledgers)
+        self.assertEqual(sorted(numbers), [3, 4])
+
+    def test_reseeds_after_eviction(self):
+        ledger = ViolationLedger(self.identity)
+        async_to_sync(ledger.seed)()
+        cache.delete(ledger.key)
+        self.assertEqual(async_to_sync(ledger.increment)(), 3)
+
+
+class TranscriptTrackerTests(TestCase):
+    def _moderate(self, tracker, utterance_id, transcript, is_final=False, toxic=False):
+        segment = tracker.segment(utterance_id, transcript, is_final)
+        if segment is not None:
+            tracker.commit(segment, flagged=toxic)
+        return segment and segment.text
+
+    def test_only_new_words_and_overlap_are_moderated(self):
+        tracker = TranscriptTracker(overlap_words=2)
+        self.assertEqual(self._moderate(tracker, 'u1', 'you are a'), 'you are a')
+        self.assertEqual(self._moderate(tracker, 'u1', 'you are a complete'), 'are a complete')
+        self.assertIsNone(self._moderate(tracker, 'u1', 'you are a complete'))
+        # A revised word invalidates everything moderated after it
+        self.assertEqual(self._moderate(tracker, 'u1', 'you were a complete idiot'), 'you were a complete idiot')
+        self.assertEqual(self._moderate(tracker, 'u1', 'you were a complete idiot', is_final=True), None)
+        self.assertNotIn('u1', tracker.utterances)
+
+    def test_flagged_words_are_not_reused_as_overlap(self):
+        tracker = TranscriptTracker(overlap_words=3)
+        self._moderate(tracker, 'u1', 'i will kill you', toxic=True)
+        self.assertEqual(self._moderate(tracker, 'u1', 'i will kill you tomorrow', is_final=True), 'tomorrow')
+
+    def test_commit_returns_the_whole_utterance_masked(self):
+        tracker = TranscriptTracker(overlap_words=2)
+        segment = tracker.segment('u1', 'well damn that', False)
+        self.assertEqual(tracker.commit(segment, masked_text='well d*** that'), 'well d*** that')
+        # "damn" is in the overlap and this pass doesn't mask it; it stays masked anyway
+        segment = tracker.segment('u1', 'well damn that hurt', False)
+        self.assertEqual(segment.text, 'damn that hurt')
+        self.assertEqual(tracker.commit(segment, masked_text='damn that hurt'), 'well d*** that hurt')
+        # A revision before the masked word drops the stale masking with it
+        segment = tracker.segment('u1', 'oh well', True)
+        self.assertEqual(tracker.commit(segment, masked_text='oh well'), 'oh well')
+
+
+class TranscriptCoalescerTests(TestCase):
+    def test_superseded_versions_are_dropped(self):
+        self.assertEqual(asyncio.run(self._submit_burst()), [
+            ('u1', 'i will kill you now', True),
+            (None, 'hello', True),
+            ('u2', 'and then', False),
+        ])
+
+    async def _submit_burst(self):
+        handled = []
+
+        async def handler(*args):
+            handled.append(args)
+
+        coalescer = TranscriptCoalescer(handler, window_ms=50)
+        await coalescer.submit('u1', 'i will', False)
+        await coalescer.submit(None, 'hello', True)
+        await coalescer.submit(None, 'hello', True)
+        await coalescer.submit('u1', 'i will kill you now', True)
+        # A late interim must not replace the final it belongs to
+        await coalescer.submit('u1', 'i will kill', False)
+        await coalescer.submit('u2', 'and then', False)
+        await asyncio.sleep(0.2)
+        self.assertEqual(coalescer.superseded, 3)
+        self.assertIsNone(coalescer.task)
+        return handled
+
+
+class SpeechModerationConsumerTests(TransactionTestCase):
+    def test_escalates_warning_timeout_and_stream_stop(self):
+        user = get_user_model().objects.create(username='speaker')
+        stream = Stream.objects.create(streamer=user, title='Live')
+        asyncio.run(self._speak_three_times(user.id, stream.id))
+
+        violations = SpeechViolation.objects.filter(user=user, stream=stream)
+        self.assertEqual(sorted(violations.values_list('violation_type', flat=True)),
+                         ['stream_stop', 'timeout', 'warning'])
+        self.assertTrue(StreamTimeout.objects.filter(user=user, stream=stream).exists())
+        stream.refresh_from_db()
+        self.assertEqual(stream.status, 'ended')
+
+    async def _speak_three_times(self, user_id, stream_id):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/speech/{stream_id}/{user_id}/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        expected = ['speech_warning', 'speech_timeout', 'stream_stopped']
+        for action in expected:
+            if action == 'stream_stopped':
+                # Expire the timeout so the third utterance is moderated, not ignored
+                await self._expire_timeouts((str(user_id), str(stream_id)))
+            await communicator.send_json_to({'type': 'speech_transcript', 'transcript': 'i will kill you'})
+            self.assertEqual((await communicator.receive_json_from(timeout=5))['type'], 'speech_toxic')
+            self.assertEqual((await communicator.receive_json_from(timeout=5))['type'], action)
+        await communicator.disconnect()
+
+    @override_settings(SPEECH_TRANSCRIPT_COALESCE_MS=0)
+    def test_interim_updates_warn_once_per_utterance(self):
+        asyncio.run(self._speak_interim('guest-abc', 'room-1'))
+        self.assertEqual(SpeechViolation.objects.filter(user_identifier='guest-abc').count(), 1)
+
+    async def _speak_interim(self, user_id, stream_id):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/speech/{stream_id}/{user_id}/')
+        await communicator.connect()
+        for transcript, is_final in [('you fucking idiot', False), ('you fucking idiot ok', False),
+                                     ('you fucking idiot ok', True)]:
+            await communicator.send_json_to({'type': 'speech_transcript', 'transcript': transcript,
+                                             'utterance_id': '1-0', 'is_final': is_final})
+        toxic = await communicator.receive_json_from(timeout=5)
+        self.assertEqual((toxic['type'], toxic['transcript']), ('speech_toxic', 'you f****** idiot'))
+        self.assertEqual((await communicator.receive_json_from(timeout=5))['type'], 'speech_warning')
+        # Only "ok" was new and it is clean, but the reply still shows the earlier words masked
+        clean = await communicator.receive_json_from(timeout=5)
+        self.assertEqual((clean['type'], clean['transcript']), ('speech_clean', 'you f****** idiot ok'))
+        # The final version added no words, so nothing else is sent
+        self.assertTrue(await communicator.receive_nothing(timeout=0.5))
+        await communicator.disconnect()
+
+    async def _expire_timeouts(self, key):
+        from channels.db import database_sync_to_async
+        self.assertTrue(timeout_index.is_timed_out(key))
+        await database_sync_to_async(StreamTimeout.objects.update)(is_active=False)
+        timeout_index.discard(key)
+
+
+class ExpirySchedulerTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create(username='muted')
+        soon = timezone.now() + timedelta(milliseconds=300)
+        self.timeout = StreamTimeout.objects.create(
+            user_identifier='guest-abc', stream_identifier='room-1', reason='test', expires_at=soon,
+        )
+        self.restriction = Restriction.objects.create(user=self.user, reason='test', expires_at=soon)
+        self.permanent = Restriction.objects.create(user=self.user, reason='test', is_permanent=True,
+                                                    expires_at=soon)
+
+    def test_rebuilds_from_db_deactivates_and_broadcasts(self):
+        events = asyncio.run(self._run_scheduler())
+
+        self.assertEqual({e['type'] for e in events}, {'timeout_expired_notification', 'restriction_expired'})
+        self.timeout.refresh_from_db()
+        self.restriction.refresh_from_db()
+        self.permanent.refresh_from_db()
+        self.assertFalse(self.timeout.is_active)
+        self.assertFalse(self.restriction.is_active)
+        self.assertTrue(self.permanent.is_active)
+
+    async def _run_scheduler(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add('speech_moderation_room-1', channel)
+        await layer.group_add('global_chat', channel)
+
+        # Started before the rows are due, so they must come from the startup rebuild
+        scheduler = ExpiryScheduler()
+        scheduler.start()
+        events = [await asyncio.wait_for(layer.receive(channel), 5) for _ in range(2)]
+        scheduler.task.cancel()
+        return events
+
+    def test_restrictions_created_by_the_view_are_scheduled_right_away(self):
+        Restriction.objects.all().delete()
+        target = get_user_model().objects.create(username='target')
+        self.assertEqual(asyncio.run(self._restrict_through_view(target)), target.pk)
+        self.assertFalse(Restriction.objects.get(user=target).is_active)
+
+    async def _restrict_through_view(self, target):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add('global_chat', channel)
+
+        scheduler = ExpiryScheduler()
+        # Only `schedule` can bring the new row in after the startup rebuild
+        scheduler.resync_seconds = 3600
+        resynced = asyncio.Event()
+        resync = scheduler._resync
+
+        async def first_resync():
+            await resync()
+            resynced.set()
+
+        scheduler._resync = first_resync
+        scheduler.start()
+        await resynced.wait()
+
+        expires_at = timezone.now() + timedelta(milliseconds=300)
+        with mock.patch('moderation.views.expiry_scheduler', scheduler):
+            response = await sync_to_async(self.client.post)(
+                '/api/moderation/restrict/', {'user_id': target.pk, 'expires_at': expires_at.isoformat()},
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 201)
+        event = await asyncio.wait_for(layer.receive(channel), 5)
+        scheduler.task.cancel()
+        return event['user_id']
+
+    def test_scheduler_survives_errors(self):
+        class FlakyScheduler(ExpiryScheduler):
+            failures = 1
+
+            def _pop_due(self, now):
+                if self.failures:
+                    self.failures -= 1
+                    raise RuntimeError('unexpected')
+                return super()._pop_due(now)
+
+        async def run():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add('global_chat', channel)
+            scheduler = FlakyScheduler()
+            scheduler.start()
+            # The first pass fails and the task backs off; the next one announces the restriction
+            event = await asyncio.wait_for(layer.receive(channel), 5)
+            alive = not scheduler.task.done()
+            scheduler.task.cancel()
+            return event, alive
+
+        # With the cache down every worker announces it rather than none
+        with mock.patch.object(expiry, 'BACKOFF_MAX_SECONDS', 0.1), \
+                mock.patch.object(expiry.cache, 'aadd', side_effect=ConnectionError('cache down')):
+            event, alive = asyncio.run(run())
+        self.assertEqual(event['type'], 'restriction_expired')
+        self.assertTrue(alive)
+
+    def test_lapsed_restriction_does_not_block_chat_before_the_scheduler_runs(self):
+        self.restriction.expires_at = timezone.now() - timedelta(minutes=1)
+        self.restriction.save()
+        self.permanent.delete()
+        self.assertTrue(Restriction.objects.get(pk=self.restriction.pk).is_active)
+        self.assertFalse(async_to_sync(is_chat_restricted)(self.user.pk))
+
+        Restriction.objects.create(user=self.user, reason='test', expires_at=timezone.now() + timedelta(hours=1))
+        self.assertTrue(async_to_sync(is_chat_restricted)(self.user.pk))
+
+    def test_migration_deactivates_restrictions_that_already_ran_out(self):
+        self.restriction.expires_at = timezone.now() - timedelta(minutes=1)
+        self.restriction.save()
+        migration = importlib.import_module('moderation.migrations.0015_deactivate_expired_restrictions')
+        migration.deactivate_expired(django_apps, None)
+        self.restriction.refresh_from_db()
+        self.permanent.refresh_from_db()
+        self.assertFalse(self.restriction.is_active)
+        self.assertTrue(self.permanent.is_active)
+
+    def test_rescheduled_deadline_replaces_old_entry(self):
+        scheduler = ExpiryScheduler()
+        later = timezone.now() + timedelta(hours=1)
+        scheduler.schedule(TIMEOUT, self.timeout.pk, self.timeout.expires_at)
+        scheduler.schedule(TIMEOUT, self.timeout.pk, later)
+        self.assertIsNone(scheduler._pop_due(self.timeout.expires_at.timestamp() + 1))
+        self.assertEqual(scheduler._pop_due(later.timestamp())[TIMEOUT], [self.timeout.pk])
+
+
+class TimeoutIndexTests(TransactionTestCase):
+    def test_loads_from_db_and_follows_channel_layer_events(self):
+        StreamTimeout.objects.create(user_identifier='guest-abc', stream_identifier='room-1', reason='test',
+                                     expires_at=timezone.now() + timedelta(minutes=5))
+        StreamTimeout.objects.create(user_identifier='guest-old', stream_identifier='room-1', reason='test',
+                                     expires_at=timezone.now() - timedelta(minutes=5))
+        asyncio.run(self._exercise_index())
+
+    async def _exercise_index(self):
+        index = TimeoutIndex()
+        await index.start()
+        self.assertTrue(index.is_timed_out(('guest-abc', 'room-1')))
+        self.assertFalse(index.is_timed_out(('guest-old', 'room-1')))
+
+        # Another worker issues a timeout, then the expiry scheduler ends it
+        layer = get_channel_layer()
+        expires = (timezone.now() + timedelta(minutes=1)).timestamp()
+        await layer.group_send(TIMEOUT_GROUP, {'type': 'timeout.issued', 'key': ['7', '3'], 'expires_at': expires})
+        await asyncio.sleep(0.1)
+        self.assertTrue(index.is_timed_out(('7', '3')))
+        await layer.group_send(TIMEOUT_GROUP, {'type': 'timeout.expired', 'key': ['7', '3'], 'expires_at': expires})
+        await asyncio.sleep(0.1)
+        self.assertFalse(index.is_timed_out(('7', '3')))
+        index.task.cancel()
+
+
+class ChatPipelineTests(TransactionTestCase):
+    def test_warns_then_restricts_and_records_stage_timings(self):
+        user = get_user_model().objects.create(username='chatter')
+        replies = asyncio.run(self._chat(user))
+
+        self.assertEqual(replies, ['warning', 'warning', 'restriction'])
+        self.assertTrue(Restriction.objects.filter(user=user, restriction_type='chat', is_active=True).exists())
+        user.refresh_from_db()
+        self.assertEqual(user.messages_sent, 3)
+        self.assertGreaterEqual(pipeline_metrics()['chat']['detect']['items'], 3)
+
+    async def _chat(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/')
+        await communicator.connect()
+        self.assertEqual((await communicator.receive_json_from(timeout=5))['type'], 'message_history')
+        replies = []
+        for _ in range(3):
+            await communicator.send_json_to({'type': 'chat_message', 'username': user.username,
+                                             'user_id': user.id, 'message': 'i will kill you'})
+            while True:
+                frame = await communicator.receive_json_from(timeout=5)
+                if frame['type'] == 'new_message':
+                    # Broadcast back to the room masked and flagged
+                    self.assertTrue(frame['message']['is_flagged'])
+                    self.assertNotIn('kill', frame['message']['text'])
+                    continue
+                replies.append(frame['type'])
+                break
+            # Keep under the per-user rate limit
+            await asyncio.sleep(0.4)
+        await communicator.disconnect()
+        return replies
+
+
+class PostFeedTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        for n in range(5):
+            post = Post.objects.create(user_id=str(n), username=f'user{n}', caption=f'post {n}')
+            for liker in range(n):
+                PostLike.objects.create(post=post, user_id=str(liker))
+            Post.objects.filter(pk=post.pk).update(likes_count=n)
+
+    def test_feed_query_count_does_not_grow_with_posts(self):
+        cursor = feed.encode_cursor(Post.objects.latest('id'))
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/moderation/', {'cursor': cursor, 'user_id': '0'})
+        self.assertEqual(len(response.json()['results']), 4)
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/moderation/', {'user_id': '0'})
+        posts = {post['caption']: post for post in response.json()['results']}
+        self.assertEqual(posts['post 3']['likes_count'], 3)
+        self.assertTrue(posts['post 3']['is_liked'])
+        self.assertFalse(posts['post 0']['is_liked'])
+
+    @override_settings(POST_FEED_PAGE_SIZE=2)
+    def test_cursor_pages_cover_every_post_once(self):
+        captions = []
+        params = {}
+        while True:
+            page = self.client.get('/api/moderation/', params).json()
+            captions += [post['caption'] for post in page['results']]
+            if not page['next']:
+                break
+            params = {'cursor': page['next']}
+        self.assertEqual(captions, [f'post {n}' for n in range(4, -1, -1)])
+        self.assertEqual(self.client.get('/api/moderation/', {'cursor': '!!'}).status_code, 400)
+
+    def test_first_page_is_cached_per_generation_and_merges_is_liked(self):
+        self.client.get('/api/moderation/')
+        # Cached: only the viewer's likes are looked up
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/moderation/', {'user_id': '1'})
+        liked = {post['caption'] for post in response.json()['results'] if post['is_liked']}
+        self.assertEqual(liked, {'post 2', 'post 3', 'post 4'})
+
+        Post.objects.create(user_id='9', username='user9', caption='fresh')
+        self.assertNotIn('fresh', [post['caption'] for post in self.client.get('/api/moderation/').json()['results']])
+        feed.invalidate_feed()
+        self.assertEqual(self.client.get('/api/moderation/').json()['results'][0]['caption'], 'fresh')
+
+
+class PostLikeCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.post = Post.objects.create(user_id='1', username='user1', caption='hello')
+
+    def like(self, user_id):
+        return self.client.post(f'/api/moderation/{self.post.pk}/like/', {'user_id': user_id}).json()
+
+    def test_toggle_keeps_count_in_step(self):
+        self.assertEqual(self.like('a'), {'liked': True, 'likes_count': 1})
+        self.assertEqual(self.like('b'), {'liked': True, 'likes_count': 2})
+        self.assertEqual(self.like('a'), {'liked': False, 'likes_count': 1})
+        self.assertEqual(PostLike.objects.filter(post=self.post).count(), 1)
+
+    def test_reconcile_fixes_drift_in_batches(self):
+        other = Post.objects.create(user_id='2', username='user2', caption='other')
+        PostLike.objects.create(post=self.post, user_id='a')
+        PostLike.objects.create(post=self.post, user_id='b')
+        Post.objects.filter(pk=other.pk).update(likes_count=5)
+
+        out = StringIO()
+        call_command('reconcile_like_counts', '--batch-size', '1', stdout=out)
+        self.assertIn('Checked 2 post(s); 2 fixed', out.getvalue())
+        self.assertEqual(
+            dict(Post.objects.values_list('pk', 'likes_count')),
+            {self.post.pk: 2, other.pk: 0},
+        )
+
+
+@override_settings(POST_VIEW_FLUSH_SECONDS=3600)
+class PostViewCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        view_counter.flush()
+        self.post = Post.objects.create(user_id='1', username='user1', caption='hello', views=10)
+
+    def view(self, user_id=None, pk=None):
+        data = {'user_id': user_id} if user_id else {}
+        return self.client.post(f'/api/moderation/{pk or self.post.pk}/view/', data)
+
+    def test_views_are_buffered_and_flushed_in_one_update(self):
+        other = Post.objects.create(user_id='2', username='user2', caption='other')
+        self.assertEqual(self.view('a').json(), {'views': 11})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.view('b').json(), {'views': 12})
+            self.view('b')  # repeat within the dedup window
+            self.assertEqual(self.view().json(), {'views': 13})
+        self.view('a', pk=other.pk)
+        self.assertEqual(Post.objects.get(pk=self.post.pk).views, 10)
+
+        with self.assertNumQueries(1):
+            view_counter.flush()
+        self.assertEqual(dict(Post.objects.values_list('pk', 'views')), {self.post.pk: 13, other.pk: 1})
+        self.assertEqual(self.view(pk=999999).status_code, 404)
+
+    def test_bloom_filter_remembers_what_it_saw(self):
+        seen = BloomFilter(1000)
+        self.assertFalse(seen.add('1:a'))
+        self.assertTrue(seen.add('1:a'))
+        self.assertIn('1:a', seen)
+        false_positives = sum(f'2:{n}' in seen for n in range(1000))
+        self.assertLess(false_positives, 10)
+
+
+@override_settings(FACT_CHECK_WORKERS=0, FACT_CHECK_MAX_ATTEMPTS=2, AI_IMAGE_CHECK_WORKERS=0, IMAGE_VARIANTS_WORKERS=0)
+class FactCheckQueueTests(TransactionTestCase):
+    def test_posts_are_saved_pending_and_checked_in_the_background(self):
+        response = self.client.post('/api/moderation/', {'user_id': '1', 'username': 'user1', 'caption': 'the moon is cheese'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['fact_check_status'], 'pending')
+        asyncio.run(self._check(response.json()['id']))
+
+    async def _check(self, post_id):
+        answers = [ConnectionError('API down'), (False, "Fact Check: rated 'false'")]
+
+        async def check(caption):
+            answer = answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        queue = FactCheckQueue(check=check)
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/posts/')
+        self.assertTrue((await communicator.connect())[0])
+
+        post = await queue.process(post_id)
+        self.assertEqual((post.fact_check_status, post.fact_check_attempts), ('pending', 1))
+        # Backing off: not due yet, so nothing is claimed
+        self.assertIsNone(await queue.process(post_id))
+        await database_sync_to_async(Post.objects.filter(pk=post_id).update)(fact_check_due_at=timezone.now())
+
+        post = await queue.process(post_id)
+        self.assertEqual((post.fact_check_status, post.is_rumor), ('checked', True))
+        event = await communicator.receive_json_from(timeout=5)
+        self.assertEqual((event['type'], event['event'], event['post']['id'], event['post']['is_rumor']),
+                         ('post_event', 'fact_checked', post_id, True))
+        await communicator.disconnect()
+
+    @override_settings(FACT_CHECK_WORKERS=1, AI_IMAGE_CHECK_WORKERS=0, IMAGE_VARIANTS_WORKERS=0)
+    def test_results_reach_consumers_from_the_queue_thread_right_away(self):
+        post = Post.objects.create(user_id='1', username='user1', caption='the moon is cheese')
+
+        async def check(caption):
+            return False, "Fact Check: rated 'false'"
+
+        queue = FactCheckQueue(check=check)
+        with mock.patch('moderation.post_consumer.fact_check_queue', queue):
+            asyncio.run(self._receive_from_thread(queue, post.pk))
+
+    async def _receive_from_thread(self, queue, post_id):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/posts/')
+        self.assertTrue((await communicator.connect())[0])
+        self.assertIs(queue.server_loop, asyncio.get_running_loop())
+
+        started = time.monotonic()
+        await database_sync_to_async(queue.submit)(post_id)
+        # Nothing else wakes this loop before the timeout; the send has to
+        event = await communicator.receive_json_from(timeout=10)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual((event['event'], event['post']['id'], event['post']['is_rumor']), ('fact_checked', post_id, True))
+        await communicator.disconnect()
+
+    def test_correct_verdict_keeps_a_flag_set_by_reports(self):
+        post = Post.objects.create(user_id='1', username='user1', caption='hello')
+
+        async def check(caption):
+            # Reported past the threshold while the check was running
+            await database_sync_to_async(Post.objects.filter(pk=post.pk).update)(is_rumor=True, rumor_reason='Reported')
+            return True, ''
+
+        post = asyncio.run(FactCheckQueue(check=check).process(post.pk))
+        self.assertEqual((post.fact_check_status, post.is_rumor, post.rumor_reason), ('checked', True, 'Reported'))
+
+    def test_gives_up_after_max_attempts(self):
+        post = Post.objects.create(user_id='1', username='user1', caption='hello')
+
+        async def check(caption):
+            raise TimeoutError
+
+        async def attempts():
+            queue = FactCheckQueue(check=check)
+            for _ in range(2):
+                await queue.process(post.pk)
+                await database_sync_to_async(Post.objects.filter(pk=post.pk).update)(fact_check_due_at=timezone.now())
+
+        asyncio.run(attempts())
+        post.refresh_from_db()
+        self.assertEqual((post.fact_check_status, post.fact_check_attempts, post.is_rumor), ('failed', 2, False))
+
+
+@override_settings(RUMOR_INDEX_PATH='')
+class RumorCheckTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        rumor_index.reset()
+
+    def test_hash_backfill_migration_does_not_follow_later_normalization(self):
+        rumor = ConfirmedRumor.objects.create(caption_text='The Moon is  CHEESE!')
+        migration = importlib.import_module('moderation.migrations.0011_confirmedrumor_caption_hash')
+        with mock.patch('moderation.rumors.normalize_caption', str.upper):
+            migration.hash_existing(django_apps, None)
+        rumor.refresh_from_db()
+        self.assertEqual(rumor.caption_hash, hashlib.sha256(b'the moon is cheese').hexdigest())
+
+    def test_confirmed_rumors_match_normalized_captions_without_the_api(self):
+        confirm_rumor('Drinking bleach cures the flu!')
+        self.assertEqual(ConfirmedRumor.objects.get().caption_hash, caption_hash('drinking  BLEACH cures the flu'))
+        # Found in the in-memory index
+        with self.assertNumQueries(0):
+            is_correct, reason = check_caption('DRINKING bleach, cures the flu')
+        self.assertFalse(is_correct)
+        self.assertEqual(reason, CONFIRMED_RUMOR_REASON)
+        # Not indexed yet (another worker's row): the hash lookup still finds it
+        ConfirmedRumor.objects.create(caption_text='Garlic stops 5G radiation')
+        with self.assertNumQueries(1):
+            self.assertEqual(check_caption('garlic stops 5g radiation!!'), (False, CONFIRMED_RUMOR_REASON))
+
+    def test_cached_verdicts_are_reused(self):
+        cache.set(f'fact_check:{caption_hash("the sky is green")}', (False, 'rated false'))
+        self.assertEqual(asyncio.run(check_caption_async('The sky is green.')), (False, 'rated false'))
+        self.assertEqual(check_caption(''), (True, ''))
+
+
+class RumorIndexTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'rumor_index.bin')
+        self.enterContext(override_settings(RUMOR_INDEX_PATH=self.path))
+        rumor_index.reset()
+        self.addCleanup(rumor_index.reset)
+        cache.clear()
+
+    def test_edited_copies_match_and_unrelated_captions_do_not(self):
+        rumor = confirm_rumor('BREAKING: drinking hot water with lemon every morning cures covid in 3 days, doctors confirm!')
+        edited = 'breaking - drinking hot water with lemon every morning cures covid in three days, doctors confirm'
+        self.assertEqual(rumor_index.match(edited)[0], rumor.pk)
+        self.assertIsNone(rumor_index.match('the weather is nice today in the city park'))
+        self.assertEqual(check_caption(edited), (False, CONFIRMED_RUMOR_REASON))
+
+    def test_negated_captions_do_not_match(self):
+        rumor = confirm_rumor('the election was stolen by voting machines in three states')
+        self.assertIsNone(rumor_index.match('the election was not stolen by voting machines in three states'))
+        self.assertIsNone(rumor_index.match("the election wasn't stolen by voting machines in three states"))
+        self.assertEqual(rumor_index.match('The election was stolen by voting machines in 3 states!')[0], rumor.pk)
+        # Negated rumors still match their own copies
+        denial = confirm_rumor('the moon landing never happened, it was filmed in a studio')
+        self.assertEqual(rumor_index.match('The moon landing NEVER happened - it was filmed in a studio!!')[0], denial.pk)
+
+    def test_signatures_are_reloaded_from_disk(self):
+        for n in range(3):
+            confirm_rumor(f'secret document number {n} proves the election was stolen by robots')
+        ConfirmedRumor.objects.create(caption_text='added by another worker: the ocean is made of soup')
+        size = os.path.getsize(self.path)
+
+        rumor_index.reset()
+        with self.assertNumQueries(2):
+            self.assertIsNotNone(rumor_index.match('secret document number 1 proves the election was stolen by robots!'))
+        self.assertEqual(len(rumor_index), 4)
+        self.assertIsNotNone(rumor_index.match('Added by another worker: the ocean is made of soup.'))
+        # Only the row the file was missing got appended
+        self.assertGreater(os.path.getsize(self.path), size)
+
+
+@override_settings(RUMOR_INDEX_PATH='')
+class PostReportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        rumor_index.reset()
+        self.post = Post.objects.create(user_id='1', username='user1', caption='aliens built the pyramids last week',
+                                        fact_check_status='checked')
+
+    def report(self, user_id, reason='Misinformation'):
+        return self.client.post(f'/api/moderation/{self.post.pk}/report/', {'user_id': user_id, 'reason': reason})
+
+    def test_threshold_flips_the_post_once_from_the_counter(self):
+        for n in range(9):
+            self.report(str(n))
+        self.report('x', reason='Spam')
+        self.post.refresh_from_db()
+        self.assertFalse(self.post.is_rumor)
+
+        self.assertEqual(self.report('9').status_code, 201)
+        self.post.refresh_from_db()
+        self.assertTrue(self.post.is_rumor)
+        self.assertTrue(ConfirmedRumor.objects.filter(caption_text=self.post.caption).exists())
+
+        # Past the threshold nothing is recounted or flipped again
+        Post.objects.filter(pk=self.post.pk).update(is_rumor=False)
+        with self.assertNumQueries(6):
+            self.report('10')
+        self.assertFalse(Post.objects.get(pk=self.post.pk).is_rumor)
+        self.assertEqual(
+            dict(PostReportCounter.objects.values_list('reason', 'count')),
+            {'Misinformation': 11, 'Spam': 1},
+        )
+
+
+def png_bytes(color='red', size=(8, 8)):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class FakeImageDetector:
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = 0
+
+    async def detect_async(self, client, image_url=None, content=None):
+        self.calls += 1
+        return self.results.pop(0)
+
+
+@override_settings(AI_IMAGE_CHECK_WORKERS=0, FACT_CHECK_WORKERS=0, IMAGE_VARIANTS_WORKERS=0)
+class ImageCheckTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=self.media.name))
+
+    def test_same_image_is_sent_to_the_api_once(self):
+        detector = FakeImageDetector({'is_ai_generated': True, 'score': 0.93}, {'is_ai_generated': False, 'score': 0.1})
+
+        async def check():
+            first = await detect_image_bytes(png_bytes(), detector)
+            again = await detect_image_bytes(png_bytes(), detector)
+            other = await detect_image_bytes(png_bytes('blue'), detector)
+            return first, again, other
+
+        first, again, other = asyncio.run(check())
+        self.assertEqual(first, again)
+        self.assertFalse(other['is_ai_generated'])
+        self.assertEqual(detector.calls, 2)
+
+    def test_uploaded_images_are_checked_in_the_background(self):
+        upload = SimpleUploadedFile('photo.png', png_bytes(), content_type='image/png')
+        response = self.client.post('/api/moderation/', {'user_id': '1', 'username': 'user1', 'caption': 'sunset', 'image': upload})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['ai_image_status'], 'pending')
+
+        detector = FakeImageDetector({'is_ai_generated': False, 'score': 0.0, 'error': 'API Error 500'},
+                                     {'is_ai_generated': True, 'score': 0.97})
+        queue = ImageCheckQueue(detector=detector)
+        post_id = response.json()['id']
+
+        async def check():
+            first = await queue.process(post_id)
+            await database_sync_to_async(Post.objects.filter(pk=post_id).update)(ai_image_due_at=timezone.now())
+            return first, await queue.process(post_id)
+
+        first, post = asyncio.run(check())
+        self.assertEqual(first.ai_image_status, 'pending')
+        self.assertEqual((post.ai_image_status, post.is_ai_generated, post.ai_image_score), ('checked', True, 0.97))
+
+
+HOSTS = {'images.example': '93.184.216.34', 'cdn.example': '151.101.1.69', 'internal.example': '10.0.0.7'}
+
+
+async def fake_resolve(host, port):
+    return [HOSTS.get(host, host)]
+
+
+class ImageURLTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.enterContext(mock.patch.object(image_checks, '_resolve', fake_resolve))
+        self.requests = []
+
+    def detect(self, url, handler, detector):
+        def record(request):
+            self.requests.append(str(request.url))
+            return handler(request)
+
+        async def check():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(record)) as client:
+                return await detect_image_url(url, detector, client)
+
+        return asyncio.run(check())
+
+    def test_private_addresses_are_refused_without_a_request(self):
+        for url in ('http://127.0.0.1/a.png', 'http://10.0.0.5/a.png', 'http://169.254.169.254/latest/meta-data/',
+                    'http://[::1]/a.png', 'http://[::ffff:127.0.0.1]/a.png', 'http://internal.example/a.png',
+                    'file:///etc/passwd', 'gopher://images.example/a.png'):
+            detector = FakeImageDetector()
+            result = self.detect(url, lambda request: httpx.Response(200, content=png_bytes()), detector)
+            self.assertEqual(result['error'], URL_NOT_ALLOWED, url)
+            self.assertEqual(detector.calls, 0)
+        self.assertEqual(self.requests, [])
+
+    def test_every_redirect_hop_is_checked(self):
+        def handler(request):
+            if request.url.host == 'images.example':
+                return httpx.Response(302, headers={'Location': 'http://internal.example/admin'})
+            return httpx.Response(200, content=png_bytes())
+
+        detector = FakeImageDetector()
+        result = self.detect('http://images.example/a.png', handler, detector)
+        self.assertEqual(result['error'], URL_NOT_ALLOWED)
+        self.assertEqual(self.requests, ['http://images.example/a.png'])
+
+    def test_public_redirects_are_followed_and_revalidated_by_etag(self):
+        def handler(request):
+            if request.url.host == 'images.example':
+                return httpx.Response(301, headers={'Location': 'https://cdn.example/a.png'})
+            if request.headers.get('If-None-Match') == '"v1"':
+                return httpx.Response(304)
+            return httpx.Response(200, content=png_bytes(), headers={'ETag': '"v1"'})
+
+        detector = FakeImageDetector({'is_ai_generated': True, 'score': 0.9})
+        first = self.detect('http://images.example/a.png', handler, detector)
+        again = self.detect('http://images.example/a.png', handler, detector)
+        self.assertEqual(first, again)
+        self.assertEqual(detector.calls, 1)
+        self.assertEqual(self.requests[1], 'https://cdn.example/a.png')
+
+    @mock.patch.object(image_checks, 'MAX_IMAGE_BYTES', 1024)
+    def test_large_bodies_are_not_read_to_the_end(self):
+        sent = []
+
+        async def body():
+            for _ in range(100):
+                sent.append(1)
+                yield b'x' * 512
+
+        detector = FakeImageDetector({'is_ai_generated': False, 'score': 0.2})
+        result = self.detect('http://images.example/huge.png', lambda request: httpx.Response(200, content=body()), detector)
+        # Left for the API to fetch by URL
+        self.assertEqual(result['score'], 0.2)
+        self.assertLess(len(sent), 100)
+
+    def test_connections_go_to_the_checked_address(self):
+        backend = image_checks.PublicAddressBackend()
+        backend.backend = mock.Mock(connect_tcp=mock.AsyncMock(return_value='stream'))
+        self.assertEqual(asyncio.run(backend.connect_tcp('images.example', 443)), 'stream')
+        backend.backend.connect_tcp.assert_awaited_once_with('93.184.216.34', 443, None, None, None)
+
+    def test_rebinding_after_the_check_is_refused_at_connect(self):
+        answers = ['93.184.216.34', '127.0.0.1']
+
+        async def rebinding(host, port):
+            return [answers.pop(0)]
+
+        async def check():
+            return await detect_image_url('http://rebind.example/a.png', detector)
+
+        detector = FakeImageDetector()
+        with mock.patch.object(image_checks, '_resolve', rebinding):
+            result = asyncio.run(check())
+        self.assertEqual(result['error'], URL_NOT_ALLOWED)
+        self.assertEqual((answers, detector.calls), ([], 0))
+
+    def test_sync_callers_share_one_pooled_client(self):
+        async def client_id(image_url):
+            return id(image_checks.get_client())
+
+        with mock.patch.object(image_checks, 'detect_image_url', client_id):
+            first = image_checks.detect_image_url_sync('http://images.example/a.png')
+            self.assertEqual(image_checks.detect_image_url_sync('http://images.example/b.png'), first)
+
+    def test_view_rejects_private_urls(self):
+        response = self.client.post('/api/moderation/check_ai_image/', {'image_url': 'http://127.0.0.1:8000/admin/'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], URL_NOT_ALLOWED)
+
+
+def photo_bytes(size=(2000, 1500)):
+    """A JPEG as a phone saves it: rotated by an EXIF tag, with a GPS position"""
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise to display
+    exif[0x8825] = {2: (51.0, 30.0, 0.0)}  # GPSInfo: latitude
+    buffer = BytesIO()
+    Image.new('RGB', size, 'green').save(buffer, 'JPEG', exif=exif)
+    return buffer.getvalue()
+
+
+@override_settings(AI_IMAGE_CHECK_WORKERS=0, FACT_CHECK_WORKERS=0, IMAGE_VARIANTS_WORKERS=0)
+class ImageVariantTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=self.media.name))
+
+    @override_settings(IMAGE_VARIANTS_PROCESSES=1)
+    def test_uploads_get_small_variants_without_exif(self):
+        upload = SimpleUploadedFile('photo.jpg', photo_bytes(), content_type='image/jpeg')
+        response = self.client.post('/api/moderation/', {'user_id': '1', 'username': 'user1', 'caption': 'park', 'image': upload})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['image_variants_status'], 'pending')
+        self.assertIsNone(response.json()['image_feed'])
+        # The original is served until the variants exist: no GPS, but still shown upright
+        with Image.open(Post.objects.get(pk=response.json()['id']).image.path) as original:
+            self.assertEqual(dict(original.getexif()), {0x0112: 6})
+
+        queue = ImageVariantQueue()
+        post_id = response.json()['id']
+        post = asyncio.run(queue.process(post_id))
+        self.assertEqual(post.image_variants_status, 'ready')
+        # Done; running it again does nothing
+        self.assertIsNone(asyncio.run(queue.process(post_id)))
+
+        for field, longest in (('image_thumb', 320), ('image_feed', 1080)):
+            with Image.open(getattr(post, field).path) as variant:
+                self.assertEqual(variant.format, 'WEBP')
+                # Turned upright by the orientation tag, which is dropped with the rest of the EXIF
+                self.assertEqual(variant.size, (longest * 3 // 4, longest))
+                self.assertEqual(len(variant.getexif()), 0)
+
+        results = self.client.get('/api/moderation/').json()['results']
+        self.assertTrue(results[0]['image_thumb'].endswith(f'/media/posts/variants/{post_id}/thumb.webp'))
+        self.assertTrue(results[0]['image_feed'].endswith(f'/media/posts/variants/{post_id}/feed.webp'))
+
+    def test_metadata_is_stripped_without_touching_the_pixels(self):
+        jpeg = os.path.join(self.media.name, 'photo.jpg')
+        with open(jpeg, 'wb') as f:
+            # Plus a second picture after the main one, as phones append previews
+            f.write(photo_bytes((640, 480)) + b'\xff\xd8\xff\xe1Exif GPS')
+        with Image.open(jpeg) as img:
+            pixels = img.tobytes()
+        png = os.path.join(self.media.name, 'drawing.png')
+        info = PngImagePlugin.PngInfo()
+        info.add_text('Author', 'Jane Doe')
+        Image.new('RGB', (8, 8), 'red').save(png, pnginfo=info)
+
+        self.assertTrue(strip_metadata(jpeg))
+        self.assertTrue(strip_metadata(png))
+        with Image.open(jpeg) as img:
+            self.assertEqual(dict(img.getexif()), {0x0112: 6})
+            self.assertEqual(img.tobytes(), pixels)
+        with open(jpeg, 'rb') as f:
+            self.assertNotIn(b'GPS', f.read())
+        with Image.open(png) as img:
+            self.assertNotIn('Author', img.info)
+        # Nothing left to strip
+        self.assertFalse(strip_metadata(jpeg))
+
+    def test_originals_uploaded_earlier_are_stripped_by_the_job(self):
+        os.makedirs(os.path.join(self.media.name, 'posts'))
+        with open(os.path.join(self.media.name, 'posts', 'old.jpg'), 'wb') as f:
+            f.write(photo_bytes((640, 480)))
+        post = Post.objects.create(user_id='1', username='user1', caption='old', image='posts/old.jpg',
+                                   image_variants_status='pending')
+
+        with override_settings(IMAGE_VARIANTS_PROCESSES=0):
+            asyncio.run(ImageVariantQueue().process(post.pk))
+        with Image.open(post.image.path) as original:
+            self.assertEqual(dict(original.getexif()), {0x0112: 6})
+
+    def test_rendering_again_replaces_the_same_files(self):
+        source = os.path.join(self.media.name, 'photo.jpg')
+        with open(source, 'wb') as f:
+            f.write(photo_bytes((640, 480)))
+        target = os.path.join(self.media.name, 'variants', 'thumb.jpg')
+
+        first = render_variants(source, [(target, 100)], 'JPEG')
+        again = render_variants(source, [(target, 100)], 'JPEG')
+        self.assertEqual(first, again)
+        self.assertEqual(first[target], (75, 100))
+        self.assertEqual(os.listdir(os.path.dirname(target)), ['thumb.jpg'])
@@ -0,0 +1,125 @@
+"""
+In-process index of active speech timeouts.
+
+`check_timeout` ran a StreamTimeout query for every transcript, although
+almost nobody is ever timed out. Each worker now keeps a dict of
+(user key, stream key) -> expiry timestamp instead. It is loaded from the DB
+when the first speech socket connects. After that it is kept coherent by
+events on the TIMEOUT_GROUP channel-layer group. The issuing worker
+publishes `timeout.issued`, and the expiry scheduler publishes
+`timeout.expired`. Entries carry their expiry time, so a lost expiry
+event can't keep anyone muted past the deadline.
+"""
+import asyncio
+import time
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.utils import timezone
+
+from .models import StreamTimeout
+
+
+TIMEOUT_GROUP = 'speech_timeouts'
+
+# Re-join the group well before channels_redis' group_expiry drops the listener
+REJOIN_SECONDS = 3600
+
+
+def row_key(user_id, user_identifier, stream_id, stream_identifier):
+    """Index key for a StreamTimeout row (FK ids win over raw identifiers, like SpeechIdentity)"""
+    return str(user_id or user_identifier), str(stream_id or stream_identifier)
+
+
+class TimeoutIndex:
+    def __init__(self):
+        self.active = {}
+        self.loop = None
+        self.task = None
+        self.ready = None
+
+    async def start(self):
+        """Load and subscribe once per event loop; later callers just wait until it's ready"""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop or self.task is None or self.task.done():
+            self.loop = loop
+            self.ready = loop.create_future()
+            self.task = loop.create_task(self._listen())
+        await asyncio.shield(self.ready)
+
+    def is_timed_out(self, key):
+        expires = self.active.get(key)
+        if expires is None:
+            return False
+        if expires <= time.time():
+            self.active.pop(key, None)
+            return False
+        return True
+
+    def add(self, key, expires_at):
+        expires = expires_at.timestamp()
+        if expires > self.active.get(key, 0):
+            self.active[key] = expires
+
+    def discard(self, key):
+        self.active.pop(key, None)
+
+    async def publish_issued(self, key, expires_at):
+        """Record locally right away, then tell the other workers"""
+        self.add(key, expires_at)
+        await get_channel_layer().group_send(TIMEOUT_GROUP, {
+            'type': 'timeout.issued',
+            'key': list(key),
+            'expires_at': expires_at.timestamp(),
+        })
+
+    @database_sync_to_async
+    def _load_active(self):
+        return list(StreamTimeout.objects.filter(is_active=True, expires_at__gt=timezone.now()).values_list(
+            'user_id', 'user_identifier', 'stream_id', 'stream_identifier', 'expires_at'
+        ))
+
+    async def _listen(self):
+        layer = get_channel_layer()
+        try:
+            channel = await layer.new_channel()
+            # Subscribe before loading so nothing issued in between is missed
+            await layer.group_add(TIMEOUT_GROUP, channel)
+            for *ids, expires_at in await self._load_active():
+                self.add(row_key(*ids), expires_at)
+        except Exception as e:
+            print(f"   [TIMEOUTS] Could not load active timeouts: {e}")
+            self.ready.set_exception(e)
+            return
+        self.ready.set_result(True)
+        print(f"   [TIMEOUTS] Index loaded with {len(self.active)} active timeout(s)")
+
+        rejoin_at = time.monotonic() + REJOIN_SECONDS
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(layer.receive(channel), REJOIN_SECONDS)
+                except asyncio.TimeoutError:
+                    message = None
+                if time.monotonic() >= rejoin_at:
+                    await layer.group_add(TIMEOUT_GROUP, channel)
+                    rejoin_at = time.monotonic() + REJOIN_SECONDS
+                if message is None:
+                    continue
+                key = tuple(message['key'])
+                if message['type'] == 'timeout.issued':
+                    expires = message['expires_at']
+                    if expires > self.active.get(key, 0):
+                        self.active[key] = expires
+                elif message['type'] == 'timeout.expired':
+                    # Ignore expiries of an older timeout when a newer one is already indexed
+                    if self.active.get(key, 0) <= message['expires_at']:
+                        self.discard(key)
+        finally:
+            try:
+                await layer.group_discard(TIMEOUT_GROUP, channel)
+            except Exception:
+                pass
+
+
+timeout_index = TimeoutIndex()
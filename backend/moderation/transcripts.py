@@ -0,0 +1,183 @@
+"""
+Incremental moderation of streaming speech transcripts.
+
+With interim results on, the browser resends the whole utterance so far
+each time it hears more, e.g. "you are", then "you are a", then "you are a
+complete idiot". Moderating every version in full scans an N-word utterance
+about N times. It also flags the same bad word again on every update.
+`TranscriptTracker` remembers how much of each utterance has already been
+moderated. Only the new words go to the detector, together with
+OVERLAP_WORDS of already-checked context so phrases split across two updates
+are still caught. The overlap never reaches back into words that were already
+counted as a violation. The tracker also keeps the masked version of what has
+been moderated, so replies always carry the whole utterance masked, never the
+raw words of an earlier, flagged update.
+
+`TranscriptCoalescer` sits in front of that. Several tabs or a reconnect
+storm can resend near-identical transcripts faster than the detector can
+keep up. The coalescer holds them for a short window and keeps only the
+newest version of each utterance.
+"""
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from django.conf import settings
+
+
+# Already-moderated words re-sent with each new suffix
+DEFAULT_OVERLAP_WORDS = 3
+# Open utterances remembered per connection; the oldest is dropped first
+MAX_OPEN_UTTERANCES = 16
+# How long a transcript may wait for a newer version before it is moderated
+DEFAULT_COALESCE_MS = 150
+
+
+@dataclass
+class Segment:
+    """The part of a transcript that still needs moderation"""
+    utterance_id: str
+    text: str
+    end: int
+    is_final: bool
+    # Index of the segment's first word in the utterance
+    start: int = 0
+
+
+class _Utterance:
+    __slots__ = ('words', 'masked', 'moderated', 'flagged')
+
+    def __init__(self):
+        self.words = []
+        # Masked version of words [0, moderated)
+        self.masked = []
+        # Words [0, moderated) have been checked; [0, flagged) already produced a violation
+        self.moderated = 0
+        self.flagged = 0
+
+
+class TranscriptTracker:
+    """Per-connection record of what has been moderated in each open utterance"""
+
+    def __init__(self, overlap_words=None):
+        if overlap_words is None:
+            overlap_words = getattr(settings, 'SPEECH_MODERATION_OVERLAP_WORDS', DEFAULT_OVERLAP_WORDS)
+        self.overlap_words = overlap_words
+        self.utterances = OrderedDict()
+
+    def segment(self, utterance_id, transcript, is_final):
+        """
+        Return the `Segment` to moderate for this version of the utterance, or
+        None when it adds nothing new. Call `commit` once it has been moderated.
+        """
+        words = transcript.split()
+        state = self.utterances.get(utterance_id)
+        if state is None:
+            state = self.utterances[utterance_id] = _Utterance()
+            while len(self.utterances) > MAX_OPEN_UTTERANCES:
+                self.utterances.popitem(last=False)
+        else:
+            self.utterances.move_to_end(utterance_id)
+
+        # The recogniser may revise earlier words; only the unchanged prefix counts as moderated
+        same = 0
+        limit = min(state.moderated, len(words))
+        while same < limit and words[same].lower() == state.words[same].lower():
+            same += 1
+        state.moderated = same
+        state.flagged = min(state.flagged, same)
+        state.words = words
+        del state.masked[same:]
+
+        if same == len(words):
+            if is_final:
+                self.utterances.pop(utterance_id, None)
+            return None
+
+        start = max(state.flagged, same - self.overlap_words, 0)
+        return Segment(utterance_id, ' '.join(words[start:]), len(words), is_final, start)
+
+    def commit(self, segment, flagged=False, masked_text=None):
+        """
+        Mark the segment as moderated; `flagged` if it was counted as a violation.
+
+        `masked_text` is the detector's masked version of the segment. Returns
+        the whole utterance so far, masked, to show the speaker.
+        """
+        masked_words = (masked_text if masked_text is not None else segment.text).split()
+        state = self.utterances.get(segment.utterance_id)
+        if segment.is_final:
+            self.utterances.pop(segment.utterance_id, None)
+        if state is None:
+            return ' '.join(masked_words)
+
+        raw_words = segment.text.split()
+        if len(masked_words) != len(raw_words):
+            # Masking never changes the word count; if it ever does, mask the whole segment
+            masked_words = ['*' * len(word) for word in raw_words]
+        masked = state.masked[:segment.start]
+        for offset, word in enumerate(masked_words):
+            position = segment.start + offset
+            # Overlap words keep their earlier masking even if this pass let them through
+            if position < len(state.masked) and word == raw_words[offset]:
+                word = state.masked[position]
+            masked.append(word)
+        state.masked = masked
+        if not segment.is_final:
+            state.moderated = max(state.moderated, segment.end)
+            if flagged:
+                state.flagged = state.moderated
+        return ' '.join(masked)
+
+
+class TranscriptCoalescer:
+    """
+    Per-connection buffer in front of `handler(utterance_id, transcript, is_final)`.
+
+    The window starts with the first transcript that arrives while the
+    buffer is empty and is not extended by later ones. Nothing waits longer
+    than one window plus the time to moderate what came before it. A newer
+    version of an utterance replaces its pending interim version. A pending
+    final is never replaced by an interim. Transcripts without an utterance
+    id only merge with identical text.
+    """
+
+    def __init__(self, handler, window_ms=None):
+        if window_ms is None:
+            window_ms = getattr(settings, 'SPEECH_TRANSCRIPT_COALESCE_MS', DEFAULT_COALESCE_MS)
+        self.handler = handler
+        self.window = window_ms / 1000
+        self.pending = OrderedDict()
+        self.task = None
+        self.superseded = 0
+
+    async def submit(self, utterance_id, transcript, is_final):
+        if self.window <= 0:
+            await self.handler(utterance_id, transcript, is_final)
+            return
+        key = ('utterance', utterance_id) if utterance_id is not None else ('text', transcript)
+        previous = self.pending.get(key)
+        if previous is not None:
+            self.superseded += 1
+            if previous[2] and not is_final:
+                return
+        # Replacing keeps the key's place, so utterances are still handled in arrival order
+        self.pending[key] = (utterance_id, transcript, is_final)
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._flush())
+
+    async def _flush(self):
+        try:
+            while self.pending:
+                await asyncio.sleep(self.window)
+                batch, self.pending = self.pending, OrderedDict()
+                for utterance_id, transcript, is_final in batch.values():
+                    await self.handler(utterance_id, transcript, is_final)
+        finally:
+            self.task = None
+
+    def close(self):
+        """Drop whatever is still pending (the socket is going away)"""
+        self.pending.clear()
+        if self.task is not None:
+            self.task.cancel()
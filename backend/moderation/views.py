@@ -1,14 +1,26 @@
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from django.contrib.auth.models import User
+from django.contrib.auth import get_user_model
 from .models import Warning, Restriction
 from .serializers import WarningSerializer, RestrictionSerializer
 from .ai_detector import ToxicityDetector
-from rest_framework import generics, permissions, status, views
+from rest_framework import generics, permissions, serializers, status, views
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.db import IntegrityError, transaction
+from django.db.models import F
 from django.shortcuts import get_object_or_404
-from .models import Post, PostLike, PostReport, ConfirmedRumor
+from .models import Post, PostLike, PostReport, PostReportCounter
 from .serializers import PostSerializer
-from moderation.ai_detector import is_factually_correct
+from .rumors import check_caption, confirm_rumor
+from .expiry import RESTRICTION, expiry_scheduler
+from .fact_check import fact_check_queue
+from .image_checks import URL_NOT_ALLOWED, detect_image_url_sync, image_check_queue
+from .image_render import strip_metadata
+from .image_variants import image_variant_queue
+from .post_views import view_counter
+from .feed import InvalidCursor, cached_first_page, feed_page, invalidate_feed, merge_liked
+
+User = get_user_model()
 
 class CheckRumorView(APIView):
     def post(self, request):
@@ -16,7 +28,7 @@ class CheckRumorView(APIView):
         if not text:
             return Response({'isRumour': False, 'warning': ''})
             
-        is_correct, reason = is_factually_correct(text)
+        is_correct, reason = check_caption(text)
         return Response({
             'isRumour': not is_correct,
             'warning': reason
@@ -38,10 +50,10 @@ class CheckAIImageView(APIView):
         if not image_url:
             return Response({'error': 'Image URL is required'}, status=status.HTTP_400_BAD_REQUEST)
             
-        from .ai_detector import AIImageDetector
-        detector = AIImageDetector()
-        result = detector.detect(image_url)
-        
+        # Cached by image content (and revalidated by ETag), so a repeat costs no API call
+        result = detect_image_url_sync(image_url)
+        if result.get('error') == URL_NOT_ALLOWED:
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
         return Response(result)
 
 class WarningListView(generics.ListAPIView):
@@ -63,6 +75,9 @@ class RestrictUserView(APIView):
         restriction_type = request.data.get('restriction_type', 'chat')
         reason = request.data.get('reason', 'Manual restriction')
         is_permanent = request.data.get('is_permanent', False)
+        # ISO 8601; a timed restriction without one is never enforced
+        expires_at = request.data.get('expires_at')
+        expires_at = serializers.DateTimeField().to_internal_value(expires_at) if expires_at else None
         
         try:
             user = User.objects.get(id=user_id)
@@ -72,8 +87,12 @@ class RestrictUserView(APIView):
                 restriction_type=restriction_type,
                 reason=reason,
                 issued_by=request.user if request.user.is_authenticated else None,
-                is_permanent=is_permanent
+                is_permanent=is_permanent,
+                expires_at=expires_at
             )
+            # Lifted on time by this worker's scheduler instead of at its next resync
+            if not restriction.is_permanent:
+                expiry_scheduler.schedule_threadsafe(RESTRICTION, restriction.pk, restriction.expires_at)
             
             return Response(
                 RestrictionSerializer(restriction).data,
@@ -90,24 +109,64 @@ class RestrictionListView(generics.ListAPIView):
     serializer_class = RestrictionSerializer
 
 class PostListCreateView(generics.ListCreateAPIView):
-    queryset = Post.objects.all().order_by('-created_at')
     serializer_class = PostSerializer
     permission_classes = [permissions.AllowAny] # No Django auth needed
 
+    def initialize_request(self, request, *args, **kwargs):
+        # Uploads go to a temp file chunk by chunk and are moved into MEDIA_ROOT, never held in memory.
+        # Set before DRF parses the body (authentication already reads it for the CSRF check).
+        if request.method == 'POST':
+            request.upload_handlers = [TemporaryFileUploadHandler(request)]
+        return super().initialize_request(request, *args, **kwargs)
+
+    def get_queryset(self):
+        # Like counts and is_liked come from the same query (no per-post queries)
+        return Post.objects.with_feed_annotations(self.request.query_params.get('user_id'))
+
     def get_serializer_context(self):
         context = super().get_serializer_context()
         # Allows passing user_id in query param for "is_liked" check
         context['user_id'] = self.request.query_params.get('user_id')
         return context
 
+    def list(self, request, *args, **kwargs):
+        cursor = request.query_params.get('cursor')
+        if not cursor:
+            # Same for every viewer once is_liked is left out; merged back in below
+            page = cached_first_page(self.build_first_page)
+            return Response({
+                'results': merge_liked(page['results'], request.query_params.get('user_id')),
+                'next': page['next'],
+            })
+
+        try:
+            posts, next_cursor = feed_page(self.get_queryset(), cursor)
+        except InvalidCursor:
+            return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'results': self.get_serializer(posts, many=True).data,
+            'next': next_cursor,
+        })
+
+    def build_first_page(self):
+        posts, next_cursor = feed_page(Post.objects.with_feed_annotations())
+        return self.get_serializer(posts, many=True).data, next_cursor
+
     def perform_create(self, serializer):
-        caption = serializer.validated_data.get('caption', '')
-        
-        # Webz.io Fact-Checking
-        is_correct, reason = is_factually_correct(caption)
-        
-        # Save with detected rumor status
-        serializer.save(is_rumor=not is_correct, rumor_reason=reason if not is_correct else "")
+        # Saved as pending; the fact check, image check and image variants run in the background
+        # and are pushed over ws/posts/
+        image = serializer.validated_data.get('image')
+        has_image = bool(image)
+        if has_image and hasattr(image, 'temporary_file_path'):
+            # Served as `image` until the variants exist; don't publish where the photo was taken
+            strip_metadata(image.temporary_file_path())
+        image_state = 'pending' if has_image else 'none'
+        post = serializer.save(ai_image_status=image_state, image_variants_status=image_state)
+        transaction.on_commit(lambda: fact_check_queue.submit(post.pk))
+        if has_image:
+            transaction.on_commit(lambda: image_check_queue.submit(post.pk))
+            transaction.on_commit(lambda: image_variant_queue.submit(post.pk))
+        invalidate_feed()
 
 class LikePostView(views.APIView):
     permission_classes = [permissions.AllowAny]
@@ -119,25 +178,34 @@ class LikePostView(views.APIView):
         if not user_id:
             return Response({"error": "user_id is required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        like, created = PostLike.objects.get_or_create(post=post, user_id=str(user_id))
-        
-        if not created:
-            # If already liked, toggle (remove) it
-            like.delete()
-            liked = False
-        else:
-            liked = True
-            
+        # One indexed delete or insert plus one F() update, however many likes the post has
+        with transaction.atomic():
+            unliked, _ = PostLike.objects.filter(post=post, user_id=str(user_id)).delete()
+            if unliked:
+                liked, delta = False, -1
+            else:
+                try:
+                    with transaction.atomic():
+                        PostLike.objects.create(post=post, user_id=str(user_id))
+                    liked, delta = True, 1
+                except IntegrityError:
+                    # A concurrent request from the same user already liked (and counted) it
+                    liked, delta = True, 0
+            if delta:
+                Post.objects.filter(pk=post.pk).update(likes_count=F('likes_count') + delta)
+            post.refresh_from_db(fields=['likes_count'])
+
         return Response({'liked': liked, 'likes_count': post.likes_count})
 
 class IncrementViewView(views.APIView):
     permission_classes = [permissions.AllowAny]
 
     def post(self, request, pk):
-        post = get_object_or_404(Post, pk=pk)
-        post.views += 1
-        post.save()
-        return Response({'views': post.views})
+        # Buffered and flushed to the DB in batches; the count is approximate
+        views_total = view_counter.record(pk, request.data.get('user_id'))
+        if views_total is None:
+            return Response({'error': 'Post not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'views': views_total})
 
 class PostDeleteView(generics.DestroyAPIView):
     queryset = Post.objects.all()
@@ -155,7 +223,16 @@ class PostDeleteView(generics.DestroyAPIView):
                 status=status.HTTP_403_FORBIDDEN
             )
             
-        return super().delete(request, *args, **kwargs)
+        response = super().delete(request, *args, **kwargs)
+        invalidate_feed()
+        return response
+
+
+# Misinformation reports that flag a post as a rumor
+MISINFORMATION_REASON = "Misinformation"
+MISINFORMATION_REPORT_THRESHOLD = 10
+
+
 class ReportPostView(views.APIView):
     permission_classes = [permissions.AllowAny]
 
@@ -170,21 +247,37 @@ class ReportPostView(views.APIView):
         if not reason:
             return Response({"error": "reason is required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        PostReport.objects.create(
-            post=post,
-            reporter_user_id=str(user_id),
-            reason=reason,
-            description=description
-        )
-        
-        # Check if reports for this post with reason "Misinformation" reached 10
-        misinfo_reports_count = PostReport.objects.filter(post=post, reason="Misinformation").count()
-        if misinfo_reports_count >= 10:
-            post.is_rumor = True
-            post.rumor_reason = "Flags: Community identified this post as potential misinformation."
-            post.save()
-            
-            # Save to ConfirmedRumor to prevent future occurrences
-            ConfirmedRumor.objects.get_or_create(caption_text=post.caption)
+        with transaction.atomic():
+            PostReport.objects.create(
+                post=post,
+                reporter_user_id=str(user_id),
+                reason=reason,
+                description=description
+            )
+            reports = count_report(post, reason)
+
+            # Exactly one report sees the counter reach the threshold: the F() update holds the row lock until commit
+            if reason == MISINFORMATION_REASON and reports == MISINFORMATION_REPORT_THRESHOLD:
+                Post.objects.filter(pk=post.pk).update(
+                    is_rumor=True,
+                    rumor_reason="Flags: Community identified this post as potential misinformation."
+                )
+                # Save to ConfirmedRumor to prevent future occurrences
+                confirm_rumor(post.caption)
+                transaction.on_commit(invalidate_feed)
         
         return Response({'message': 'Report submitted successfully'}, status=status.HTTP_201_CREATED)
+
+
+def count_report(post, reason):
+    """Add one to the (post, reason) counter and return the new total"""
+    counters = PostReportCounter.objects.filter(post=post, reason=reason)
+    if not counters.update(count=F('count') + 1):
+        try:
+            with transaction.atomic():
+                PostReportCounter.objects.create(post=post, reason=reason, count=1)
+            return 1
+        except IntegrityError:
+            # Created by a concurrent first report
+            counters.update(count=F('count') + 1)
+    return counters.values_list('count', flat=True).get()
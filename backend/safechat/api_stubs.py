@@ -0,0 +1,157 @@
+"""
+Local stand-ins for the Sightengine and Google Fact Check APIs.
+
+Load tests point SIGHTENGINE_API_URL and GOOGLE_FACT_CHECK_API_URL here so
+nuanced messages exercise the API code path without hitting the real services
+(or their quotas). Every response is delayed by a tunable latency so slow
+upstreams can be simulated. Verdicts come from small word lists, so runs are
+repeatable.
+
+    python -m safechat.api_stubs --port 8901 --latency-ms 80 --jitter-ms 40
+
+GET /stats returns per-endpoint request counts.
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+from urllib.parse import parse_qs, urlsplit
+
+
+PROFANITY = {'fuck', 'fucking', 'shit', 'damn', 'bitch', 'asshole'}
+INSULTS = {'idiot', 'stupid', 'loser', 'moron', 'pathetic', 'trash', 'useless'}
+FALSE_CLAIM_MARKERS = ('hoax', 'rumor', 'rumour', 'fake cure', 'flat earth')
+
+
+class ApiStubServer:
+    """Asyncio HTTP server answering the Sightengine and fact check endpoints"""
+
+    def __init__(self, latency_ms=50, jitter_ms=0, error_rate=0.0, seed=None):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.counts = {}
+        self.server = None
+
+    # ---- responses ----
+
+    def sightengine(self, params):
+        if params.get('models') == 'genai':
+            # Image check: pretend URLs mentioning "ai" are generated
+            score = 0.95 if 'ai' in params.get('url', '').lower() else 0.05
+            return {'status': 'success', 'type': {'ai_generated': score}}
+
+        words = re.findall(r"[a-z']+", params.get('text', '').lower())
+        matches = [{'type': 'inappropriate', 'match': w, 'word': w} for w in words if w in PROFANITY]
+        insult = 0.9 if any(w in INSULTS for w in words) else 0.05
+        return {
+            'status': 'success',
+            'profanity': {'matches': matches},
+            'class': {
+                'insult': insult,
+                'toxic': 0.8 if matches or insult > 0.5 else 0.05,
+                'discriminatory': 0.01,
+            },
+        }
+
+    def fact_check(self, params):
+        query = params.get('query', '').lower()
+        if not any(marker in query for marker in FALSE_CLAIM_MARKERS):
+            return {}
+        return {'claims': [{
+            'text': query,
+            'claimReview': [{'textualRating': 'False', 'publisher': {'name': 'Stub Fact Check'}}],
+        }]}
+
+    def route(self, path, params):
+        if path.endswith('/check.json'):
+            return 'sightengine', self.sightengine(params)
+        if path.endswith('claims:search'):
+            return 'fact_check', self.fact_check(params)
+        if path == '/stats':
+            return None, {'requests': self.counts}
+        return None, None
+
+    # ---- HTTP plumbing ----
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass  # headers are not needed; stub endpoints are all GET
+            parts = request_line.decode('latin-1').split()
+            if len(parts) < 2:
+                return
+            url = urlsplit(parts[1])
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+            name, payload = self.route(url.path, params)
+            status = '200 OK'
+            if name:
+                self.counts[name] = self.counts.get(name, 0) + 1
+                delay = self.latency + self.random.uniform(0, self.jitter)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if self.error_rate and self.random.random() < self.error_rate:
+                    status, payload = '503 Service Unavailable', {'status': 'failure'}
+            elif payload is None:
+                status, payload = '404 Not Found', {'error': 'unknown endpoint'}
+
+            body = json.dumps(payload).encode()
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+def stub_settings_env(base_url):
+    """Environment that points a SafeChat server at stubs running on `base_url`"""
+    return {
+        'SIGHTENGINE_API_URL': f'{base_url}/1.0/check.json',
+        'SIGHTENGINE_API_USER': 'stub',
+        'SIGHTENGINE_API_SECRET': 'stub',
+        'GOOGLE_FACT_CHECK_API_URL': f'{base_url}/v1alpha1/claims:search',
+        'GOOGLE_FACT_CHECK_API_KEY': 'stub',
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run local Sightengine / fact check API stubs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8901)
+    parser.add_argument('--latency-ms', type=float, default=50, help='Base delay added to every API response')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Extra random delay, uniform in [0, jitter]')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with HTTP 503')
+    parser.add_argument('--seed', type=int, default=None)
+    options = parser.parse_args()
+
+    async def serve():
+        stubs = ApiStubServer(options.latency_ms, options.jitter_ms, options.error_rate, options.seed)
+        port = await stubs.start(options.host, options.port)
+        print(f"API stubs listening on http://{options.host}:{port}", flush=True)
+        await stubs.server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
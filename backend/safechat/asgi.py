@@ -9,6 +9,7 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'safechat.settings')
 django_asgi_app = get_asgi_application()
 
 from chat.routing import websocket_urlpatterns
+from safechat.health import with_heartbeat
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
@@ -17,4 +18,7 @@ application = ProtocolTypeRouter({
             URLRouter(websocket_urlpatterns)
         )
     ),
-})
\ No newline at end of file
+})
+
+# Reports per-worker health when started by `manage.py runworkers`
+application = with_heartbeat(application)
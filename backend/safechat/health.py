@@ -0,0 +1,150 @@
+"""
+Per-worker health reporting for `manage.py runworkers`.
+
+Each worker started by the supervisor gets SAFECHAT_WORKER_ID and
+SAFECHAT_HEALTH_DIR in its environment. A heartbeat thread then writes
+`worker-<pid>.json` into that directory every few seconds. The file holds
+uptime, event-loop lag and chat socket counts. The supervisor restarts workers
+whose heartbeat goes stale (dead or stuck process) or whose loop lag passes
+--max-loop-lag (wedged event loop). Every worker serves the combined view at
+/api/health/.
+"""
+import asyncio
+import glob
+import json
+import os
+import threading
+import time
+
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+
+WORKER_ID = os.environ.get('SAFECHAT_WORKER_ID')
+HEALTH_DIR = os.environ.get('SAFECHAT_HEALTH_DIR')
+HEARTBEAT_INTERVAL = float(os.environ.get('SAFECHAT_HEARTBEAT_INTERVAL', 2))
+
+STARTED_AT = time.time()
+
+
+def write_json_atomic(path, payload):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, path)
+
+
+def read_statuses(health_dir=HEALTH_DIR):
+    """All worker heartbeats plus the supervisor summary found in `health_dir`"""
+    statuses = {'supervisor': None, 'workers': []}
+    if not health_dir:
+        return statuses
+    for path in sorted(glob.glob(os.path.join(health_dir, 'worker-*.json'))):
+        try:
+            with open(path) as f:
+                statuses['workers'].append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    try:
+        with open(os.path.join(health_dir, 'supervisor.json')) as f:
+            statuses['supervisor'] = json.load(f)
+    except (OSError, ValueError):
+        pass
+    return statuses
+
+
+class WorkerHeartbeat(threading.Thread):
+    """Background thread that periodically records this worker's health"""
+
+    def __init__(self, health_dir, worker_id, interval=HEARTBEAT_INTERVAL):
+        super().__init__(name='safechat-heartbeat', daemon=True)
+        self.path = os.path.join(health_dir, f'worker-{os.getpid()}.json')
+        self.worker_id = worker_id
+        self.interval = interval
+        self.loop = None
+        self.loop_lag_ms = None
+        # (event, posted at) of the last no-op sent through the loop
+        self._probe = None
+
+    def watch_loop(self, loop):
+        self.loop = loop
+
+    def _measure_loop_lag(self):
+        """
+        Round-trip a no-op through the event loop; a wedged loop shows up as lag.
+
+        This thread keeps writing heartbeats while the loop is blocked, so the
+        lag is what tells the supervisor a worker is wedged. A probe the loop
+        still hasn't run counts the whole time since it was posted, so the lag
+        keeps growing for as long as the loop stays blocked.
+        """
+        if self.loop is None or self.loop.is_closed():
+            return None
+        if self._probe is not None and not self._probe[0].is_set():
+            return round((time.monotonic() - self._probe[1]) * 1000, 1)
+        ran = threading.Event()
+        started = time.monotonic()
+        try:
+            self.loop.call_soon_threadsafe(ran.set)
+        except RuntimeError:
+            return None
+        self._probe = (ran, started)
+        ran.wait(self.interval)
+        return round((time.monotonic() - started) * 1000, 1)
+
+    def snapshot(self):
+        from chat.outbound import room_metrics
+
+        rooms = room_metrics()
+        return {
+            'worker_id': self.worker_id,
+            'pid': os.getpid(),
+            'started_at': STARTED_AT,
+            'uptime': round(time.time() - STARTED_AT, 1),
+            'heartbeat_at': time.time(),
+            'loop_lag_ms': self.loop_lag_ms,
+            'chat_connections': sum(r['connections'] for r in rooms.values()),
+            'queued_frames': sum(r['queue_depth'] for r in rooms.values()),
+        }
+
+    def run(self):
+        while True:
+            self.loop_lag_ms = self._measure_loop_lag()
+            try:
+                write_json_atomic(self.path, self.snapshot())
+            except OSError as e:
+                print(f"[!] Heartbeat write failed: {e}")
+            time.sleep(self.interval)
+
+
+heartbeat = None
+
+
+def with_heartbeat(application):
+    """
+    Wrap the ASGI application so supervised workers report health.
+    Outside `runworkers` this returns the application unchanged.
+    """
+    global heartbeat
+    if not (WORKER_ID and HEALTH_DIR):
+        return application
+
+    heartbeat = WorkerHeartbeat(HEALTH_DIR, WORKER_ID)
+    heartbeat.start()
+
+    async def app(scope, receive, send):
+        if heartbeat.loop is None:
+            heartbeat.watch_loop(asyncio.get_running_loop())
+        return await application(scope, receive, send)
+
+    return app
+
+
+class HealthView(APIView):
+    """Liveness of this worker plus the last heartbeat of every sibling worker"""
+    def get(self, request):
+        return Response({
+            'status': 'ok',
+            'worker': heartbeat.snapshot() if heartbeat else {'pid': os.getpid(), 'uptime': round(time.time() - STARTED_AT, 1)},
+            **read_statuses(),
+        })
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/6.0/ref/settings/
 
 from pathlib import Path
 import os
+
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -91,7 +93,8 @@ WSGI_APPLICATION = 'safechat.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        # Overridable so subprocess tests (e.g. the load test smoke run) can use a throwaway database
+        'NAME': os.environ.get('SQLITE_PATH') or BASE_DIR / 'db.sqlite3',
     }
 }
 
@@ -132,6 +135,10 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Uploaded post images and their variants
+MEDIA_URL = '/media/'
+MEDIA_ROOT = os.environ.get('MEDIA_ROOT', str(BASE_DIR / 'media'))
+
 
 # CORS Settings
 CORS_ALLOWED_ORIGINS = [
@@ -154,15 +161,176 @@ REST_FRAMEWORK = {
 
 # Google Fact Check API
 GOOGLE_FACT_CHECK_API_KEY = os.environ.get("GOOGLE_FACT_CHECK_API_KEY", "YOUR_GOOGLE_FACT_CHECK_API_KEY_HERE")
+GOOGLE_FACT_CHECK_API_URL = os.environ.get("GOOGLE_FACT_CHECK_API_URL", "https://factchecktools.googleapis.com/v1alpha1/claims:search")
 
 # Sightengine API
 SIGHTENGINE_API_USER = os.environ.get("SIGHTENGINE_API_USER", "1208256496")
 SIGHTENGINE_API_SECRET = os.environ.get("SIGHTENGINE_API_SECRET", "hWKXKMEuVeVUgtXQmXLJGMkWRsTk7tvP")
+# Point both at `python -m safechat.api_stubs` for load testing without the real services
+SIGHTENGINE_API_URL = os.environ.get("SIGHTENGINE_API_URL", "https://api.sightengine.com/1.0/check.json")
 
 # Channels
 ASGI_APPLICATION = 'safechat.asgi.application'
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+
+# Channel layer selection:
+#   'memory'        - single process only, group broadcasts never leave the worker
+#   'redis'         - one Redis server at REDIS_URL (required for multiple workers)
+#   'redis_sharded' - channels/groups consistently hashed across REDIS_SHARD_URLS
+CHANNEL_LAYER_BACKEND = os.environ.get('CHANNEL_LAYER_BACKEND', 'memory')
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/0')
+REDIS_SHARD_URLS = [url.strip() for url in os.environ.get('REDIS_SHARD_URLS', '').split(',') if url.strip()]
+if CHANNEL_LAYER_BACKEND == 'redis_sharded' and not REDIS_SHARD_URLS:
+    raise ImproperlyConfigured(
+        "CHANNEL_LAYER_BACKEND=redis_sharded needs REDIS_SHARD_URLS (comma-separated redis:// URLs)"
+    )
+
+CHANNEL_LAYER_CONFIG = {
+    # Messages buffered per channel before sends raise ChannelFull
+    'capacity': int(os.environ.get('CHANNEL_LAYER_CAPACITY', 500)),
+    # Chat frames older than this are useless to a viewer, drop them early
+    'expiry': int(os.environ.get('CHANNEL_LAYER_EXPIRY', 30)),
+    # Must outlive the longest WebSocket session or sockets silently leave their groups
+    'group_expiry': int(os.environ.get('CHANNEL_LAYER_GROUP_EXPIRY', 86400)),
+}
+
+if CHANNEL_LAYER_BACKEND in ('redis', 'redis_sharded'):
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': REDIS_SHARD_URLS if CHANNEL_LAYER_BACKEND == 'redis_sharded' else [REDIS_URL],
+                'prefix': 'safechat',
+                **CHANNEL_LAYER_CONFIG,
+                # Group fan-out targets are per-socket channels; HTTP channels need far less room
+                'channel_capacity': {
+                    'http.request': 200,
+                    'http.response!*': 10,
+                },
+            },
+        },
+    }
+    # Shared cache for cross-worker state (rate limits etc.)
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL if CHANNEL_LAYER_BACKEND == 'redis' else REDIS_SHARD_URLS[0],
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': CHANNEL_LAYER_CONFIG,
+        },
+    }
+
+
+# WebSocket rate limiting: token buckets refilling `rate` tokens/second up to `burst`
+WEBSOCKET_RATE_LIMITS = {
+    'chat': {
+        'connection': {'rate': 2, 'burst': 5},
+        'user': {'rate': 3, 'burst': 8},
+        'room': {'rate': 100, 'burst': 200},
     },
+    'speech': {
+        'connection': {'rate': 4, 'burst': 8},
+        'user': {'rate': 4, 'burst': 8},
+        'room': {'rate': 10, 'burst': 20},
+    },
+}
+# What the 'user' bucket of an anonymous socket is keyed on: 'address' (client IP)
+# or 'connection'. Websockets carry no Django session here, so with 'connection'
+# a client gets a fresh user bucket for every socket it opens.
+WEBSOCKET_RATE_LIMIT_ANONYMOUS_KEY = os.environ.get('WEBSOCKET_RATE_LIMIT_ANONYMOUS_KEY', 'address')
+# Cache alias (e.g. a Redis-backed cache) to enforce user/room limits across workers.
+# With a Redis channel layer the default cache is Redis, so that is the default here too.
+WEBSOCKET_RATE_LIMIT_CACHE = os.environ.get('WEBSOCKET_RATE_LIMIT_CACHE') or (
+    'default' if CHANNEL_LAYER_BACKEND in ('redis', 'redis_sharded') else None
+)
+
+# Per-(user, stream) speech violation counts used for escalation. With a Redis
+# channel layer the default cache is Redis, so the counts are shared by all workers.
+SPEECH_VIOLATION_LEDGER_CACHE = 'default'
+
+# Interim speech transcripts are moderated incrementally: only the new words
+# plus this many already-checked words before them, for phrases split across updates
+SPEECH_MODERATION_OVERLAP_WORDS = 3
+
+# Speech transcripts wait up to this long for a newer version of the same
+# utterance; superseded interim versions are dropped without being moderated
+SPEECH_TRANSCRIPT_COALESCE_MS = int(os.environ.get('SPEECH_TRANSCRIPT_COALESCE_MS', 150))
+
+# How often each worker's expiry scheduler reloads upcoming timeout/restriction
+# deadlines from the DB (picks up rows created by other workers or the admin)
+EXPIRY_RESYNC_SECONDS = int(os.environ.get('EXPIRY_RESYNC_SECONDS', 60))
+
+# Stream viewer counts are tallied in memory and written (one F() update per
+# stream) and broadcast this often. RECORD_STREAM_VIEWERS also keeps
+# StreamViewer join/leave rows for viewers with a known user id.
+VIEWER_COUNT_FLUSH_SECONDS = float(os.environ.get('VIEWER_COUNT_FLUSH_SECONDS', 2))
+RECORD_STREAM_VIEWERS = os.environ.get('RECORD_STREAM_VIEWERS', 'True') == 'True'
+
+# Each worker's live stream directory (ws/streams/) is rebuilt from stream
+# events; this periodic DB comparison catches changes that sent no event
+DIRECTORY_RESYNC_SECONDS = int(os.environ.get('DIRECTORY_RESYNC_SECONDS', 300))
+
+# Post feed (GET /api/moderation/) page size, and how long the shared first
+# page is cached; create/delete/rumor flag changes invalidate it immediately
+POST_FEED_PAGE_SIZE = int(os.environ.get('POST_FEED_PAGE_SIZE', 20))
+POST_FEED_CACHE_SECONDS = int(os.environ.get('POST_FEED_CACHE_SECONDS', 30))
+
+# Post views are counted in memory and in the default cache, and written to
+# the DB this often as one F() UPDATE. Repeat views of a post by the same
+# viewer within POST_VIEW_DEDUP_SECONDS are not counted (0 counts every view).
+POST_VIEW_FLUSH_SECONDS = float(os.environ.get('POST_VIEW_FLUSH_SECONDS', 5))
+POST_VIEW_DEDUP_SECONDS = int(os.environ.get('POST_VIEW_DEDUP_SECONDS', 1800))
+
+# New posts are saved as pending and fact-checked in the background by this
+# many concurrent checks per process (0 turns the background queue off).
+# Failed checks are retried with exponential backoff starting at
+# FACT_CHECK_RETRY_SECONDS; pending posts left over from a restart are picked
+# up every FACT_CHECK_POLL_SECONDS.
+FACT_CHECK_WORKERS = int(os.environ.get('FACT_CHECK_WORKERS', 4))
+FACT_CHECK_TIMEOUT_SECONDS = float(os.environ.get('FACT_CHECK_TIMEOUT_SECONDS', 10))
+FACT_CHECK_MAX_ATTEMPTS = int(os.environ.get('FACT_CHECK_MAX_ATTEMPTS', 5))
+FACT_CHECK_RETRY_SECONDS = int(os.environ.get('FACT_CHECK_RETRY_SECONDS', 15))
+FACT_CHECK_POLL_SECONDS = int(os.environ.get('FACT_CHECK_POLL_SECONDS', 30))
+
+# Fact check API verdicts (including "correct") are cached per normalized
+# caption for this long; confirmed rumors are matched before either
+FACT_CHECK_CACHE_SECONDS = int(os.environ.get('FACT_CHECK_CACHE_SECONDS', 6 * 60 * 60))
+
+# AI-generated image verdicts are cached by image content hash. Uploaded
+# post images are checked in the background like fact checks.
+AI_IMAGE_CACHE_SECONDS = int(os.environ.get('AI_IMAGE_CACHE_SECONDS', 30 * 24 * 60 * 60))
+AI_IMAGE_CHECK_WORKERS = int(os.environ.get('AI_IMAGE_CHECK_WORKERS', 2))
+AI_IMAGE_CHECK_TIMEOUT_SECONDS = float(os.environ.get('AI_IMAGE_CHECK_TIMEOUT_SECONDS', 30))
+AI_IMAGE_CHECK_MAX_ATTEMPTS = int(os.environ.get('AI_IMAGE_CHECK_MAX_ATTEMPTS', 5))
+
+# Uploaded post images get a thumbnail and a feed-size copy (longest side in
+# pixels), re-encoded without EXIF, by IMAGE_VARIANTS_WORKERS concurrent jobs
+# per process. The Pillow work runs in IMAGE_VARIANTS_PROCESSES spawned
+# processes (0 renders in a thread).
+IMAGE_VARIANTS_WORKERS = int(os.environ.get('IMAGE_VARIANTS_WORKERS', 2))
+IMAGE_VARIANTS_PROCESSES = int(os.environ.get('IMAGE_VARIANTS_PROCESSES', 2))
+IMAGE_VARIANTS_TIMEOUT_SECONDS = float(os.environ.get('IMAGE_VARIANTS_TIMEOUT_SECONDS', 60))
+IMAGE_VARIANTS_MAX_ATTEMPTS = int(os.environ.get('IMAGE_VARIANTS_MAX_ATTEMPTS', 3))
+IMAGE_VARIANTS_SIZES = {'thumb': 320, 'feed': 1080}
+IMAGE_VARIANTS_FORMAT = os.environ.get('IMAGE_VARIANTS_FORMAT', 'WEBP')
+IMAGE_VARIANTS_QUALITY = int(os.environ.get('IMAGE_VARIANTS_QUALITY', 80))
+
+# Near-duplicates of confirmed rumors are matched in an in-memory MinHash/LSH
+# index whose signatures are appended to RUMOR_INDEX_PATH for fast startup
+# ('' keeps it in memory only). Other processes' new rumors are picked up
+# every RUMOR_INDEX_REFRESH_SECONDS.
+RUMOR_INDEX_PATH = os.environ.get('RUMOR_INDEX_PATH', str(BASE_DIR / 'rumor_index.bin'))
+RUMOR_MATCH_THRESHOLD = float(os.environ.get('RUMOR_MATCH_THRESHOLD', 0.7))
+RUMOR_INDEX_REFRESH_SECONDS = int(os.environ.get('RUMOR_INDEX_REFRESH_SECONDS', 30))
+
+# Per-socket outbound queue for chat broadcasts.
+# POLICY: 'drop_oldest', 'coalesce' (merge into a message_batch frame) or 'disconnect'
+CHAT_OUTBOUND_QUEUE = {
+    'MAX_SIZE': 100,
+    'POLICY': 'coalesce',
+    'MAX_LAG_SECONDS': 10,
 }
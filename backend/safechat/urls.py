@@ -2,12 +2,14 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from safechat.health import HealthView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/auth/', include('users.urls')),
     path('api/chat/', include('chat.urls')),
     path('api/moderation/', include('moderation.urls')),
+    path('api/health/', HealthView.as_view(), name='health'),
 ]
 
 if settings.DEBUG:
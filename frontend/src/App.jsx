@@ -132,6 +132,12 @@ const SocialModerationPlatform = () => {
         const data = JSON.parse(event.data);
         console.log('WebSocket message:', data);
 
+        if (data.type === 'message_batch') {
+          // Server coalesced messages while this client was lagging behind
+          data.messages.forEach(message => ws.onmessage({ data: JSON.stringify({ type: 'new_message', message }) }));
+          return;
+        }
+
         if (data.type === 'message_history') {
           setMessages(prev => mergeMessages(prev, data.messages, null));
         } else if (data.type === 'new_message') {
@@ -178,6 +184,14 @@ const SocialModerationPlatform = () => {
         } else if (data.type === 'restriction') {
           setRestrictedUsers(prev => new Set([...prev, user.id]));
           alert(data.message);
+        } else if (data.type === 'restriction_expired') {
+          if (String(data.user_id) === String(user.id)) {
+            setRestrictedUsers(prev => {
+              const next = new Set(prev);
+              next.delete(user.id);
+              return next;
+            });
+          }
         }
       };
 
@@ -210,7 +224,8 @@ const SocialModerationPlatform = () => {
     if (!user || !currentStream) return;
 
     const connectStreamWebSocket = () => {
-      const ws = new WebSocket(`ws://127.0.0.1:8000/ws/chat/${currentStream.id}/`);
+      // user_id lets the server record this visit in StreamViewer
+      const ws = new WebSocket(`ws://127.0.0.1:8000/ws/chat/${currentStream.id}/?user_id=${user.id}`);
 
       ws.onopen = () => {
         console.log('Stream WebSocket connected');
@@ -219,6 +234,11 @@ const SocialModerationPlatform = () => {
       ws.onmessage = (event) => {
         const data = JSON.parse(event.data);
 
+        if (data.type === 'message_batch') {
+          data.messages.forEach(message => ws.onmessage({ data: JSON.stringify({ type: 'new_message', message }) }));
+          return;
+        }
+
         if (data.type === 'message_history') {
           setMessages(prev => mergeMessages(prev, data.messages, currentStream.id));
         } else if (data.type === 'new_message') {
@@ -264,6 +284,24 @@ const SocialModerationPlatform = () => {
         } else if (data.type === 'restriction') {
           setRestrictedUsers(prev => new Set([...prev, user.id]));
           alert(data.message);
+        } else if (data.type === 'stream_event') {
+          // Lifecycle deltas pushed by the server; no need to poll the stream endpoints
+          const delta = data.stream;
+          if (data.event === 'viewer_count') {
+            setLiveStreams(prev =>
+              prev.map(s => String(s.id) === String(delta.id) ? { ...s, viewers: delta.viewer_count } : s)
+            );
+          } else if (data.event === 'ended' || data.event === 'stopped') {
+            setLiveStreams(prev =>
+              prev.map(s => String(s.id) === String(delta.id) ? { ...s, isLive: false } : s)
+            );
+            // The streamer's own UI is handled by handleStopStream / the speech hook
+            if (currentStream.streamerId !== user.id) {
+              alert(data.event === 'stopped' ? 'This stream was stopped by moderation.' : 'This stream has ended.');
+              setCurrentStream(null);
+              setActiveTab('chat');
+            }
+          }
         }
       };
 
@@ -511,6 +549,11 @@ const SocialModerationPlatform = () => {
     setRestrictedUsers(prev => new Set([...prev, userId]));
   };
 
+  // Viewer counts are kept up to date in liveStreams (replacing currentStream would reconnect its socket)
+  const currentViewers = currentStream
+    ? (liveStreams.find(s => s.id === currentStream.id) || currentStream).viewers
+    : 0;
+
   const getFilteredMessages = () => {
     if (activeTab === 'chat') {
       return messages.filter(msg => msg.streamId === null);
@@ -879,7 +922,7 @@ const SocialModerationPlatform = () => {
                       <span className="w-3 h-3 bg-red-500 rounded-full animate-pulse"></span>
                       <span className="font-semibold text-red-700">LIVE</span>
                       <span className="text-gray-600">|</span>
-                      <span className="text-gray-700">{currentStream?.viewers || 0} viewers</span>
+                      <span className="text-gray-700">{currentViewers || 0} viewers</span>
                     </div>
                     <button
                       onClick={handleStopStream}
@@ -925,7 +968,7 @@ const SocialModerationPlatform = () => {
                 <div className="flex items-center space-x-6">
                   <div className="flex items-center space-x-2 text-purple-300">
                     <Eye className="w-5 h-5" />
-                    <span className="font-black">{currentStream.viewers}</span>
+                    <span className="font-black">{currentViewers}</span>
                   </div>
                   {currentStream.streamerId !== user.id && (
                     <button
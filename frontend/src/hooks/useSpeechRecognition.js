@@ -13,6 +13,7 @@ export const useSpeechRecognition = (streamId, userId, isStreaming) => {
   const timeoutIntervalRef = useRef(null);
   const reconnectTimeoutRef = useRef(null);
   const lastSentTranscriptRef = useRef('');
+  const sessionRef = useRef(0);
   const processingRef = useRef(false);
   const lastRestartRef = useRef(0);
   const resumeOnWsOpenRef = useRef(false);
@@ -34,26 +35,32 @@ export const useSpeechRecognition = (streamId, userId, isStreaming) => {
     streamStoppedRef.current = streamStopped;
   }, [streamStopped]);
 
-  // Throttle function to prevent sending too many requests
-  const throttledSend = useCallback((ws, transcript) => {
-    // Don't send if already processing or if it's the same as last sent
-    if (processingRef.current || transcript === lastSentTranscriptRef.current) {
-      return;
-    }
+  // Throttle function to prevent sending too many requests.
+  // Final results always go out, even when the text matches the last interim,
+  // so the backend can moderate the end of the utterance and close it.
+  const throttledSend = useCallback((ws, transcript, utteranceId, isFinal) => {
+    if (!isFinal) {
+      // Don't send if already processing or if it's the same as last sent
+      if (transcript === lastSentTranscriptRef.current || processingRef.current) {
+        return;
+      }
 
-    // Don't send very short transcripts
-    if (transcript.length < 3) {
-      return;
+      // Don't send very short transcripts
+      if (transcript.length < 3) {
+        return;
+      }
     }
 
     processingRef.current = true;
     lastSentTranscriptRef.current = transcript;
 
-    console.log('🎤 SENDING TO BACKEND:', transcript);
+    console.log(`🎤 SENDING TO BACKEND (${isFinal ? 'final' : 'interim'}):`, transcript);
 
     ws.send(JSON.stringify({
       type: 'speech_transcript',
       transcript: transcript,
+      utterance_id: utteranceId,
+      is_final: isFinal,
       user_id: userId,
       stream_id: streamId,
       timestamp: new Date().toISOString()
@@ -139,7 +146,7 @@ export const useSpeechRecognition = (streamId, userId, isStreaming) => {
 
     const recognition = new SpeechRecognition();
     recognition.continuous = true;
-    recognition.interimResults = false; // Only get final results for better performance
+    recognition.interimResults = true; // Interim results are moderated incrementally by the backend
     recognition.maxAlternatives = 1; // Only get best match
     recognition.lang = 'en-US';
 
@@ -281,19 +288,21 @@ export const useSpeechRecognition = (streamId, userId, isStreaming) => {
         return;
       }
 
-      // Only process final results for better performance
+      // Each result index is one utterance; interim versions of it grow until it is final
       for (let i = event.resultIndex; i < event.results.length; i++) {
-        if (event.results[i].isFinal) {
-          const transcript = event.results[i][0].transcript.trim();
+        const isFinal = event.results[i].isFinal;
+        const transcript = event.results[i][0].transcript.trim();
+        const utteranceId = `${sessionRef.current}-${i}`;
 
+        if (isFinal) {
           console.log('🎤 FINAL TRANSCRIPT:', transcript);
+        }
 
-          if (transcript && speechWsRef.current &&
-            speechWsRef.current.readyState === WebSocket.OPEN &&
-            !isTimedOut && !streamStopped) {
-            // Use throttled send
-            throttledSend(speechWsRef.current, transcript);
-          }
+        if (transcript && speechWsRef.current &&
+          speechWsRef.current.readyState === WebSocket.OPEN &&
+          !isTimedOut && !streamStopped) {
+          // Use throttled send
+          throttledSend(speechWsRef.current, transcript, utteranceId, isFinal);
         }
       }
     };
@@ -369,6 +378,8 @@ export const useSpeechRecognition = (streamId, userId, isStreaming) => {
 
     recognition.onstart = () => {
       console.log('🎙️ Recognition started');
+      // Result indexes restart with every session, so utterance ids get a session prefix
+      sessionRef.current += 1;
       setIsListening(true);
       isStartingRef.current = false;
     };